@@ -0,0 +1,262 @@
+"""Admission control and load shedding.
+
+WSGI middleware that sorts each request into a route class before Flask
+sees it, and gives every class its own concurrency limit and wait queue:
+
+    auth      /login, /signup               bcrypt makes these CPU-heavy
+    timeline  / and /api/v1/timeline        the most expensive reads
+    writes    other POST/PUT/PATCH/DELETE
+    static    /static/ and /media/ files
+    default   every other read
+
+So when logins or timelines pile up, they only queue behind each other and
+cheap pages keep being served.
+
+A request that finds its class at its limit waits in that class's queue,
+but only until the class's deadline; a full queue or a missed deadline gets
+an immediate 503 with Retry-After, rather than a slow timeout after it has
+already tied up a worker. The live stream (/stream) and account exports
+are long-lived by design and are never limited.
+
+A request holds its slot until the server closes its response body, as
+every WSGI server does once the body is sent. Werkzeug's test client
+doesn't: open requests with ``buffered=True`` or close the response, or
+every request leaks a slot and the class soon sheds everything
+(benchmarks/harness.py buffers; testing.py turns admission off).
+
+Limits adapt to observed latency (additive increase, multiplicative
+decrease): a class whose requests take longer than its target latency has
+its limit cut by 10%, at most once per target interval; a class running at
+its limit within target creeps back up. Admission counters, queue depths,
+current limits and a latency average per class are served as JSON at
+/_status/admission.
+"""
+
+import json
+import threading
+import time
+
+STATUS_PATH = '/_status/admission'
+
+# Never admission controlled: long-lived responses would hold a slot and
+# drag their class's limit down
+EXEMPT_PATHS = {'/stream', '/users/export', STATUS_PATH}
+
+AUTH_PATHS = {'/login', '/signup'}
+TIMELINE_PATHS = {'/', '/api/v1/timeline'}
+STATIC_PREFIXES = ('/static/', '/media/')
+WRITE_METHODS = {'POST', 'PUT', 'PATCH', 'DELETE'}
+
+# Route class -> limiter settings; override per class with ADMISSION_LIMITS
+DEFAULT_LIMITS = {
+    'auth':     {'limit': 4,  'min_limit': 1,  'max_limit': 16,
+                 'max_queue': 16,  'deadline': 0.5, 'target_latency': 0.5},
+    'timeline': {'limit': 8,  'min_limit': 2,  'max_limit': 32,
+                 'max_queue': 32,  'deadline': 1.0, 'target_latency': 0.3},
+    'writes':   {'limit': 8,  'min_limit': 2,  'max_limit': 32,
+                 'max_queue': 32,  'deadline': 1.0, 'target_latency': 0.2},
+    'static':   {'limit': 64, 'min_limit': 16, 'max_limit': 256,
+                 'max_queue': 256, 'deadline': 2.0, 'target_latency': 0.05},
+    'default':  {'limit': 16, 'min_limit': 4,  'max_limit': 64,
+                 'max_queue': 64,  'deadline': 1.0, 'target_latency': 0.2},
+}
+
+DECREASE_FACTOR = 0.9
+
+# Weight of the newest sample in each class's latency average
+LATENCY_SMOOTHING = 0.1
+
+
+def classify(environ):
+    """The route class of a WSGI request, or None if it's exempt."""
+    path = environ.get('PATH_INFO') or '/'
+    if path in EXEMPT_PATHS:
+        return None
+    if path in AUTH_PATHS:
+        return 'auth'
+    if path.startswith(STATIC_PREFIXES):
+        return 'static'
+    if environ.get('REQUEST_METHOD', 'GET') in WRITE_METHODS:
+        return 'writes'
+    if path in TIMELINE_PATHS:
+        return 'timeline'
+    return 'default'
+
+
+class Shed(Exception):
+    """A request turned away; ``reason`` is 'queue_full' or 'deadline'."""
+
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class AdaptiveLimiter:
+    """A concurrency limit with a bounded, deadline-limited wait queue."""
+
+    def __init__(self, limit, min_limit, max_limit, max_queue, deadline,
+                 target_latency, clock=time.monotonic):
+        self.limit = float(limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.max_queue = max_queue
+        self.deadline = deadline
+        self.target_latency = target_latency
+        self.clock = clock
+
+        self.in_flight = 0
+        self.queued = 0
+        self.last_decrease = float('-inf')
+        self.latency = None
+        self.counts = {'admitted': 0, 'queue_full': 0, 'deadline': 0}
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """Wait for a slot; raise Shed if none comes free in time."""
+        with self.condition:
+            if self.in_flight < int(self.limit) and not self.queued:
+                return self._admit()
+
+            if self.queued >= self.max_queue:
+                self.counts['queue_full'] += 1
+                raise Shed('queue_full')
+
+            give_up = self.clock() + self.deadline
+            self.queued += 1
+            try:
+                while self.in_flight >= int(self.limit):
+                    remaining = give_up - self.clock()
+                    if remaining <= 0 or not self.condition.wait(remaining):
+                        if self.in_flight < int(self.limit):
+                            break
+                        self.counts['deadline'] += 1
+                        raise Shed('deadline')
+            finally:
+                self.queued -= 1
+            return self._admit()
+
+    def _admit(self):
+        self.in_flight += 1
+        self.counts['admitted'] += 1
+        return self.clock()
+
+    def release(self, started):
+        """Free a slot and adapt the limit to how long the request took."""
+        now = self.clock()
+        latency = now - started
+        with self.condition:
+            self.in_flight -= 1
+            self.latency = (latency if self.latency is None else
+                            self.latency + LATENCY_SMOOTHING * (latency - self.latency))
+
+            if latency > self.target_latency:
+                if now - self.last_decrease >= self.target_latency:
+                    self.limit = max(self.min_limit, self.limit * DECREASE_FACTOR)
+                    self.last_decrease = now
+            elif self.in_flight + 1 >= int(self.limit):
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+            self.condition.notify()
+
+    def metrics(self):
+        with self.condition:
+            return dict(self.counts, limit=round(self.limit, 2), in_flight=self.in_flight,
+                        queued=self.queued,
+                        latency_ms=None if self.latency is None else round(self.latency * 1000, 2))
+
+
+class _Released:
+    """Wraps a WSGI response body so its slot is freed once it's been sent."""
+
+    def __init__(self, body, release):
+        self.body = body
+        self.release = release
+
+    def __iter__(self):
+        return iter(self.body)
+
+    def close(self):
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            self.release()
+
+
+class AdmissionController:
+    """WSGI middleware applying a limiter per route class."""
+
+    def __init__(self, app=None):
+        self.wsgi_app = None
+        self.limiters = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if not app.config.setdefault('ADMISSION_ENABLED', True):
+            return
+
+        overrides = app.config.setdefault('ADMISSION_LIMITS', {})
+        self.limiters = {name: AdaptiveLimiter(**dict(settings, **overrides.get(name, {})))
+                         for name, settings in DEFAULT_LIMITS.items()}
+
+        # Only ever wrap the Flask app once, however often this is called
+        if self.wsgi_app is None or getattr(app.wsgi_app, '__self__', None) is not self:
+            self.wsgi_app = app.wsgi_app
+            app.wsgi_app = self.__call__
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO')
+        if path == STATUS_PATH:
+            return self.status(start_response)
+
+        route_class = classify(environ)
+        limiter = self.limiters.get(route_class)
+        if limiter is None:
+            return self.wsgi_app(environ, start_response)
+
+        try:
+            started = limiter.acquire()
+        except Shed:
+            return self.shed(limiter, start_response)
+
+        released = []
+
+        def release():
+            if not released:
+                released.append(True)
+                limiter.release(started)
+
+        try:
+            return _Released(self.wsgi_app(environ, start_response), release)
+        except BaseException:
+            release()
+            raise
+
+    @staticmethod
+    def shed(limiter, start_response):
+        """A fast 503 for a request that couldn't be admitted."""
+        retry_after = max(1, int(limiter.deadline + 0.999))
+        body = b"The server is busy. Try again shortly.\n"
+        start_response('503 Service Unavailable', [
+            ('Content-Type', 'text/plain; charset=utf-8'),
+            ('Content-Length', str(len(body))),
+            ('Retry-After', str(retry_after)),
+            ('Cache-Control', 'no-store'),
+        ])
+        return [body]
+
+    def metrics(self):
+        return {name: limiter.metrics() for name, limiter in self.limiters.items()}
+
+    def status(self, start_response):
+        body = json.dumps(self.metrics(), sort_keys=True).encode()
+        start_response('200 OK', [
+            ('Content-Type', 'application/json'),
+            ('Content-Length', str(len(body))),
+            ('Cache-Control', 'no-store'),
+        ])
+        return [body]
+
+
+admission = AdmissionController()
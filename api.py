@@ -0,0 +1,473 @@
+"""Versioned JSON API (``/api/v1``) for timelines, profiles and messages.
+
+Reads go straight to Core ``SELECT``s of just the requested columns and are
+serialized from plain rows, so no ORM objects are built. Conventions:
+
+- ``?fields=id,username`` selects a subset of fields (``id`` is always kept)
+- list endpoints return ``{"data": [...], "next_cursor": ...}``; pass
+  ``?cursor=<next_cursor>`` for the next page, ``?limit=`` to size pages;
+  message lists carry on into the archive (see archive.py) past the
+  oldest hot message
+- message lists side-load their authors once in ``"users"``, keyed by id
+- ``/users?ids=1,2,3`` and ``/messages?ids=...`` fetch many rows at once
+- ``/follows`` and ``/likes`` apply up to MAX_BULK_ITEMS follows or likes
+  (POST) or unfollows/unlikes (DELETE) in one transaction, from a JSON body
+  like ``{"ids": [1, 2, 3]}``, and report what happened to each id
+
+Authentication is the same session cookie the HTML pages use.
+
+With sharding on (see sharding.py), message and like queries run on the
+shards that hold them, found from the authors or message ids asked for,
+and pages from several shards are merged by (timestamp, id).
+"""
+
+import base64
+import binascii
+import json
+from datetime import datetime
+
+from flask import Blueprint, Response, current_app, g, request
+
+import archive
+from models import db, Follows, Likes, Message, User
+from sharding import router
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 200
+MAX_BATCH_IDS = 100
+MAX_BULK_ITEMS = 100
+
+users = User.__table__
+messages = Message.__table__
+follows = Follows.__table__
+likes = Likes.__table__
+
+# Cursor timestamps always carry microseconds so they round-trip exactly
+CURSOR_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+# Public fields per resource; email and password are never exposed
+USER_FIELDS = {name: users.c[name] for name in
+               ('id', 'username', 'image_url', 'header_image_url', 'bio', 'location')}
+MESSAGE_FIELDS = {name: messages.c[name] for name in ('id', 'text', 'timestamp', 'user_id')}
+
+# Author fields side-loaded with message lists
+AUTHOR_FIELDS = ['id', 'username', 'image_url']
+
+
+class APIError(Exception):
+    """An error returned to the client as JSON with an HTTP status."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+@api.errorhandler(APIError)
+def handle_api_error(err):
+    return json_response({'error': err.message}, status=err.status)
+
+
+def _default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Can't serialize {type(value).__name__}")
+
+
+def json_response(payload, status=200):
+    """Serialize compactly (no whitespace) straight from plain data."""
+    body = json.dumps(payload, separators=(',', ':'), default=_default)
+    return Response(body, status=status, mimetype='application/json')
+
+
+def require_user():
+    if not g.user:
+        raise APIError("Authentication required.", 401)
+    return g.user
+
+
+##############################################################################
+# Request parsing
+
+
+def requested_fields(available, default=None):
+    """Column list for ``?fields=``, validated against ``available``."""
+    raw = request.args.get('fields')
+    if not raw:
+        names = default or list(available)
+    else:
+        names = [name.strip() for name in raw.split(',') if name.strip()]
+        unknown = [name for name in names if name not in available]
+        if unknown:
+            raise APIError(f"Unknown fields: {', '.join(unknown)}")
+
+    # The id is needed for cursors and side-loading, so always include it
+    if 'id' not in names:
+        names = ['id'] + names
+    return names
+
+
+def requested_limit():
+    limit = request.args.get('limit', DEFAULT_LIMIT, type=int)
+    return max(1, min(limit, MAX_LIMIT))
+
+
+def requested_ids():
+    """Parse ``?ids=1,2,3`` into a de-duplicated list of ints."""
+    try:
+        ids = [int(part) for part in request.args.get('ids', '').split(',') if part]
+    except ValueError:
+        raise APIError("ids must be a comma-separated list of integers")
+
+    if not ids:
+        raise APIError("ids is required")
+    if len(ids) > MAX_BATCH_IDS:
+        raise APIError(f"At most {MAX_BATCH_IDS} ids per request")
+    return list(dict.fromkeys(ids))
+
+
+def requested_body_ids():
+    """Parse the ``{"ids": [...]}`` JSON body of a bulk write.
+
+    Requiring a JSON body also keeps these session-authenticated writes out
+    of reach of cross-site form posts.
+    """
+    body = request.get_json(silent=True)
+    ids = body.get('ids') if isinstance(body, dict) else None
+
+    if not isinstance(ids, list) or not ids:
+        raise APIError('Expected a JSON body like {"ids": [1, 2, 3]}')
+    if not all(isinstance(i, int) and not isinstance(i, bool) for i in ids):
+        raise APIError("ids must be integers")
+
+    max_items = current_app.config.get('API_MAX_BULK_ITEMS', MAX_BULK_ITEMS)
+    if len(ids) > max_items:
+        raise APIError(f"At most {max_items} ids per request")
+    return ids
+
+
+def encode_cursor(values):
+    raw = json.dumps(values, separators=(',', ':'), default=_default).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor():
+    """Return the decoded ``?cursor=`` value, or None if absent."""
+    raw = request.args.get('cursor')
+    if not raw:
+        return None
+    try:
+        return json.loads(base64.urlsafe_b64decode(raw + '=' * (-len(raw) % 4)))
+    except (binascii.Error, ValueError):
+        raise APIError("Invalid cursor")
+
+
+##############################################################################
+# Queries
+
+
+def execute(query, shard=None):
+    """Run a Core query on the main database, or on ``shard``."""
+    return db.session.execute(query, bind=router.engine(shard) if shard is not None else None)
+
+
+def fetch(query, names, shard=None):
+    """Run a Core query and return its rows as dicts keyed by ``names``."""
+    return [dict(zip(names, row)) for row in execute(query, shard)]
+
+
+def by_shard(keys, shard_for, where):
+    """{shard: where(keys stored there)}, or {None: where(keys)} unsharded.
+
+    ``shard_for`` is ``router.shard_for_user`` or ``router.shard_for_message``.
+    """
+    if not router.enabled:
+        return {None: where(list(keys))}
+    groups = router.group_by_shard(dict.fromkeys(keys), shard_for)
+    return {shard: where(group) for shard, group in groups.items()}
+
+
+def fetch_users(ids, names):
+    columns = [USER_FIELDS[name] for name in names]
+    return fetch(db.select(columns).where(users.c.id.in_(ids)), names)
+
+
+def message_page(wheres, names, archived_authors=None):
+    """A keyset-paginated page of messages, newest first, with authors.
+
+    ``wheres`` maps each shard to read (None for the main database; see
+    ``by_shard``) to the condition its messages must meet. The cursor is
+    the (timestamp, id) of the last message returned; the next page
+    continues strictly after it in the same order the index is read.
+    If the hot table runs out, the page is filled from the archive of the
+    users ``archived_authors()`` returns.
+    """
+    limit = requested_limit()
+    cursor = decode_cursor()
+    before = None
+
+    # Cursor values and authors need these even if the client didn't ask
+    select_names = list(dict.fromkeys(names + ['timestamp', 'user_id']))
+    query = (db.select([MESSAGE_FIELDS[name] for name in select_names])
+             .order_by(messages.c.timestamp.desc(), messages.c.id.desc())
+             .limit(limit + 1))
+
+    if cursor is not None:
+        try:
+            timestamp = datetime.strptime(cursor[0], CURSOR_TIME_FORMAT)
+            message_id = int(cursor[1])
+        except (TypeError, ValueError, IndexError):
+            raise APIError("Invalid cursor")
+        before = (timestamp, message_id)
+        query = query.where(db.tuple_(messages.c.timestamp, messages.c.id)
+                            < db.tuple_(*before))
+
+    rows = []
+    for shard, where in wheres.items():
+        rows.extend(fetch(query.where(where), select_names, shard))
+    if len(wheres) > 1:
+        # Each shard's newest limit + 1; the newest of all of them make the page
+        rows.sort(key=lambda row: (row['timestamp'], row['id']), reverse=True)
+        del rows[limit + 1:]
+
+    if len(rows) <= limit and archived_authors is not None:
+        # Everything left in the hot table fits: carry on into the archive
+        if rows:
+            before = (rows[-1]['timestamp'], rows[-1]['id'])
+        older = archive.older_messages(archived_authors(), before, limit + 1 - len(rows))
+        rows.extend({name: msg[name] for name in select_names} for msg in older)
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    next_cursor = None
+    if has_more:
+        last = rows[-1]
+        next_cursor = encode_cursor([last['timestamp'].strftime(CURSOR_TIME_FORMAT), last['id']])
+    authors = fetch_users({row['user_id'] for row in rows}, AUTHOR_FIELDS) if rows else []
+
+    return {
+        'data': [{name: row[name] for name in names} for row in rows],
+        'users': {str(author['id']): author for author in authors},
+        'next_cursor': next_cursor,
+    }
+
+
+def user_page(user_column, other_column, user_id, names):
+    """A page of users on the other end of ``user_id``'s follows, by id."""
+    limit = requested_limit()
+    cursor = decode_cursor()
+
+    columns = [USER_FIELDS[name] for name in names]
+    query = (db.select(columns)
+             .select_from(users.join(follows, other_column == users.c.id))
+             .where(user_column == user_id)
+             .order_by(users.c.id)
+             .limit(limit + 1))
+
+    if cursor is not None:
+        if not isinstance(cursor, int):
+            raise APIError("Invalid cursor")
+        query = query.where(users.c.id > cursor)
+
+    rows = fetch(query, names)
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    return {
+        'data': rows,
+        'next_cursor': encode_cursor(rows[-1]['id']) if has_more else None,
+    }
+
+
+def get_user_or_404(user_id, names):
+    rows = fetch_users([user_id], names)
+    if not rows:
+        raise APIError("User not found.", 404)
+    return rows[0]
+
+
+##############################################################################
+# Endpoints
+
+
+@api.route('/timeline')
+def timeline():
+    """The logged-in user's homepage feed."""
+    user = require_user()
+    names = requested_fields(MESSAGE_FIELDS)
+
+    following = (db.select([follows.c.user_being_followed_id])
+                 .where(follows.c.user_following_id == user.id))
+
+    def authors():
+        return [user.id] + [user_id for (user_id,) in db.session.execute(following)]
+
+    if router.enabled:
+        # Follows stay in the main database: look the authors up first
+        wheres = by_shard(authors(), router.shard_for_user, messages.c.user_id.in_)
+    else:
+        wheres = {None: db.or_(messages.c.user_id == user.id,
+                               messages.c.user_id.in_(following))}
+
+    return json_response(message_page(wheres, names, authors))
+
+
+@api.route('/users')
+def users_batch():
+    """Many users by id: ``/users?ids=1,2,3``. Missing ids are left out."""
+    names = requested_fields(USER_FIELDS)
+    return json_response({'data': fetch_users(requested_ids(), names)})
+
+
+@api.route('/users/<int:user_id>')
+def user_detail(user_id):
+    """One user's profile, with follow/message counts."""
+    names = requested_fields(USER_FIELDS)
+    user = get_user_or_404(user_id, names)
+
+    message_count = db.select([db.func.count()]).where(messages.c.user_id == user_id)
+    follow_counts = [
+        db.select([db.func.count()]).where(follows.c.user_following_id == user_id).as_scalar(),
+        db.select([db.func.count()]).where(follows.c.user_being_followed_id == user_id).as_scalar(),
+    ]
+    if router.enabled:
+        # The author's messages are on their shard, follows in the main database
+        counts = [execute(message_count, router.shard_for_user(user_id)).scalar(),
+                  *db.session.execute(db.select(follow_counts)).first()]
+    else:
+        counts = db.session.execute(db.select(
+            [message_count.as_scalar()] + follow_counts)).first()
+    user['counts'] = dict(zip(('messages', 'following', 'followers'), counts))
+    user['counts']['messages'] += archive.archived_count(user_id)
+
+    return json_response({'data': user})
+
+
+@api.route('/users/<int:user_id>/messages')
+def user_messages(user_id):
+    """One user's messages, newest first."""
+    get_user_or_404(user_id, ['id'])
+    names = requested_fields(MESSAGE_FIELDS)
+    wheres = by_shard([user_id], router.shard_for_user, lambda ids: messages.c.user_id == user_id)
+    return json_response(message_page(wheres, names, lambda: [user_id]))
+
+
+@api.route('/users/<int:user_id>/followers')
+def user_followers(user_id):
+    """Users following this user."""
+    get_user_or_404(user_id, ['id'])
+    names = requested_fields(USER_FIELDS, ['id', 'username', 'image_url'])
+    return json_response(user_page(follows.c.user_being_followed_id,
+                                   follows.c.user_following_id, user_id, names))
+
+
+@api.route('/users/<int:user_id>/following')
+def user_following(user_id):
+    """Users this user follows."""
+    get_user_or_404(user_id, ['id'])
+    names = requested_fields(USER_FIELDS, ['id', 'username', 'image_url'])
+    return json_response(user_page(follows.c.user_following_id,
+                                   follows.c.user_being_followed_id, user_id, names))
+
+
+@api.route('/messages')
+def messages_batch():
+    """Many messages by id: ``/messages?ids=1,2,3``, with their authors."""
+    names = requested_fields(MESSAGE_FIELDS)
+    select_names = list(dict.fromkeys(names + ['user_id']))
+    query = db.select([MESSAGE_FIELDS[name] for name in select_names])
+    rows = []
+    for shard, where in by_shard(requested_ids(), router.shard_for_message,
+                                 messages.c.id.in_).items():
+        rows.extend(fetch(query.where(where), select_names, shard))
+    authors = fetch_users({row['user_id'] for row in rows}, AUTHOR_FIELDS) if rows else []
+
+    return json_response({
+        'data': [{name: row[name] for name in names} for row in rows],
+        'users': {str(author['id']): author for author in authors},
+    })
+
+
+@api.route('/messages/<int:message_id>')
+def message_detail(message_id):
+    """One message, with its author and like count."""
+    names = requested_fields(MESSAGE_FIELDS)
+    select_names = list(dict.fromkeys(names + ['user_id']))
+    # A message's likes are on its shard too
+    shard = router.shard_for_message(message_id) if router.enabled else None
+    rows = fetch(db.select([MESSAGE_FIELDS[name] for name in select_names])
+                 .where(messages.c.id == message_id), select_names, shard)
+    if not rows:
+        raise APIError("Message not found.", 404)
+
+    row = rows[0]
+    message = {name: row[name] for name in names}
+    message['likes'] = execute(
+        db.select([db.func.count()]).where(likes.c.message_id == message_id), shard).scalar()
+
+    return json_response({
+        'data': message,
+        'users': {str(row['user_id']): fetch_users([row['user_id']], AUTHOR_FIELDS)[0]},
+    })
+
+
+def bulk_result(ids, outcomes):
+    """Per-item results, in request order, plus a tally of outcomes."""
+    counts = {}
+    for outcome in outcomes.values():
+        counts[outcome] = counts.get(outcome, 0) + 1
+
+    return json_response({
+        'results': [{'id': i, 'result': outcomes[i]} for i in dict.fromkeys(ids)],
+        'counts': counts,
+    })
+
+
+@api.route('/follows', methods=['POST'])
+def follow_many():
+    """Follow many users in one transaction."""
+    user = require_user()
+    ids = requested_body_ids()
+
+    outcomes = Follows.add_many(user.id, ids)
+    db.session.commit()
+
+    return bulk_result(ids, outcomes)
+
+
+@api.route('/follows', methods=['DELETE'])
+def unfollow_many():
+    """Unfollow many users in one transaction."""
+    user = require_user()
+    ids = requested_body_ids()
+
+    outcomes = Follows.remove_many(user.id, ids)
+    db.session.commit()
+
+    return bulk_result(ids, outcomes)
+
+
+@api.route('/likes', methods=['POST'])
+def like_many():
+    """Like many messages in one transaction."""
+    user = require_user()
+    ids = requested_body_ids()
+
+    outcomes = Likes.add_many(user.id, ids)
+    db.session.commit()
+
+    return bulk_result(ids, outcomes)
+
+
+@api.route('/likes', methods=['DELETE'])
+def unlike_many():
+    """Unlike many messages in one transaction."""
+    user = require_user()
+    ids = requested_body_ids()
+
+    outcomes = Likes.remove_many(user.id, ids)
+    db.session.commit()
+
+    return bulk_result(ids, outcomes)
@@ -1,9 +1,26 @@
 import os
-from flask import Flask, render_template, request, flash, redirect, session, g
+from flask import (Flask, Response, abort, render_template, request, flash, redirect,
+                   session, g, stream_with_context)
 from flask_debugtoolbar import DebugToolbarExtension
 from sqlalchemy.exc import IntegrityError
+from werkzeug.contrib.fixers import ProxyFix
 from forms import UserAddForm, LoginForm, MessageForm, UserEditForm
-from models import db, connect_db, User, Message, Likes, bcrypt
+from models import db, connect_db, AccountDeletion, User, Message, Follows, Likes, bcrypt
+from admission import admission
+from api import api
+from graph import graph
+from images import images, InvalidImage
+from jobs import queue
+from like_buffer import like_buffer
+from query_cache import cache
+from throttle import throttle
+import invalidation
+import export
+import live
+import mentions
+import profiles
+import sharding
+import tasks
 
 # Constant to store the key used for the current user ID in the session
 CURR_USER_KEY = "curr_user"
@@ -19,11 +36,90 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+
+# bcrypt cost for password hashes; tests turn it down to 4 (see testing.py)
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+
+# Generate time-ordered (snowflake-style) message ids in-process; see ids.py.
+# Set WARBLER_NODE_ID per worker process when this is on.
+app.config['MESSAGE_SNOWFLAKE_IDS'] = os.environ.get('MESSAGE_SNOWFLAKE_IDS') == '1'
+
+# Where slow side effects run: 'inline', 'thread' or 'database' (see jobs.py)
+app.config['JOB_BACKEND'] = os.environ.get('JOB_BACKEND', 'inline')
+
+# Threads for slow jobs (account deletion) under the inline backend, so they
+# never run inside a request
+app.config['JOB_BACKGROUND_WORKERS'] = int(os.environ.get('JOB_BACKGROUND_WORKERS', 1))
+
+# How new messages reach /stream connections: 'local' or 'postgres' (see live.py)
+app.config['LIVE_RELAY'] = os.environ.get('LIVE_RELAY', 'local')
+
+# Rows per DELETE when removing an account (see tasks.delete_account)
+app.config['ACCOUNT_DELETE_BATCH_SIZE'] = int(os.environ.get('ACCOUNT_DELETE_BATCH_SIZE', 1000))
+
+# How cache invalidations reach other worker processes: 'memory', 'socket'
+# or 'postgres' (see invalidation.py)
+app.config['INVALIDATION_BACKEND'] = os.environ.get('INVALIDATION_BACKEND', 'memory')
+
+# Where cached query results live: 'none', 'memory' or 'redis' (see query_cache.py)
+app.config['QUERY_CACHE_BACKEND'] = os.environ.get('QUERY_CACHE_BACKEND', 'none')
+app.config['QUERY_CACHE_URL'] = os.environ.get('QUERY_CACHE_URL', 'redis://localhost:6379/0')
+
+# Login attempt rate limits: 'memory', 'redis' or 'none' (see throttle.py)
+app.config['LOGIN_THROTTLE_BACKEND'] = os.environ.get('LOGIN_THROTTLE_BACKEND', 'memory')
+app.config['LOGIN_THROTTLE_URL'] = os.environ.get('LOGIN_THROTTLE_URL', 'redis://localhost:6379/0')
+
+# How many reverse proxies in front of the app to trust X-Forwarded-For
+# from, so request.remote_addr (which the login throttle keys on) is the
+# client rather than the proxy. Leave at 0 unless the app is only reachable
+# through them, or clients can set their own address.
+app.config['PROXY_COUNT'] = int(os.environ.get('PROXY_COUNT', 0))
+
+# Per-route-class concurrency limits and load shedding (see admission.py).
+# Slots are freed when the server closes each response, so in-process
+# clients must close theirs too (the test client: buffered=True)
+app.config['ADMISSION_ENABLED'] = os.environ.get('ADMISSION_ENABLED', '1') == '1'
+
+# Where uploaded images are stored, and how many processes resize them (see images.py)
+app.config['MEDIA_ROOT'] = os.environ.get('MEDIA_ROOT', os.path.join(app.root_path, 'media'))
+app.config['IMAGE_WORKERS'] = int(os.environ.get('IMAGE_WORKERS', 2))
+app.config['MAX_CONTENT_LENGTH'] = 11 * 1024 * 1024
+
+# Where account exports run as jobs are written (see export.py)
+app.config['EXPORT_ROOT'] = os.environ.get('EXPORT_ROOT', os.path.join(app.root_path, 'exports'))
+
+# Buffer likes in a local log and apply them in batches (see like_buffer.py)
+app.config['LIKE_WRITE_BEHIND'] = os.environ.get('LIKE_WRITE_BEHIND') == '1'
+app.config['LIKE_BUFFER_DIR'] = os.environ.get('LIKE_BUFFER_DIR',
+                                               os.path.join(app.root_path, 'like_buffer'))
+app.config['LIKE_FLUSH_INTERVAL'] = float(os.environ.get('LIKE_FLUSH_INTERVAL', 0.25))
+
+# Messages older than this many days move to the archive (see archive.py)
+app.config['ARCHIVE_AFTER_DAYS'] = int(os.environ.get('ARCHIVE_AFTER_DAYS', 365))
+
+# Databases to shard messages and likes over, as comma-separated URLs; two
+# or more turn sharding on (see sharding.py)
+shard_urls = [url for url in os.environ.get('SHARD_URLS', '').split(',') if url]
+app.config['SQLALCHEMY_BINDS'] = {f"shard{i}": url for i, url in enumerate(shard_urls)}
+app.config['SHARDS'] = list(app.config['SQLALCHEMY_BINDS'])
 toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
 bcrypt.init_app(app)
+queue.init_app(app)
+live.init_app(app)
+invalidation.init_app(app, db)
+cache.init_app(app)
+images.init_app(app)
+throttle.init_app(app)
+if app.config['PROXY_COUNT']:
+    app.wsgi_app = ProxyFix(app.wsgi_app, num_proxies=app.config['PROXY_COUNT'])
+admission.init_app(app)
+graph.init_app(app)
+like_buffer.init_app(app)
+app.register_blueprint(api)
 db.create_all()
+sharding.router.init_app(app, db)
 ##############################################################################
 # User signup/login/logout
 
@@ -34,8 +130,9 @@ def add_user_to_g():
     This allows the user to be accessed easily in other parts of the app, such as templates.
     """
     if CURR_USER_KEY in session:
-        # Retrieve user from DB using their ID in session
-        user = User.query.get(session[CURR_USER_KEY])
+        # Retrieve user using their ID in session (from the query cache
+        # when it has them)
+        user = cache.get(User, session[CURR_USER_KEY])
 
          # Set the user to 'g.user', or None if not found
         g.user = user if user else None
@@ -119,21 +216,29 @@ def login():
     - Flash a message to the user indicating the login failure.
     """
 
+    # Turn away throttled attempts before any password checking
+    if request.method == 'POST':
+        wait = throttle.check(request.form.get('username'), request.remote_addr)
+        if wait:
+            return throttle.reject(wait)
+
     form = LoginForm()
 
     # Check if the form has been submitted and is valid
     if form.validate_on_submit():
-        # Find user by username
+        # Find user by username; authenticate checks the password too
         user = User.authenticate(form.username.data,
                                  form.password.data)
 
         # Check if user exists and password is correct
-        if user and bcrypt.check_password_hash(user.password, form.password.data):
+        if user:
             # Log the user in by storing their ID in the session
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect(f"/users/{user.id}")
 
+        # Only failures count against the username (see throttle.py)
+        throttle.failed(form.username.data)
         flash("Invalid credentials.", 'danger')
 
     # Render the login form if not valid
@@ -176,15 +281,40 @@ def list_users():
     return render_template('users/index.html', users=users)
 
 
+@app.route('/users/suggestions')
+def users_suggestions():
+    """Show people the current user may know: who the people they follow follow."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    # Suggestions come from the in-memory follow graph (see graph.py)
+    graph.sync()
+    suggestions = graph.suggestions_for(g.user.id)
+
+    users = {user.id: user for user in
+             User.query.filter(User.id.in_([user_id for user_id, _ in suggestions]))}
+    suggested = [(users[user_id], mutual) for user_id, mutual in suggestions
+                 if user_id in users]
+
+    return render_template('users/suggestions.html', suggested=suggested)
+
+
+def load_profile_or_404(user_id, with_pages=True):
+    """The profile page read model for ``user_id``, as the current user sees it."""
+    profile = profiles.load(user_id, g.user.id if g.user else None, with_pages=with_pages)
+    if profile is None:
+        abort(404)
+    return profile
+
+
 @app.route('/users/<int:user_id>')
 def users_show(user_id):
     """Show user profile page for a specific user identified by user_id."""
-    # Retrieve user by their ID or return 404 if not found
-    user = User.query.get_or_404(user_id)
-
-    # Get the messages that the user has liked
-    liked_messages = user.likes
-    return render_template('users/show.html', user=user, liked_messages=liked_messages)
+    # Everything the page shows, in two queries (see profiles.py)
+    profile = load_profile_or_404(user_id)
+    return render_template('users/show.html', user=profile)
 
 
 @app.route('/users/<int:user_id>/following')
@@ -196,9 +326,15 @@ def show_following(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
+    # The header needs only the user and counts, not their messages
+    profile = load_profile_or_404(user_id, with_pages=False)
+    following = cache.all(
+        User.query.join(Follows, Follows.user_being_followed_id == User.id)
+        .filter(Follows.user_following_id == user_id),
+        tags=[f"follows:following:{user_id}"])
+
     # Render following page for the user
-    return render_template('users/following.html', user=user)
+    return render_template('users/following.html', user=profile, following=following)
 
 
 @app.route('/users/<int:user_id>/followers')
@@ -210,8 +346,12 @@ def users_followers(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    profile = load_profile_or_404(user_id, with_pages=False)
+    followers = cache.all(
+        User.query.join(Follows, Follows.user_following_id == User.id)
+        .filter(Follows.user_being_followed_id == user_id),
+        tags=[f"follows:followers:{user_id}"])
+    return render_template('users/followers.html', user=profile, followers=followers)
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
@@ -224,9 +364,9 @@ def add_follow(follow_id):
 
     followed_user = User.query.get_or_404(follow_id)
 
-    # Add the followed user to the logged-in user's following lis
-    g.user.following.append(followed_user)
-    # Commit the change to the database
+    # Add the followed user to the logged-in user's following list, so the
+    # page we redirect to already shows it
+    g.user.follow(followed_user)
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
@@ -241,10 +381,10 @@ def stop_following(follow_id):
         return redirect("/")
 
     # Retrieve the user to stop following
-    followed_user = User.query.get(follow_id)
+    followed_user = User.query.get_or_404(follow_id)
 
     # Remove the followed user from the logged-in user's following list
-    g.user.following.remove(followed_user)
+    g.user.unfollow(followed_user)
 
     # Commit the change to the database
     db.session.commit()
@@ -272,6 +412,18 @@ def profile():
             g.user.header_image_url = form.header_image_url.data
             g.user.bio = form.bio.data
 
+            # Uploaded images are stored locally and resized in the
+            # background; their URLs replace any typed in
+            try:
+                if form.image_file.data:
+                    g.user.image_url = images.save_avatar(form.image_file.data.read())
+                if form.header_file.data:
+                    g.user.header_image_url = images.save_header(form.header_file.data.read())
+            except InvalidImage as err:
+                db.session.rollback()
+                flash(str(err), "danger")
+                return render_template("users/edit.html", form=form, user_id=g.user.id)
+
             # Commit changes to the database
             db.session.commit()
 
@@ -283,6 +435,25 @@ def profile():
         
     return render_template("users/edit.html", form=form, user_id=g.user.id)
 
+@app.route('/users/export')
+def users_export():
+    """Download all of the current user's data as a zip of NDJSON files.
+
+    The zip is streamed as it's built, so it starts downloading at once and
+    never sits in memory (see export.py).
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    user_id = g.user.id
+    return Response(stream_with_context(export.generate_zip(user_id)),
+                    mimetype='application/zip',
+                    headers={'Content-Disposition':
+                             f'attachment; filename="{export.export_filename(user_id)}"'})
+
+
 @app.route('/users/delete', methods=["POST"])
 def delete_user():
     """Delete the currently logged-in user's account."""
@@ -291,14 +462,21 @@ def delete_user():
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
+    user_id = g.user.id
+
     # Log the user out after account deletion
     do_logout()
 
-    # Delete the user's record from the database
-    db.session.delete(g.user)
-    # Commit the change to the database
+    # Record the request first: it locks the account out straight away
+    AccountDeletion.request(user_id)
     db.session.commit()
 
+    # Deleting an account can touch a lot of rows, so it's handed to the job
+    # queue and done in small batches, off the request thread even with the
+    # inline backend; the key stops a double-submitted form queueing it twice
+    queue.enqueue('delete_account', user_id=user_id,
+                  idempotency_key=f"delete-account:{user_id}")
+
     # Redirect to the signup page after account deletion
     return redirect("/signup")
 
@@ -311,33 +489,53 @@ def liked_messages(user_id):
     # Retrieve user by their ID or return 404 if not found
     user = User.query.get_or_404(user_id)
 
-    # Get the user's liked messages
-    liked_messages = user.likes
+    # Get the user's liked messages, with their likes and unlikes not yet
+    # written (see like_buffer.py)
+    newly_liked, unliked = profiles.pending_like_changes(user)
+    liked_messages = newly_liked + [msg for msg in user.likes if msg.id not in unliked]
     return render_template('users/liked_messages.html', user=user, liked_messages=liked_messages)
 
 @app.route('/messages/<int:message_id>/like', methods=["POST"])
 def like_message(message_id):
-    """Allow the logged-in user to like or unlike a message."""
+    """Allow the logged-in user to like or unlike a message.
+
+    The form posts the state it wants (liked=1 or liked=0), so a resubmit,
+    or a page rendered before a buffered like was written, can't flip it
+    the wrong way. Without one it toggles.
+    """
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    # Check if the user has already liked the message
-    like = Likes.query.filter_by(user_id=g.user.id, message_id=message_id).first()
+    wanted = request.form.get('liked')
+    if wanted is None:
+        liked = not g.user.has_liked(message_id)
+    else:
+        liked = wanted == '1'
 
-    if like:
-        # If already liked, remove the like from the database
-        db.session.delete(like)
-        flash("You unliked this message.", "success")
+    if like_buffer.enabled:
+        # Buffered and written in a batch shortly, without locking the likes
+        like_buffer.record(g.user.id, message_id, liked)
     else:
-        new_like = Likes(user_id=g.user.id, message_id=message_id)
+        # Check if the user has already liked the message
+        like = Likes.query.filter_by(user_id=g.user.id, message_id=message_id).first()
+
+        if like and not liked:
+            # Remove the like from the database
+            db.session.delete(like)
+        elif liked and not like:
+            new_like = Likes(user_id=g.user.id, message_id=message_id)
 
-        # Add the new like to the session
-        db.session.add(new_like)
+            # Add the new like to the session
+            db.session.add(new_like)
+
+        # Commit changes to the database
+        db.session.commit()
+
+    if liked:
         flash("You liked this message!", "success")
-    
-    # Commit changes to the database
-    db.session.commit()
+    else:
+        flash("You unliked this message.", "success")
     return redirect("/")
 
 @app.route('/messages/new', methods=["GET", "POST"])
@@ -351,14 +549,21 @@ def messages_add():
 
     # Check if the form is valid
     if form.validate_on_submit():
-        # Create a new message instance
-        msg = Message(text=form.text.data)
+        # Insert the new message for the logged-in user (without loading
+        # the messages they've already posted)
+        msg = g.user.post_message(form.text.data)
 
-        # Associate the new message with the logged-in user
-        g.user.messages.append(msg)
+        # Record its @mentions and #hashtags for their feeds; the flush
+        # fills in the id and timestamp they're indexed by
+        db.session.flush()
+        mentions.index_messages([msg])
 
         # Commit the new message to the database
         db.session.commit()
+
+        # Push it to followers watching their live timeline
+        live.publish_message(msg)
+
         flash("Message posted!", "success")
         return redirect(f"/users/{g.user.id}")  # <-- Redirect (302)
 
@@ -367,11 +572,14 @@ def messages_add():
 @app.route('/messages/<int:message_id>', methods=["GET"])
 def messages_show(message_id):
     """Show a specific message by its ID."""
-    # Retrieve the message by its ID
-    msg = Message.query.get(message_id)
+    # Retrieve the message by its ID or return 404 if not found
+    msg = cache.get_or_404(Message, message_id)
+
+    # Whether the user likes it, counting likes not yet written
+    liked = g.user.has_liked(msg.id) if g.user else False
 
     # Render the message details page
-    return render_template('messages/show.html', message=msg)
+    return render_template('messages/show.html', message=msg, liked=liked)
 
 @app.route('/messages/<int:message_id>/delete', methods=["POST"])
 def messages_destroy(message_id):
@@ -388,8 +596,9 @@ def messages_destroy(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/"), 403
 
-    # Delete the message from the database
+    # Delete the message from the database, and from the mention/tag feeds
     db.session.delete(msg)
+    mentions.unindex_messages([msg.id])
 
     # Commit the deletion to the database
     db.session.commit()
@@ -397,6 +606,53 @@ def messages_destroy(message_id):
     return redirect(f"/users/{g.user.id}")
 
 
+@app.route('/tags/<tag>')
+def tag_feed(tag):
+    """Messages using a #hashtag, newest first."""
+
+    before = mentions.decode_cursor(request.args.get('before'))
+    messages, next_cursor = mentions.tag_page(tag, before)
+    return render_template('messages/feed.html', title=f"#{tag.lower()}",
+                           messages=messages, next_cursor=next_cursor)
+
+
+@app.route('/mentions')
+def mentions_feed():
+    """Messages mentioning the current user, newest first."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    before = mentions.decode_cursor(request.args.get('before'))
+    messages, next_cursor = mentions.mentions_page(g.user.id, before)
+    return render_template('messages/feed.html', title=f"Mentions of @{g.user.username}",
+                           messages=messages, next_cursor=next_cursor)
+
+
+@app.route('/stream')
+def stream():
+    """Server-Sent Events stream of new messages for the homepage timeline.
+
+    Browsers reconnect with a Last-Event-ID header and get what they missed.
+    EventSource can't set that header on its first connection, so the page
+    passes the newest message it rendered as ``?last_id=`` instead.
+    """
+    if not g.user:
+        return Response(status=401)
+
+    last_event_id = request.headers.get('Last-Event-ID', type=int)
+    if last_event_id is None:
+        last_event_id = request.args.get('last_id', type=int)
+
+    return Response(
+        stream_with_context(live.event_stream(g.user.id, last_event_id)),
+        mimetype='text/event-stream',
+        # Stop proxies (e.g. nginx) from buffering the stream
+        headers={'X-Accel-Buffering': 'no'},
+    )
+
+
 ##############################################################################
 # Homepage and error pages
 
@@ -409,19 +665,27 @@ def homepage():
     - logged in: 100 most recent messages of followed_users
     """
     if g.user:
-        # Get list of followed user IDs, including self
-        following_ids = [u.id for u in g.user.following] + [g.user.id]
-
-        # Fetch the 100 most recent messages from users the logged-in user follows
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(following_ids))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
+        # Followed user IDs as a subquery, so they're never loaded as objects
+        following_ids = (db.session
+                         .query(Follows.user_being_followed_id)
+                         .filter(Follows.user_following_id == g.user.id))
+
+        # Fetch the 100 most recent messages from the user and users they follow
+        if sharding.router.enabled:
+            # Authors are spread over the shards: ask each in parallel, merge
+            author_ids = [user_id for (user_id,) in following_ids] + [g.user.id]
+            messages = sharding.timeline(Message, author_ids, 100, Message.newest_first())
+        else:
+            messages = (Message
+                        .query
+                        .filter(db.or_(Message.user_id == g.user.id,
+                                       Message.user_id.in_(following_ids)))
+                        .order_by(*Message.newest_first())
+                        .limit(100)
+                        .all())
 
-        # Get the list of message likes by the user
-        likes = [like.id for like in g.user.likes]
+        # Which of the messages on this page the user has liked
+        likes = g.user.liked_ids_among([msg.id for msg in messages])
 
         # Render the homepage with messages and likes
         return render_template('home.html', messages=messages, likes=likes)
@@ -442,6 +706,10 @@ def homepage():
 def add_header(req):
     """Add non-caching headers on every request."""
 
+    # Content-addressed files (see images.py) are cacheable forever
+    if 'immutable' in req.headers.get('Cache-Control', ''):
+        return req
+
     req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
     req.headers["Pragma"] = "no-cache"
     req.headers["Expires"] = "0"
@@ -0,0 +1,200 @@
+"""Hot/cold storage for messages.
+
+Timelines and profiles almost always read recent messages, so messages older
+than ARCHIVE_AFTER_DAYS are moved out of the ``messages`` table into
+compressed chunks in ``message_archive`` (one chunk per author per archiving
+batch). That keeps the hot table, and the depth of its indexes, proportional
+to recent traffic rather than to all of history.
+
+Pages that start from the top (the homepage, profiles) only ever read the
+hot table. Cursor-paginated reads (the JSON API) fall through to
+``older_messages`` once a cursor reaches past the newest archived message,
+so paging still runs back through everything.
+
+Archived messages are read-only: they keep who liked them, but can't be
+liked, unliked or deleted one at a time. Archive with:
+
+    python archive.py run
+
+or by enqueueing the ``archive_messages`` job (e.g. from cron).
+"""
+
+import argparse
+import json
+import zlib
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from flask import current_app
+
+from invalidation import mark, row_tags
+from mentions import unindex_messages
+from models import db, ArchivedMessages, Likes, Message
+from sharding import router
+
+DEFAULT_HORIZON_DAYS = 365
+
+# Messages moved per transaction
+BATCH_SIZE = 5000
+
+COMPRESSION_LEVEL = 6
+
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def horizon(now=None):
+    """Messages older than this belong in the archive."""
+    days = current_app.config.get('ARCHIVE_AFTER_DAYS', DEFAULT_HORIZON_DAYS)
+    return (now or datetime.utcnow()) - timedelta(days=days)
+
+
+def sort_key(msg):
+    """Timeline order: (timestamp, id)."""
+    return (msg['timestamp'], msg['id'])
+
+
+def pack(messages, likers):
+    """Compress messages (newest first) and who liked them into a chunk's data."""
+    return zlib.compress(json.dumps([
+        {'id': msg.id, 'text': msg.text, 'user_id': msg.user_id,
+         'timestamp': msg.timestamp.strftime(TIME_FORMAT),
+         'liked_by': likers.get(msg.id, [])}
+        for msg in messages
+    ]).encode(), COMPRESSION_LEVEL)
+
+
+def unpack(data):
+    """The messages in a chunk's data, as dicts, newest first."""
+    messages = json.loads(zlib.decompress(data).decode())
+    for msg in messages:
+        msg['timestamp'] = datetime.strptime(msg['timestamp'], TIME_FORMAT)
+    return messages
+
+
+def archive_batch(before, batch_size=BATCH_SIZE):
+    """Move up to ``batch_size`` messages older than ``before`` into the archive.
+
+    The chunks are written and the hot rows (and their likes) deleted in one
+    transaction. Returns the number of messages moved.
+    """
+    old = (Message.query
+           .filter(Message.timestamp < before)
+           .order_by(Message.timestamp, Message.id)
+           .limit(batch_size)
+           .all())
+    if not old:
+        return 0
+
+    ids = [msg.id for msg in old]
+    likers = defaultdict(list)
+    for message_id, user_id in (db.session.query(Likes.message_id, Likes.user_id)
+                                .filter(Likes.message_id.in_(ids))):
+        likers[message_id].append(user_id)
+
+    by_author = defaultdict(list)
+    for msg in old:
+        by_author[msg.user_id].append(msg)
+
+    for user_id, messages in by_author.items():
+        messages.sort(key=lambda msg: (msg.timestamp, msg.id), reverse=True)
+        db.session.add(ArchivedMessages(
+            user_id=user_id,
+            oldest_timestamp=messages[-1].timestamp, oldest_id=messages[-1].id,
+            newest_timestamp=messages[0].timestamp, newest_id=messages[0].id,
+            message_count=len(messages),
+            data=pack(messages, likers),
+        ))
+
+    # Bulk deletes: tag them so caches of these messages are dropped
+    for msg in old:
+        mark(db.session, *row_tags('messages', {'id': msg.id, 'user_id': msg.user_id}))
+    for message_id in likers:
+        mark(db.session, f"likes:message:{message_id}")
+
+    unindex_messages(ids)
+    Likes.query.filter(Likes.message_id.in_(ids)).delete(synchronize_session=False)
+    Message.query.filter(Message.id.in_(ids)).delete(synchronize_session=False)
+    db.session.commit()
+
+    return len(old)
+
+
+def archive_old_messages(before=None, batch_size=BATCH_SIZE):
+    """Archive everything older than ``before`` (default: the horizon)."""
+    before = before or horizon()
+    total = 0
+    while True:
+        moved = archive_batch(before, batch_size)
+        total += moved
+        if moved < batch_size:
+            return total
+
+
+def older_messages(author_ids, before, limit):
+    """Up to ``limit`` archived messages by ``author_ids``, newest first.
+
+    ``before`` is a (timestamp, id) to start strictly below, or None for the
+    newest archived messages. Chunks are read newest first and decompressed
+    only until no later chunk could contain anything newer than what's
+    already been found.
+    """
+    if router.enabled:
+        groups = router.group_by_shard(set(author_ids), router.shard_for_user)
+    else:
+        groups = {None: list(author_ids)}
+
+    found = []
+    for shard, ids in groups.items():
+        found.extend(_older_on_shard(shard, ids, before, limit))
+
+    found.sort(key=sort_key, reverse=True)
+    return found[:limit]
+
+
+def _older_on_shard(shard, author_ids, before, limit):
+    query = ArchivedMessages.query.filter(ArchivedMessages.user_id.in_(author_ids))
+    if before is not None:
+        query = query.filter(db.tuple_(ArchivedMessages.oldest_timestamp,
+                                       ArchivedMessages.oldest_id) < db.tuple_(*before))
+    query = query.order_by(ArchivedMessages.newest_timestamp.desc(),
+                           ArchivedMessages.newest_id.desc())
+    if shard is not None:
+        query = query.set_shard(shard)
+
+    found = []
+    for chunk in query.yield_per(20):
+        if len(found) >= limit and (chunk.newest_timestamp, chunk.newest_id) < sort_key(found[limit - 1]):
+            break
+        found.extend(msg for msg in unpack(chunk.data)
+                     if before is None or sort_key(msg) < tuple(before))
+        found.sort(key=sort_key, reverse=True)
+    return found[:limit]
+
+
+def archived_count(user_id):
+    """How many of ``user_id``'s messages are in the archive."""
+    query = (db.session.query(db.func.coalesce(db.func.sum(ArchivedMessages.message_count), 0))
+             .filter(ArchivedMessages.user_id == user_id))
+    if router.enabled:
+        query = query.set_shard(router.shard_for_user(user_id))
+    return query.scalar()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Archive old Warbler messages.")
+    parser.add_argument('command', choices=['run'])
+    parser.add_argument('--days', type=int, help="archive messages older than this")
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    args = parser.parse_args(argv)
+
+    from app import app
+
+    with app.app_context():
+        if args.days is not None:
+            app.config['ARCHIVE_AFTER_DAYS'] = args.days
+        moved = archive_old_messages(batch_size=args.batch_size)
+        print(f"Archived {moved} messages older than {horizon():%Y-%m-%d}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,7 @@
+"""Benchmarks for Warbler.
+
+These drive the real app against a synthetic dataset and write JSON results
+that can be diffed between commits. They need a scratch database; never point
+them at one holding real data, since seeding drops every table. They refuse
+to seed a database without "bench" in its name (see harness.SCRATCH_DATABASE_MARKER).
+"""
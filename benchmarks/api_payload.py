@@ -0,0 +1,90 @@
+"""Compare payload size and serialization time of the JSON API and HTML pages.
+
+For each pair of equivalent pages (e.g. the homepage and /api/v1/timeline)
+this requests both for a sample of seeded users and reports bytes per
+response, latency percentiles and queries per request.
+
+Run it from the repository root like:
+    python -m benchmarks.api_payload
+    python -m benchmarks.api_payload --no-seed --samples 500
+"""
+
+import argparse
+import random
+import time
+
+from benchmarks.harness import (DEFAULT_DATABASE_URL, QUERY_COUNT_HEADER,
+                                Result, git_commit, load_app, print_summary,
+                                save_results, seed_dataset, summarize)
+
+# (name, HTML path, JSON path); {user} and {message} are filled in per request
+PAIRS = [
+    ('timeline', '/', '/api/v1/timeline?limit=100'),
+    ('profile', '/users/{user}', '/api/v1/users/{user}'),
+    ('followers', '/users/{user}/followers', '/api/v1/users/{user}/followers?limit=100'),
+    ('message', '/messages/{message}', '/api/v1/messages/{message}'),
+]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare JSON API and HTML payloads.")
+    parser.add_argument('--database-url', default=DEFAULT_DATABASE_URL)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--messages', type=int, default=50000)
+    parser.add_argument('--follows', type=int, default=40000)
+    parser.add_argument('--no-seed', action='store_true')
+    parser.add_argument('--samples', type=int, default=200)
+    parser.add_argument('--out', default=None)
+    args = parser.parse_args(argv)
+
+    app = load_app(args.database_url)
+    from app import CURR_USER_KEY
+    from models import Message, User, db
+
+    if not args.no_seed:
+        seed_dataset(app, args.users, args.messages, args.follows)
+
+    with app.app_context():
+        user_ids = [user_id for (user_id,) in db.session.query(User.id)]
+        max_message = db.session.query(db.func.max(Message.id)).scalar() or 1
+
+    rng = random.Random(0)
+    client = app.test_client()
+    results = []
+    sizes = {}
+
+    for _ in range(args.samples):
+        user_id = rng.choice(user_ids)
+        message_id = rng.randint(1, max_message)
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+        for name, html_path, json_path in PAIRS:
+            for kind, path in (('html', html_path), ('json', json_path)):
+                url = path.format(user=user_id, message=message_id)
+                started = time.perf_counter()
+                # Buffered, so each response is closed and frees its admission slot
+                resp = client.get(url, buffered=True)
+                elapsed = time.perf_counter() - started
+
+                key = f"{name}_{kind}"
+                results.append(Result(key, resp.status_code, elapsed,
+                                      int(resp.headers.get(QUERY_COUNT_HEADER, 0))))
+                # Error pages (a missing message, say) aren't payloads
+                if resp.status_code == 200:
+                    sizes.setdefault(key, []).append(len(resp.data))
+
+    summary = summarize(results, sum(r.seconds for r in results))
+    for key, values in sizes.items():
+        summary[key]['mean_bytes'] = round(sum(values) / len(values))
+    print_summary(summary)
+    for key in sorted(sizes):
+        print(f"{key:<16}{summary[key]['mean_bytes']:>10} bytes")
+
+    out = args.out or f"bench/results/api_payload-{git_commit() or 'unknown'}.json"
+    save_results(out, 'api_payload', {'samples': args.samples}, summary)
+    print(f"Results written to {out}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""Diff two benchmark result files.
+
+Run it like:
+    python -m benchmarks.compare bench/results/routes-abc123.json bench/results/routes-def456.json
+
+Prints the change in throughput, latency percentiles and queries per request
+for every scenario present in both files. Exits non-zero if any p95 latency
+regressed by more than ``--threshold`` percent.
+"""
+
+import argparse
+import json
+import sys
+
+METRICS = ['throughput_rps', 'p50_ms', 'p95_ms', 'p99_ms', 'queries_per_request']
+
+
+def pct_change(old, new):
+    if not old:
+        return 0.0
+    return (new - old) / old * 100
+
+
+def compare(old, new, threshold):
+    """Print a table of changes and return the list of regressed scenarios."""
+    regressions = []
+    print(f"{old['commit']} -> {new['commit']}")
+
+    for name in sorted(set(old['results']) & set(new['results'])):
+        before, after = old['results'][name], new['results'][name]
+        changes = ", ".join(
+            f"{metric} {before[metric]} -> {after[metric]} "
+            f"({pct_change(before[metric], after[metric]):+.1f}%)"
+            for metric in METRICS)
+        print(f"{name}: {changes}")
+
+        if pct_change(before['p95_ms'], after['p95_ms']) > threshold:
+            regressions.append(name)
+
+    print(f"peak_memory_mb {old['peak_memory_mb']} -> {new['peak_memory_mb']}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare benchmark results.")
+    parser.add_argument('old')
+    parser.add_argument('new')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help="p95 regression (percent) that counts as a failure")
+    args = parser.parse_args(argv)
+
+    with open(args.old) as old_file, open(args.new) as new_file:
+        regressions = compare(json.load(old_file), json.load(new_file), args.threshold)
+
+    if regressions:
+        print(f"p95 regressed: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
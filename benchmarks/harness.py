@@ -0,0 +1,343 @@
+"""Shared machinery for the benchmark scripts.
+
+Provides dataset seeding, two ways of driving the app (the Flask test client
+or a local threaded WSGI server), a concurrent weighted-scenario runner,
+latency/query/memory statistics and JSON result files.
+"""
+
+import http.cookiejar
+import itertools
+import json
+import os
+import random
+import resource
+import subprocess
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import defaultdict, namedtuple
+
+DEFAULT_DATABASE_URL = 'postgresql:///warbler-bench'
+
+# Seeding drops every table, so it's refused unless the database's name
+# marks it as a benchmark scratch database (like the default above)
+SCRATCH_DATABASE_MARKER = 'bench'
+
+# Plaintext password given to every seeded user so login scenarios work
+BENCH_PASSWORD = 'benchpass'
+
+# Response header the app adds in benchmark mode with the request's query count
+QUERY_COUNT_HEADER = 'X-Bench-Queries'
+
+Scenario = namedtuple('Scenario', ['name', 'weight', 'run'])
+
+Result = namedtuple('Result', ['scenario', 'status', 'seconds', 'queries'])
+
+
+def load_app(database_url=DEFAULT_DATABASE_URL):
+    """Import the app pointed at ``database_url`` and configure it for benchmarking.
+
+    The environment has to be set before the first import of ``app``, since
+    the app reads DATABASE_URL at import time.
+    """
+    os.environ['DATABASE_URL'] = database_url
+
+    from app import app
+    if app.config['SQLALCHEMY_DATABASE_URI'] != database_url:
+        raise RuntimeError(f"app was already imported with "
+                           f"{app.config['SQLALCHEMY_DATABASE_URI']}, not {database_url}")
+    app.config['WTF_CSRF_ENABLED'] = False
+    app.config['DEBUG_TB_ENABLED'] = False
+    install_query_counter(app)
+    return app
+
+
+def install_query_counter(app):
+    """Count SQL statements per request and report them in a response header."""
+    from flask import g, has_request_context
+    from sqlalchemy import event
+    from models import db
+    from sharding import router
+
+    if app.config.get('BENCH_QUERY_COUNTER'):
+        return
+    app.config['BENCH_QUERY_COUNTER'] = True
+
+    def count_query(conn, cursor, statement, parameters, context, executemany):
+        if has_request_context():
+            g.bench_queries = g.get('bench_queries', 0) + 1
+
+    # Message and like queries go to the shards when SHARD_URLS is set
+    with app.app_context():
+        engines = [db.engine] + [router.engine(shard) for shard in router.shards]
+    for engine in engines:
+        event.listen(engine, 'before_cursor_execute', count_query)
+
+    @app.after_request
+    def add_query_count(response):
+        response.headers[QUERY_COUNT_HEADER] = str(g.get('bench_queries', 0))
+        return response
+
+
+def ensure_scratch_database(app):
+    """Exit unless ``app`` uses a benchmark database, which may be wiped.
+
+    Its name has to contain SCRATCH_DATABASE_MARKER ("warbler-bench", say).
+    """
+    from sqlalchemy.engine.url import make_url
+
+    url = app.config['SQLALCHEMY_DATABASE_URI']
+    if SCRATCH_DATABASE_MARKER not in (make_url(url).database or ''):
+        raise SystemExit(f"Refusing to drop the tables of {url}: benchmarks only "
+                         f"seed a database with {SCRATCH_DATABASE_MARKER!r} in its name")
+
+
+def seed_dataset(app, num_users, num_messages, num_follows, seed=0, log_rounds=4):
+    """Generate and bulk-load a synthetic dataset, then set a known password.
+
+    Drops every table first, so only runs against a benchmark database (see
+    ensure_scratch_database). Returns a list of (id, username) for every
+    seeded user.
+    """
+    ensure_scratch_database(app)
+
+    from bulk_load import load_all
+    from generator.create_csvs import generate
+    from models import User, bcrypt, db
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        generate(data_dir, num_users, num_messages, num_follows, seed=seed)
+
+        with app.app_context():
+            load_all(data_dir, chunk_size=50000, out=open(os.devnull, 'w'))
+
+    with app.app_context():
+        # One cheap hash shared by everyone keeps seeding fast while still
+        # exercising a real bcrypt check on login
+        password = bcrypt.generate_password_hash(
+            BENCH_PASSWORD, log_rounds).decode('UTF-8')
+        db.session.query(User).update({User.password: password},
+                                      synchronize_session=False)
+        db.session.commit()
+
+        return [tuple(row) for row in db.session.query(User.id, User.username)]
+
+
+##############################################################################
+# Drivers: how a worker talks to the app
+
+
+def client_address(number):
+    """A distinct IP address for simulated client ``number``.
+
+    Without one each, every client shares the per-IP login throttle bucket.
+    """
+    return f"10.{number // 62500 % 256}.{number // 250 % 250}.{number % 250 + 1}"
+
+
+class TestClientDriver:
+    """Drive the app in-process through Flask's test client."""
+
+    def __init__(self, app):
+        self.app = app
+        self.sessions = itertools.count()
+
+    def session(self):
+        return _TestClientSession(self.app.test_client(), client_address(next(self.sessions)))
+
+    def close(self):
+        pass
+
+
+class _TestClientSession:
+    def __init__(self, client, address):
+        self.client = client
+        self.environ = {'REMOTE_ADDR': address}
+
+    def login_as(self, user_id, username=None):
+        from app import CURR_USER_KEY
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def request(self, method, path, data=None):
+        # Buffered, so the response is closed (freeing its admission slot)
+        # before it's returned, as a real server would
+        resp = self.client.open(path, method=method, data=data, buffered=True,
+                                environ_base=self.environ)
+        return resp.status_code, int(resp.headers.get(QUERY_COUNT_HEADER, 0))
+
+
+class ServerDriver:
+    """Drive the app over HTTP through a local threaded WSGI server."""
+
+    def __init__(self, app, host='127.0.0.1', port=0):
+        from werkzeug.contrib.fixers import ProxyFix
+        from werkzeug.serving import make_server
+
+        # Every session connects from localhost; the address it claims in
+        # X-Forwarded-For stands in for its own
+        self.server = make_server(host, port, ProxyFix(app, num_proxies=1), threaded=True)
+        self.base_url = f"http://{host}:{self.server.server_port}"
+        self.sessions = itertools.count()
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def session(self):
+        return _HTTPSession(self.base_url, client_address(next(self.sessions)))
+
+    def close(self):
+        self.server.shutdown()
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class _HTTPSession:
+    def __init__(self, base_url, address):
+        self.base_url = base_url
+        self.address = address
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()),
+            _NoRedirect())
+
+    def login_as(self, user_id, username=None):
+        # Over HTTP the only way in is the real login form
+        self.request('POST', '/login', {'username': username, 'password': BENCH_PASSWORD})
+
+    def request(self, method, path, data=None):
+        body = urllib.parse.urlencode(data).encode() if data is not None else None
+        req = urllib.request.Request(self.base_url + path, data=body, method=method,
+                                     headers={'X-Forwarded-For': self.address})
+        try:
+            with self.opener.open(req) as resp:
+                resp.read()
+                return resp.status, int(resp.headers.get(QUERY_COUNT_HEADER, 0))
+        except urllib.error.HTTPError as err:
+            err.read()
+            return err.code, int(err.headers.get(QUERY_COUNT_HEADER, 0))
+
+
+##############################################################################
+# Running scenarios
+
+
+def run_scenarios(driver, scenarios, users, workers=8, total_requests=2000, seed=0):
+    """Run ``total_requests`` weighted-random scenarios across ``workers`` threads.
+
+    Each worker logs in as a random seeded user and then repeatedly picks a
+    scenario by weight. ``scenario.run(session, rng, users)`` performs the
+    request(s) and returns (status, queries).
+    """
+    results = []
+    results_lock = threading.Lock()
+    remaining = [total_requests]
+    weights = [s.weight for s in scenarios]
+
+    def worker(worker_id):
+        rng = random.Random(f"{seed}:{worker_id}")
+        session = driver.session()
+        user_id, username = rng.choice(users)
+        session.login_as(user_id, username)
+        local = []
+
+        while True:
+            with results_lock:
+                if remaining[0] <= 0:
+                    break
+                remaining[0] -= 1
+
+            scenario = rng.choices(scenarios, weights)[0]
+            started = time.perf_counter()
+            status, queries = scenario.run(session, rng, users)
+            local.append(Result(scenario.name, status, time.perf_counter() - started, queries))
+
+        with results_lock:
+            results.extend(local)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(workers)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return results, time.perf_counter() - started
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already-sorted list."""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(pct / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def summarize(results, elapsed):
+    """Turn raw results into per-scenario and overall statistics."""
+    by_scenario = defaultdict(list)
+    for result in results:
+        by_scenario[result.scenario].append(result)
+    by_scenario['ALL'] = results
+
+    summary = {}
+    for name, rows in sorted(by_scenario.items()):
+        latencies = sorted(r.seconds * 1000 for r in rows)
+        summary[name] = {
+            'requests': len(rows),
+            'errors': sum(1 for r in rows if r.status >= 500),
+            'throttled': sum(1 for r in rows if r.status == 429),
+            'throughput_rps': round(len(rows) / elapsed, 2) if elapsed else 0.0,
+            'p50_ms': round(percentile(latencies, 50), 3),
+            'p95_ms': round(percentile(latencies, 95), 3),
+            'p99_ms': round(percentile(latencies, 99), 3),
+            'queries_per_request': round(sum(r.queries for r in rows) / len(rows), 2),
+        }
+
+    return summary
+
+
+def peak_memory_mb():
+    """Peak resident set size of this process, in MB."""
+    # ru_maxrss is KB on Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_results(path, name, params, summary):
+    """Write a benchmark result file and return its contents."""
+    data = {
+        'benchmark': name,
+        'commit': git_commit(),
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'params': params,
+        'peak_memory_mb': peak_memory_mb(),
+        'results': summary,
+    }
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as out:
+        json.dump(data, out, indent=2, sort_keys=True)
+
+    return data
+
+
+def print_summary(summary):
+    print(f"{'scenario':<16}{'reqs':>7}{'rps':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'q/req':>7}"
+          f"{'5xx':>6}{'429':>6}")
+    for name, row in summary.items():
+        print(f"{name:<16}{row['requests']:>7}{row['throughput_rps']:>9.1f}"
+              f"{row['p50_ms']:>9.2f}{row['p95_ms']:>9.2f}{row['p99_ms']:>9.2f}"
+              f"{row['queries_per_request']:>7.1f}{row['errors']:>6}{row['throttled']:>6}")
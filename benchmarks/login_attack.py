@@ -0,0 +1,134 @@
+"""Measure normal traffic latency while /login is under a credential-stuffing attack.
+
+Legitimate clients browse and occasionally log in, each from their own IP,
+while attacker threads post wrong passwords for random usernames from a
+handful of IPs as fast as they can. The run is done three times: with no
+attack, under attack without throttling, and under attack with the login
+throttle (see throttle.py) on. Passwords are hashed with real bcrypt cost so
+the attack costs what it would in production. Legitimate logins turned away
+because attackers used up their username's failed attempts show up in the
+``throttled`` (429) column.
+
+Run it from the repository root like:
+    python -m benchmarks.login_attack
+    python -m benchmarks.login_attack --attackers 16 --requests 1000 --log-rounds 12
+"""
+
+import argparse
+import random
+import threading
+import time
+
+from benchmarks.harness import (DEFAULT_DATABASE_URL, BENCH_PASSWORD, Result,
+                                client_address, git_commit, load_app, print_summary,
+                                save_results, seed_dataset, summarize)
+
+
+def legit_worker(app, users, worker_id, count, results, seed):
+    from app import CURR_USER_KEY
+
+    rng = random.Random(f"{seed}:legit:{worker_id}")
+    client = app.test_client()
+    environ = {'REMOTE_ADDR': client_address(worker_id)}
+    user_id, username = rng.choice(users)
+    with client.session_transaction() as sess:
+        sess[CURR_USER_KEY] = user_id
+
+    for _ in range(count):
+        roll = rng.random()
+        if roll < 0.05:
+            name, method, path = 'login', 'POST', '/login'
+            data = {'username': username, 'password': BENCH_PASSWORD}
+        elif roll < 0.6:
+            name, method, path, data = 'homepage', 'GET', '/', None
+        else:
+            name, method, path, data = 'users_show', 'GET', f"/users/{rng.choice(users)[0]}", None
+
+        started = time.perf_counter()
+        # Buffered, so each response is closed and frees its admission slot
+        resp = client.open(path, method=method, data=data, environ_base=environ,
+                           buffered=True)
+        results.append(Result(name, resp.status_code, time.perf_counter() - started, 0))
+
+
+def attack_worker(app, users, worker_id, stop, counts, seed):
+    rng = random.Random(f"{seed}:attack:{worker_id}")
+    client = app.test_client()
+    environ = {'REMOTE_ADDR': f"203.0.113.{worker_id % 8 + 1}"}
+
+    while not stop.is_set():
+        _, username = rng.choice(users)
+        resp = client.post('/login', data={'username': username, 'password': 'guess'},
+                           environ_base=environ, buffered=True)
+        counts[resp.status_code] = counts.get(resp.status_code, 0) + 1
+
+
+def run_phase(app, users, args, attackers):
+    """Run the legitimate load with ``attackers`` attack threads alongside."""
+    results = []
+    counts = {}
+    stop = threading.Event()
+
+    attack = [threading.Thread(target=attack_worker, args=(app, users, i, stop, counts, args.seed))
+              for i in range(attackers)]
+    legit = [threading.Thread(target=legit_worker,
+                              args=(app, users, i, args.requests // args.workers, results, args.seed))
+             for i in range(args.workers)]
+
+    for thread in attack:
+        thread.start()
+    started = time.perf_counter()
+    for thread in legit:
+        thread.start()
+    for thread in legit:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    stop.set()
+    for thread in attack:
+        thread.join()
+
+    return summarize(results, elapsed), counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark latency during a login attack.")
+    parser.add_argument('--database-url', default=DEFAULT_DATABASE_URL)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--messages', type=int, default=10000)
+    parser.add_argument('--follows', type=int, default=5000)
+    parser.add_argument('--log-rounds', type=int, default=12,
+                        help="bcrypt cost of the seeded passwords")
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--attackers', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=800)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default=None)
+    args = parser.parse_args(argv)
+
+    app = load_app(args.database_url)
+    users = seed_dataset(app, args.users, args.messages, args.follows,
+                         seed=args.seed, log_rounds=args.log_rounds)
+
+    from throttle import throttle
+
+    phases = [('baseline', 0, 'memory'), ('attack_unthrottled', args.attackers, 'none'),
+              ('attack_throttled', args.attackers, 'memory')]
+    summary = {}
+    for name, attackers, backend in phases:
+        app.config['LOGIN_THROTTLE_BACKEND'] = backend
+        throttle.init_app(app)
+
+        phase_summary, counts = run_phase(app, users, args, attackers)
+        print(f"\n{name}: attack responses {dict(sorted(counts.items()))}")
+        print_summary(phase_summary)
+        summary[name] = {'legit': phase_summary, 'attack_statuses': counts}
+
+    out = args.out or f"bench/results/login_attack-{git_commit() or 'unknown'}.json"
+    params = {k: v for k, v in vars(args).items() if k not in ('out', 'database_url')}
+    data = save_results(out, 'login_attack', params, summary)
+    print(f"Peak memory: {data['peak_memory_mb']} MB; results written to {out}")
+
+
+if __name__ == '__main__':
+    main()
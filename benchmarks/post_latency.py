@@ -0,0 +1,92 @@
+"""Measure POST /messages/new latency against how many messages the author has.
+
+Posting should cost the same whether the author has 10 messages or 100,000;
+this creates one author per size, backfills their messages with a bulk
+insert, then times a batch of posts through the test client. A run where
+any post fails isn't saved.
+
+Run it from the repository root like:
+    python -m benchmarks.post_latency
+    python -m benchmarks.post_latency --sizes 10 1000 100000 --posts 200
+"""
+
+import argparse
+import time
+from datetime import datetime, timedelta
+
+from benchmarks.harness import (DEFAULT_DATABASE_URL, Result, TestClientDriver,
+                                ensure_scratch_database, git_commit, load_app,
+                                print_summary, save_results, summarize)
+
+DEFAULT_SIZES = [10, 100, 1000, 10000, 100000]
+
+
+def make_author(size):
+    """Create an author with ``size`` existing messages; return their id."""
+    from models import Message, User, db
+
+    user = User(username=f"poster{size}", email=f"poster{size}@bench.test",
+                password="not-a-real-hash")
+    db.session.add(user)
+    db.session.commit()
+
+    start = datetime(2020, 1, 1)
+    table = Message.__table__
+    for offset in range(0, size, 10000):
+        db.session.execute(table.insert(), [
+            {'text': f'backfill {i}', 'user_id': user.id,
+             'timestamp': start + timedelta(seconds=i)}
+            for i in range(offset, min(size, offset + 10000))
+        ])
+        db.session.commit()
+
+    return user.id
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark post latency by history size.")
+    parser.add_argument('--database-url', default=DEFAULT_DATABASE_URL)
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES)
+    parser.add_argument('--posts', type=int, default=100)
+    parser.add_argument('--out', default=None)
+    args = parser.parse_args(argv)
+
+    app = load_app(args.database_url)
+    ensure_scratch_database(app)
+    from models import db
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        authors = {size: make_author(size) for size in args.sizes}
+
+    driver = TestClientDriver(app)
+    results = []
+
+    for size, author_id in authors.items():
+        session = driver.session()
+        session.login_as(author_id)
+
+        for i in range(args.posts):
+            started = time.perf_counter()
+            status, queries = session.request('POST', '/messages/new', {'text': f'post {i}'})
+            results.append(Result(f'{size}_existing', status,
+                                  time.perf_counter() - started, queries))
+
+    total = sum(r.seconds for r in results)
+    summary = summarize(results, total)
+    print_summary(summary)
+
+    # A post redirects to the author's page; anything else (a 503 from load
+    # shedding, say) times an error page rather than a post
+    statuses = sorted({r.status for r in results if r.status != 302})
+    if statuses:
+        raise SystemExit(f"Some posts failed with {statuses}; not saving results")
+
+    out = args.out or f"bench/results/post_latency-{git_commit() or 'unknown'}.json"
+    save_results(out, 'post_latency', {'sizes': args.sizes, 'posts': args.posts}, summary)
+    print(f"Results written to {out}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""Load-test every main route with a weighted mix of concurrent users.
+
+Run it from the repository root like:
+    python -m benchmarks.routes --users 5000 --messages 200000 --follows 100000
+    python -m benchmarks.routes --mode server --workers 16 --requests 20000
+    python -m benchmarks.routes --no-seed --out bench/results/latest.json
+
+Results are written as JSON (default ``bench/results/routes-<commit>.json``);
+compare two runs with ``python -m benchmarks.compare old.json new.json``.
+"""
+
+import argparse
+
+from benchmarks.harness import (DEFAULT_DATABASE_URL, BENCH_PASSWORD, Scenario,
+                                ServerDriver, TestClientDriver, git_commit,
+                                load_app, print_summary, run_scenarios,
+                                save_results, seed_dataset, summarize)
+
+
+def homepage(session, rng, users):
+    return session.request('GET', '/')
+
+
+def users_show(session, rng, users):
+    user_id, _ = rng.choice(users)
+    return session.request('GET', f'/users/{user_id}')
+
+
+def list_users(session, rng, users):
+    _, username = rng.choice(users)
+    return session.request('GET', f'/users?q={username[:3]}')
+
+
+def like_message(session, rng, users):
+    # Likes toggle, so repeated picks exercise both like and unlike
+    return session.request('POST', f'/messages/{rng.randint(1, like_message.max_id)}/like')
+
+
+def messages_add(session, rng, users):
+    return session.request('POST', '/messages/new', {'text': f'bench warble {rng.random()}'})
+
+
+def follow_unfollow(session, rng, users):
+    user_id, _ = rng.choice(users)
+    status, queries = session.request('POST', f'/users/follow/{user_id}')
+    status2, queries2 = session.request('POST', f'/users/stop-following/{user_id}')
+    return max(status, status2), queries + queries2
+
+
+def login(session, rng, users):
+    user_id, username = rng.choice(users)
+    return session.request('POST', '/login', {'username': username, 'password': BENCH_PASSWORD})
+
+
+SCENARIOS = [
+    Scenario('homepage', 40, homepage),
+    Scenario('users_show', 20, users_show),
+    Scenario('list_users', 10, list_users),
+    Scenario('like_message', 10, like_message),
+    Scenario('messages_add', 8, messages_add),
+    Scenario('follow_unfollow', 7, follow_unfollow),
+    Scenario('login', 5, login),
+]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark Warbler routes.")
+    parser.add_argument('--database-url', default=DEFAULT_DATABASE_URL)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--messages', type=int, default=50000)
+    parser.add_argument('--follows', type=int, default=40000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-seed', action='store_true',
+                        help="reuse the data already in the database")
+    parser.add_argument('--mode', choices=['client', 'server'], default='client',
+                        help="Flask test client or a local threaded WSGI server")
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--out', default=None)
+    args = parser.parse_args(argv)
+
+    app = load_app(args.database_url)
+
+    if args.no_seed:
+        from models import Message, User, db
+        with app.app_context():
+            users = [tuple(row) for row in db.session.query(User.id, User.username)]
+            like_message.max_id = db.session.query(db.func.max(Message.id)).scalar() or 1
+    else:
+        users = seed_dataset(app, args.users, args.messages, args.follows, seed=args.seed)
+        like_message.max_id = max(args.messages, 1)
+
+    driver = TestClientDriver(app) if args.mode == 'client' else ServerDriver(app)
+    try:
+        results, elapsed = run_scenarios(driver, SCENARIOS, users, workers=args.workers,
+                                         total_requests=args.requests, seed=args.seed)
+    finally:
+        driver.close()
+
+    summary = summarize(results, elapsed)
+    print_summary(summary)
+
+    out = args.out or f"bench/results/routes-{git_commit() or 'unknown'}.json"
+    params = {k: v for k, v in vars(args).items() if k not in ('out', 'database_url')}
+    data = save_results(out, 'routes', params, summary)
+    print(f"Peak memory: {data['peak_memory_mb']} MB; results written to {out}")
+
+
+if __name__ == '__main__':
+    main()
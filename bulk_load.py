@@ -0,0 +1,331 @@
+"""Bulk-load the generator CSVs into the database.
+
+Rows are streamed from each CSV in fixed-size chunks. On Postgres every chunk
+goes through ``COPY ... FROM STDIN``; on other backends it falls back to an
+executemany INSERT. Each chunk is committed in its own short transaction
+together with a progress record, so a load that fails part-way can be picked
+up again with ``--resume`` without duplicating or skipping rows. The loaded
+messages' @mentions and #hashtags are indexed at the end (see mentions.py).
+
+Run it like:
+    python bulk_load.py
+    python bulk_load.py --data-dir generator --chunk-size 50000
+    python bulk_load.py --resume
+"""
+
+import argparse
+import csv
+import io
+import os
+import sys
+import time
+from datetime import datetime
+from itertools import islice
+
+from sqlalchemy import (Column, DateTime, Integer, MetaData, String, Table,
+                        inspect)
+from sqlalchemy.schema import AddConstraint, ForeignKeyConstraint, UniqueConstraint
+
+import mentions
+from models import db
+from sharding import router
+
+DEFAULT_CHUNK_SIZE = 10000
+
+# Tables to load, in dependency order: (table name, CSV file name).
+# Users and messages get explicit ids from their row number (starting at 1),
+# which is what the generator assumes when it writes foreign keys.
+LOAD_PLAN = [
+    ('users', 'users.csv'),
+    ('messages', 'messages.csv'),
+    ('follows', 'follows.csv'),
+]
+
+# Progress bookkeeping lives outside the app's metadata so that
+# ``db.drop_all()`` / ``db.create_all()`` never touch it.
+progress_metadata = MetaData()
+
+load_progress = Table(
+    'bulk_load_progress', progress_metadata,
+    Column('table_name', String(100), primary_key=True),
+    Column('rows_loaded', Integer, nullable=False, default=0),
+    Column('updated_at', DateTime, nullable=False, default=datetime.utcnow),
+)
+
+
+def is_postgres(engine):
+    """Return True if the engine talks to Postgres (and so supports COPY)."""
+    return engine.dialect.name == 'postgresql'
+
+
+def parse_value(column, value):
+    """Convert a raw CSV string into a value suitable for ``column``.
+
+    Only needed on the executemany path; COPY parses text itself.
+    """
+    if value == '' and column.nullable:
+        return None
+
+    python_type = column.type.python_type
+
+    if python_type is datetime:
+        for fmt in ('%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S'):
+            try:
+                return datetime.strptime(value, fmt)
+            except ValueError:
+                pass
+        raise ValueError(f"Unparseable timestamp for {column}: {value!r}")
+
+    if python_type is int:
+        return int(value)
+
+    return value
+
+
+def read_chunks(path, chunk_size, skip=0):
+    """Yield (header, rows) chunks of at most ``chunk_size`` rows from a CSV.
+
+    ``skip`` rows after the header are passed over first (used when resuming).
+    """
+    with open(path, newline='') as csv_file:
+        reader = csv.reader(csv_file)
+        header = next(reader)
+
+        # Fast-forward past rows a previous run already committed
+        for _ in islice(reader, skip):
+            pass
+
+        while True:
+            rows = list(islice(reader, chunk_size))
+            if not rows:
+                return
+            yield header, rows
+
+
+def has_serial_id(table):
+    """Return True if the table has an autoincrementing integer ``id`` PK."""
+    return 'id' in table.c and table.c.id.primary_key and table.c.id.autoincrement
+
+
+def copy_chunk(conn, table, columns, rows):
+    """Stream one chunk into ``table`` with Postgres COPY."""
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+
+    cursor = conn.connection.cursor()
+    cursor.copy_expert(
+        f"COPY {table.name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)",
+        buffer)
+    cursor.close()
+
+
+def insert_chunk(conn, table, columns, rows):
+    """Insert one chunk into ``table`` with executemany (non-Postgres fallback)."""
+    table_columns = [table.c[name] for name in columns]
+    conn.execute(table.insert(), [
+        {col.name: parse_value(col, value) for col, value in zip(table_columns, row)}
+        for row in rows
+    ])
+
+
+def get_rows_loaded(conn, table_name):
+    """Return how many rows of ``table_name`` a previous run committed."""
+    row = conn.execute(
+        load_progress.select().where(load_progress.c.table_name == table_name)
+    ).first()
+    return row.rows_loaded if row else 0
+
+
+def set_rows_loaded(conn, table_name, rows_loaded):
+    """Record progress for ``table_name`` inside the caller's transaction."""
+    updated = conn.execute(
+        load_progress.update()
+        .where(load_progress.c.table_name == table_name)
+        .values(rows_loaded=rows_loaded, updated_at=datetime.utcnow()))
+
+    if not updated.rowcount:
+        conn.execute(load_progress.insert().values(
+            table_name=table_name, rows_loaded=rows_loaded))
+
+
+def defer_constraints(engine, table):
+    """Drop secondary indexes, unique and foreign key constraints before loading.
+
+    Primary keys are kept so resumed loads can never duplicate rows. Only done
+    on Postgres; SQLite cannot drop constraints from an existing table.
+    """
+    if not is_postgres(engine):
+        return
+
+    with engine.begin() as conn:
+        inspector = inspect(conn)
+
+        for index in table.indexes:
+            if index.name in {ix['name'] for ix in inspector.get_indexes(table.name)}:
+                index.drop(bind=conn)
+
+        existing = (inspector.get_foreign_keys(table.name)
+                    + inspector.get_unique_constraints(table.name))
+        for constraint in existing:
+            conn.execute(f'ALTER TABLE {table.name} DROP CONSTRAINT "{constraint["name"]}"')
+
+
+def restore_constraints(engine, table):
+    """Re-create whatever ``defer_constraints`` removed. Safe to run repeatedly."""
+    if not is_postgres(engine):
+        return
+
+    with engine.begin() as conn:
+        inspector = inspect(conn)
+
+        index_names = {ix['name'] for ix in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in index_names:
+                index.create(bind=conn)
+
+        unique_columns = {tuple(sorted(uc['column_names']))
+                          for uc in inspector.get_unique_constraints(table.name)}
+        fk_columns = {tuple(sorted(fk['constrained_columns']))
+                      for fk in inspector.get_foreign_keys(table.name)}
+
+        for constraint in table.constraints:
+            columns = tuple(sorted(col.name for col in constraint.columns))
+
+            if isinstance(constraint, UniqueConstraint) and columns not in unique_columns:
+                add_constraint(conn, constraint)
+            elif isinstance(constraint, ForeignKeyConstraint) and columns not in fk_columns:
+                add_constraint(conn, constraint)
+
+
+def add_constraint(conn, constraint):
+    """ALTER TABLE ... ADD ``constraint``.
+
+    AddConstraint marks the constraint as one that's added separately, which
+    would leave it out of every later CREATE TABLE (``db.create_all()``) in
+    this process, so the mark is undone afterwards.
+    """
+    create_rule = constraint._create_rule
+    try:
+        conn.execute(AddConstraint(constraint))
+    finally:
+        constraint._create_rule = create_rule
+
+
+def reset_sequence(engine, table):
+    """Point the table's id sequence past the explicitly-loaded ids."""
+    if not (is_postgres(engine) and has_serial_id(table)):
+        return
+
+    with engine.begin() as conn:
+        conn.execute(
+            f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), "
+            f"COALESCE(MAX(id), 0) + 1, false) FROM {table.name}")
+
+
+def load_table(engine, table, path, chunk_size, out=sys.stdout):
+    """Stream one CSV into ``table`` chunk by chunk, committing as it goes."""
+    with engine.begin() as conn:
+        rows_loaded = get_rows_loaded(conn, table.name)
+
+    write_chunk = copy_chunk if is_postgres(engine) else insert_chunk
+    assign_ids = has_serial_id(table)
+    started = time.perf_counter()
+    loaded_this_run = 0
+
+    if rows_loaded:
+        print(f"{table.name}: resuming after {rows_loaded:,} rows", file=out)
+
+    for header, rows in read_chunks(path, chunk_size, skip=rows_loaded):
+        columns = list(header)
+
+        # Give rows explicit ids so resumed loads land on the same keys
+        if assign_ids and 'id' not in columns:
+            columns = ['id'] + columns
+            rows = [[rows_loaded + i + 1] + row for i, row in enumerate(rows)]
+
+        with engine.begin() as conn:
+            write_chunk(conn, table, columns, rows)
+            set_rows_loaded(conn, table.name, rows_loaded + len(rows))
+
+        rows_loaded += len(rows)
+        loaded_this_run += len(rows)
+        elapsed = time.perf_counter() - started
+        print(f"{table.name}: {rows_loaded:,} rows "
+              f"({loaded_this_run / elapsed:,.0f} rows/s)", file=out)
+
+    return loaded_this_run
+
+
+def load_all(data_dir='generator', chunk_size=DEFAULT_CHUNK_SIZE, resume=False,
+             out=sys.stdout):
+    """Load every CSV in ``LOAD_PLAN`` from ``data_dir``.
+
+    A fresh load drops and recreates the schema; ``resume=True`` keeps the
+    existing tables and continues from the recorded progress.
+
+    Loads the main database only, with serial message ids, so it refuses
+    to run with sharding on (see sharding.py).
+    """
+    if router.enabled:
+        raise RuntimeError("bulk_load.py loads a single database; unset SHARD_URLS to use it")
+
+    engine = db.engine
+    tables = db.metadata.tables
+
+    if not resume:
+        db.drop_all()
+        db.create_all()
+        progress_metadata.drop_all(bind=engine)
+
+    progress_metadata.create_all(bind=engine)
+
+    for table_name, _ in LOAD_PLAN:
+        defer_constraints(engine, tables[table_name])
+
+    started = time.perf_counter()
+    total = 0
+
+    for table_name, file_name in LOAD_PLAN:
+        total += load_table(engine, tables[table_name],
+                            os.path.join(data_dir, file_name), chunk_size, out=out)
+
+    print("Rebuilding indexes and constraints...", file=out)
+    for table_name, _ in LOAD_PLAN:
+        restore_constraints(engine, tables[table_name])
+        reset_sequence(engine, tables[table_name])
+
+    # Rows copied in skip the parsing that posting does; it's safe to redo
+    # after a resume, since each chunk replaces its messages' entries
+    print("Indexing mentions and hashtags...", file=out)
+    mentions.backfill()
+
+    if is_postgres(engine):
+        with engine.connect() as conn:
+            conn.execution_options(isolation_level='AUTOCOMMIT').execute('ANALYZE')
+
+    elapsed = time.perf_counter() - started
+    print(f"Loaded {total:,} rows in {elapsed:.1f}s "
+          f"({total / max(elapsed, 1e-9):,.0f} rows/s)", file=out)
+    return total
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--data-dir', default='generator',
+                        help="directory holding users.csv, messages.csv, follows.csv")
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                        help="rows per COPY/INSERT transaction")
+    parser.add_argument('--resume', action='store_true',
+                        help="continue an interrupted load instead of starting over")
+    args = parser.parse_args(argv)
+
+    # Importing the app configures and connects the database
+    from app import app
+
+    with app.app_context():
+        load_all(args.data_dir, args.chunk_size, args.resume)
+
+
+if __name__ == '__main__':
+    main()
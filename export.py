@@ -0,0 +1,213 @@
+"""Account data export.
+
+A user's data is exported as a zip of newline-delimited JSON files:
+
+    profile.ndjson     the user row (without the password hash)
+    messages.ndjson    every message, archived ones included, oldest first
+    likes.ndjson       the messages they've liked
+    following.ndjson   who they follow
+    followers.ndjson   who follows them
+
+Nothing is loaded whole: each file is written from a server-side cursor
+(``stream_results``) a batch of rows at a time, and the zip is written to a
+sink that hands back its compressed bytes as they're produced, so memory
+stays flat however big the account is. The zip is streamed (data
+descriptors, zip64 entries), so it never needs to seek.
+
+``GET /users/export`` streams it straight to the browser. For very large
+accounts, the ``export_account`` job or
+
+    python export.py 42 --out warbler-42.zip
+
+writes it to a local file instead (default: EXPORT_ROOT/<user>-<time>.zip);
+``python export.py 42 --queue`` enqueues that job on the JOB_BACKEND queue
+rather than writing the file itself.
+"""
+
+import argparse
+import json
+import os
+import zipfile
+from datetime import datetime
+
+from flask import current_app
+
+from archive import unpack
+from models import db, ArchivedMessages, Follows, Likes, Message, User
+from sharding import router
+
+# Rows fetched per round trip from each cursor
+FETCH_SIZE = 1000
+
+# Hand compressed output back once this much has built up
+CHUNK_BYTES = 64 * 1024
+
+USER_COLUMNS = ['id', 'username', 'email', 'image_url', 'header_image_url', 'bio', 'location']
+
+
+def _default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Can't serialize {type(value).__name__}")
+
+
+class ChunkSink:
+    """A write-only file that collects bytes until they're taken."""
+
+    def __init__(self):
+        self.parts = []
+        self.size = 0
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self.parts)
+        self.parts = []
+        self.size = 0
+        return data
+
+
+def stream_rows(engine, query):
+    """Rows of ``query`` as dicts, read through a server-side cursor."""
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True).execute(query)
+        while True:
+            rows = result.fetchmany(FETCH_SIZE)
+            if not rows:
+                return
+            for row in rows:
+                yield dict(row)
+
+
+def _engines_for_user(user_id):
+    """Engines holding ``user_id``'s messages and archive."""
+    if router.enabled:
+        return [router.engine(router.shard_for_user(user_id))]
+    return [db.engine]
+
+
+def _all_message_engines():
+    """Engines that may hold likes (which live with the liked message)."""
+    if router.enabled:
+        return [router.engine(shard) for shard in router.shards]
+    return [db.engine]
+
+
+def profile_rows(user_id):
+    users = User.__table__
+    return stream_rows(db.engine, db.select([users.c[name] for name in USER_COLUMNS])
+                       .where(users.c.id == user_id))
+
+
+def message_rows(user_id):
+    messages = Message.__table__
+    archive = ArchivedMessages.__table__
+    for engine in _engines_for_user(user_id):
+        # Archived chunks first (they're older), one chunk in memory at a time
+        for chunk in stream_rows(engine, db.select([archive.c.data])
+                                 .where(archive.c.user_id == user_id)
+                                 .order_by(archive.c.oldest_timestamp, archive.c.oldest_id)):
+            for msg in reversed(unpack(chunk['data'])):
+                yield {'id': msg['id'], 'text': msg['text'], 'timestamp': msg['timestamp'],
+                       'archived': True}
+
+        yield from stream_rows(engine, db.select([messages.c.id, messages.c.text,
+                                                  messages.c.timestamp])
+                               .where(messages.c.user_id == user_id)
+                               .order_by(messages.c.timestamp, messages.c.id))
+
+
+def like_rows(user_id):
+    likes = Likes.__table__
+    messages = Message.__table__
+    for engine in _all_message_engines():
+        yield from stream_rows(engine, db.select([likes.c.message_id, messages.c.user_id,
+                                                  messages.c.text, messages.c.timestamp])
+                               .select_from(likes.join(messages,
+                                                       messages.c.id == likes.c.message_id))
+                               .where(likes.c.user_id == user_id)
+                               .order_by(likes.c.message_id))
+
+
+def follow_rows(user_column, other_column, user_id):
+    users = User.__table__
+    return stream_rows(db.engine, db.select([users.c.id, users.c.username])
+                       .select_from(users.join(Follows.__table__, other_column == users.c.id))
+                       .where(user_column == user_id)
+                       .order_by(users.c.id))
+
+
+def sections(user_id):
+    """(file name, row iterator) for each file in the export."""
+    follows = Follows.__table__
+    return [
+        ('profile.ndjson', profile_rows(user_id)),
+        ('messages.ndjson', message_rows(user_id)),
+        ('likes.ndjson', like_rows(user_id)),
+        ('following.ndjson', follow_rows(follows.c.user_following_id,
+                                         follows.c.user_being_followed_id, user_id)),
+        ('followers.ndjson', follow_rows(follows.c.user_being_followed_id,
+                                         follows.c.user_following_id, user_id)),
+    ]
+
+
+def generate_zip(user_id):
+    """Yield the export zip for ``user_id`` in chunks of compressed bytes."""
+    sink = ChunkSink()
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for name, rows in sections(user_id):
+            with archive.open(name, 'w', force_zip64=True) as entry:
+                for row in rows:
+                    entry.write(json.dumps(row, separators=(',', ':'), default=_default).encode())
+                    entry.write(b'\n')
+                    if sink.size >= CHUNK_BYTES:
+                        yield sink.take()
+            yield sink.take()
+    yield sink.take()
+
+
+def export_filename(user_id):
+    return f"warbler-{user_id}-{datetime.utcnow():%Y%m%d%H%M%S}.zip"
+
+
+def write_export(user_id, path=None):
+    """Write ``user_id``'s export to ``path`` (default under EXPORT_ROOT); return the path."""
+    if path is None:
+        root = current_app.config['EXPORT_ROOT']
+        os.makedirs(root, exist_ok=True)
+        path = os.path.join(root, export_filename(user_id))
+
+    tmp = f"{path}.tmp"
+    with open(tmp, 'wb') as out:
+        for chunk in generate_zip(user_id):
+            out.write(chunk)
+    os.replace(tmp, path)
+    return path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export a Warbler user's data.")
+    parser.add_argument('user_id', type=int)
+    parser.add_argument('--out', help="file to write (default: under EXPORT_ROOT)")
+    parser.add_argument('--queue', action='store_true',
+                        help="run it as an export_account job instead of here")
+    args = parser.parse_args(argv)
+
+    from app import app, queue
+
+    with app.app_context():
+        if args.queue:
+            queue.enqueue('export_account', user_id=args.user_id, path=args.out)
+            print(f"Queued export of user {args.user_id}")
+        else:
+            print(f"Wrote {write_export(args.user_id, args.out)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,5 @@
 from flask_wtf import FlaskForm
+from flask_wtf.file import FileAllowed, FileField
 from wtforms import StringField, PasswordField, TextAreaField
 from wtforms.validators import DataRequired, Email, Length, Optional
 
@@ -39,6 +40,12 @@ class UserEditForm(FlaskForm):
     # Optional field for header image URL
     header_image_url = StringField('Header Image URL', validators=[Optional()])
 
+    # Optional uploads; these win over the URL fields when given
+    image_file = FileField('Upload a profile image', validators=[
+        FileAllowed(['jpg', 'jpeg', 'png', 'gif', 'webp'], 'Images only!')])
+    header_file = FileField('Upload a header image', validators=[
+        FileAllowed(['jpg', 'jpeg', 'png', 'gif', 'webp'], 'Images only!')])
+
     # Optional field for bio
     bio = StringField('Bio', validators=[Optional()])
 
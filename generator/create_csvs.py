@@ -3,14 +3,30 @@
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
 tweak the CSV formats or generate fewer/more rows.
+
+Generation is fully offline and deterministic for a given ``--seed``. Work is
+split into fixed shards (so output doesn't depend on the number of workers),
+each shard streams its rows to a part file in a process pool, and the parts
+are concatenated into the final CSVs. Nothing is held in memory beyond one
+user's follow targets, so it scales to millions of users and hundreds of
+millions of messages.
+
+Run it from the repository root like:
+    python -m generator.create_csvs
+    python -m generator.create_csvs --users 1000000 --messages 100000000 \\
+        --follows 50000000 --workers 16 --seed 42
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
-from faker import Faker
-from helpers import get_random_datetime
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from generator.helpers import (CITIES, EMAIL_DOMAINS, WORDS, bursty_timestamps,
+                               coprime_multiplier, fake_sentence, make_rng,
+                               pareto, popular_user)
 
 MAX_WARBLER_LENGTH = 140
 
@@ -22,56 +38,211 @@ NUM_USERS = 300
 NUM_MESSAGES = 1000
 NUM_FOLLWERS = 5000
 
-fake = Faker()
+# Rows per shard; small enough to spread work, big enough to amortize startup
+ROWS_PER_SHARD = 250000
+
+# Power-law exponents: follower popularity and how much more active
+# prolific posters are than everyone else
+FOLLOW_POPULARITY_ALPHA = 2.1
+POSTING_ACTIVITY_ALPHA = 2.3
+OUT_DEGREE_ALPHA = 2.5
+
+# bcrypt hash of "password", shared by every generated user
+PASSWORD_HASH = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
 
-# Generate random profile image URLs to use for users
+DEFAULT_HEADER_IMAGE = "/static/images/warbler-hero.jpg"
 
+# Profile image URLs; only the strings are used, nothing is downloaded
 image_urls = [
     f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
     for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
 
-header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
-]
+def shard_bounds(total, num_shards, shard):
+    """Return the [start, stop) slice of ``total`` rows owned by ``shard``."""
+    return total * shard // num_shards, total * (shard + 1) // num_shards
+
+
+def part_path(out_dir, table, shard):
+    return os.path.join(out_dir, '.parts', f"{table}-{shard:05d}.csv")
+
+
+def write_users_shard(seed, out_dir, num_users, num_shards, shard):
+    """Write users for ids in this shard's range."""
+    rng = make_rng(seed, 'users', shard)
+    start, stop = shard_bounds(num_users, num_shards, shard)
+
+    with open(part_path(out_dir, 'users', shard), 'w', newline='') as part:
+        writer = csv.writer(part)
+
+        for user_id in range(start + 1, stop + 1):
+            # Suffix with the id so usernames/emails are always unique
+            username = f"{rng.choice(WORDS)}{rng.choice(WORDS)}{user_id}"
+            writer.writerow([
+                f"{username}@{rng.choice(EMAIL_DOMAINS)}",
+                username,
+                rng.choice(image_urls),
+                PASSWORD_HASH,
+                fake_sentence(rng, 100),
+                DEFAULT_HEADER_IMAGE,
+                rng.choice(CITIES),
+            ])
+
+    return stop - start
+
+
+def write_messages_shard(seed, out_dir, num_users, num_messages, num_shards, shard,
+                         start_time, end_time):
+    """Write this shard's messages: power-law authors, bursty posting times."""
+    rng = make_rng(seed, 'messages', shard)
+    start, stop = shard_bounds(num_messages, num_shards, shard)
+    multiplier = coprime_multiplier(num_users)
+    written = 0
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+    with open(part_path(out_dir, 'messages', shard), 'w', newline='') as part:
+        writer = csv.writer(part)
+
+        while written < stop - start:
+            # Each author posts a burst of messages in one sitting
+            author = popular_user(rng, num_users, POSTING_ACTIVITY_ALPHA, multiplier)
+            burst = min(int(pareto(rng, 2.0)), stop - start - written)
+
+            for timestamp in bursty_timestamps(rng, burst, start_time, end_time):
+                writer.writerow([
+                    fake_sentence(rng, MAX_WARBLER_LENGTH),
+                    timestamp.isoformat(sep=' '),
+                    author,
+                ])
+                written += 1
+
+    return written
+
+
+def write_follows_shard(seed, out_dir, num_users, num_follows, num_shards, shard):
+    """Write follows for followers in this shard's id range.
+
+    Out-degree is power-law with mean ``num_follows / num_users``; targets
+    are drawn with power-law popularity, so in-degree is heavy-tailed too.
+    Pairs are never materialized: each follower's targets are sampled
+    independently and de-duplicated in a small set.
+    """
+    rng = make_rng(seed, 'follows', shard)
+    start, stop = shard_bounds(num_users, num_shards, shard)
+    multiplier = coprime_multiplier(num_users)
+    mean_degree = num_follows / num_users
+
+    # x_min chosen so the unscaled Pareto draw has mean 1
+    x_min = (OUT_DEGREE_ALPHA - 2) / (OUT_DEGREE_ALPHA - 1)
+    written = 0
+
+    with open(part_path(out_dir, 'follows', shard), 'w', newline='') as part:
+        writer = csv.writer(part)
+
+        for follower in range(start + 1, stop + 1):
+            degree = mean_degree * pareto(rng, OUT_DEGREE_ALPHA, x_min)
+            # Stochastic rounding keeps the expected total on target
+            degree = min(int(degree + rng.random()), num_users - 1)
+
+            if degree > (num_users - 1) // 2:
+                # Dense case: a uniform sample is cheaper than rejection
+                targets = [u for u in rng.sample(range(1, num_users + 1), degree + 1)
+                           if u != follower][:degree]
+            else:
+                targets = set()
+                while len(targets) < degree:
+                    followed = popular_user(rng, num_users, FOLLOW_POPULARITY_ALPHA, multiplier)
+                    if followed == follower or followed in targets:
+                        # Popular users saturate; fall back to uniform picks
+                        followed = rng.randint(1, num_users)
+                    if followed != follower:
+                        targets.add(followed)
+
+            for followed in sorted(targets):
+                writer.writerow([followed, follower])
+            written += len(targets)
+
+    return written
+
+
+def concatenate(out_dir, table, headers, num_shards):
+    """Stream the shard part files into ``<out_dir>/<table>.csv``."""
+    with open(os.path.join(out_dir, f"{table}.csv"), 'w', newline='') as out:
+        csv.writer(out).writerow(headers)
+
+        for shard in range(num_shards):
+            path = part_path(out_dir, table, shard)
+            with open(path, newline='') as part:
+                shutil.copyfileobj(part, out)
+            os.remove(path)
+
+
+def num_shards_for(rows):
+    return max(1, -(-rows // ROWS_PER_SHARD))
+
+
+def generate(out_dir='generator', num_users=NUM_USERS, num_messages=NUM_MESSAGES,
+             num_follows=NUM_FOLLWERS, seed=0, workers=None, year_gap=2):
+    """Generate users.csv, messages.csv and follows.csv in ``out_dir``.
+
+    Returns a dict of row counts actually written per table.
+    """
+    os.makedirs(os.path.join(out_dir, '.parts'), exist_ok=True)
+
+    # A fixed window rather than one ending now, so reruns with the same
+    # seed are byte-identical
+    end_time = datetime(2024, 1, 1)
+    start_time = end_time.replace(year=end_time.year - year_gap)
+
+    user_shards = num_shards_for(num_users)
+    message_shards = num_shards_for(num_messages)
+    follow_shards = num_shards_for(num_follows) if num_users > 1 else 0
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        users = [pool.submit(write_users_shard, seed, out_dir, num_users,
+                             user_shards, shard)
+                 for shard in range(user_shards)]
+        messages = [pool.submit(write_messages_shard, seed, out_dir, num_users,
+                                num_messages, message_shards, shard,
+                                start_time, end_time)
+                    for shard in range(message_shards)]
+        follows = [pool.submit(write_follows_shard, seed, out_dir, num_users,
+                               num_follows, follow_shards, shard)
+                   for shard in range(follow_shards)]
+
+        counts = {
+            'users': sum(f.result() for f in users),
+            'messages': sum(f.result() for f in messages),
+            'follows': sum(f.result() for f in follows),
+        }
+
+    concatenate(out_dir, 'users', USERS_CSV_HEADERS, user_shards)
+    concatenate(out_dir, 'messages', MESSAGES_CSV_HEADERS, message_shards)
+    concatenate(out_dir, 'follows', FOLLOWS_CSV_HEADERS, follow_shards)
+    os.rmdir(os.path.join(out_dir, '.parts'))
+
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate Warbler CSVs.")
+    parser.add_argument('--out-dir', default='generator')
+    parser.add_argument('--users', type=int, default=NUM_USERS)
+    parser.add_argument('--messages', type=int, default=NUM_MESSAGES)
+    parser.add_argument('--follows', type=int, default=NUM_FOLLWERS,
+                        help="approximate number of follow rows")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=None,
+                        help="worker processes (default: one per CPU)")
+    args = parser.parse_args(argv)
+
+    counts = generate(args.out_dir, args.users, args.messages, args.follows,
+                      seed=args.seed, workers=args.workers)
+
+    for table, count in counts.items():
+        print(f"{table}: {count:,} rows")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,117 @@
-"""Support functions for CSV generation."""
+"""Support functions for CSV generation.
 
-from datetime import datetime
-from random import uniform
+Everything here is offline and driven by an explicit ``random.Random`` so the
+generator produces identical output for the same seed.
+"""
 
+import math
+import random
+from datetime import datetime, timedelta
 
-def get_random_datetime(year_gap=2):
+# Small built-in lexicon so generation needs no network and no Faker.
+WORDS = """
+able acid aged also area army away baby back ball band bank base bath bear
+beat been beer bell belt best bill bird blow blue boat body bomb bond bone
+book boom born boss both bowl bulk burn bush busy call calm came camp card
+care case cash cast cell chat chip city club coal coat code cold come cook
+cool cope copy core cost crew crop dark data date dawn days dead deal dean
+dear debt deep deny desk dial diet disc disk does done door dose down draw
+drew drop drug dual duke dust duty each earn ease east easy edge else even
+ever evil exit face fact fail fair fall farm fast fate fear feed feel feet
+fell felt file fill film find fine fire firm fish five flat flow food foot
+ford form fort four free from fuel full fund gain game gate gave gear gene
+gift girl give glad goal goes gold golf gone good gray grew grey grow gulf
+hair half hall hand hang hard harm hate have head hear heat held hell help
+here hero high hill hire hold hole holy home hope host hour huge hung hunt
+hurt idea inch into iron item jack jane jean john join jump jury just keen
+keep kent kept kick kill kind king knee knew know lack lady laid lake land
+lane last late lead left less life lift like line link list live load loan
+lock logo long look lord lose loss lost love luck made mail main make male
+many mark mass matt meal mean meat meet menu mere mike mile milk mill mind
+mine miss mode mood moon more most move much must name navy near neck need
+news next nice nick nine none nose note okay once only onto open oral over
+pace pack page paid pain pair palm park part pass past path peak pick pink
+pipe plan play plot plug plus poll pool poor port post pull pure push race
+rail rain rank rare rate read real rear rely rent rest rice rich ride ring
+rise risk road rock role roll roof room root rose rule rush ruth safe said
+sake sale salt same sand save seat seed seek seem seen self sell send sent
+""".split()
+
+CITIES = [
+    "Springfield", "Riverton", "Lakeside", "Fairview", "Greenville",
+    "Bristol", "Clinton", "Georgetown", "Salem", "Madison", "Oakland",
+    "Franklin", "Ashland", "Burlington", "Manchester", "Milton", "Newport",
+    "Oxford", "Dover", "Hudson", "Kingston", "Marion", "Arlington",
+]
+
+EMAIL_DOMAINS = ["example.com", "example.net", "example.org", "mail.test"]
+
+
+def get_random_datetime(year_gap=2, rng=random):
     """Get a random datetime within the last few years."""
 
     now = datetime.now()
     then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+    random_timestamp = rng.uniform(then.timestamp(), now.timestamp())
 
     return datetime.fromtimestamp(random_timestamp)
+
+
+def make_rng(seed, *parts):
+    """Return a Random seeded from ``seed`` and any extra identifying parts.
+
+    String seeds are hashed deterministically by ``random.Random``, so the same
+    (seed, parts) always produces the same stream regardless of process.
+    """
+    return random.Random(":".join(str(p) for p in (seed,) + parts))
+
+
+def pareto(rng, alpha, x_min=1.0):
+    """Draw from a Pareto (power-law) distribution with tail exponent ``alpha``."""
+    return x_min * (1.0 - rng.random()) ** (-1.0 / (alpha - 1.0))
+
+
+def coprime_multiplier(n):
+    """Return a large multiplier coprime with ``n`` for scattering ranks to ids."""
+    multiplier = 2654435761 % max(n, 2) or 1
+    while math.gcd(multiplier, n) != 1:
+        multiplier += 1
+    return multiplier
+
+
+def popular_user(rng, num_users, alpha, multiplier):
+    """Pick a user id with power-law popularity.
+
+    Rank 1 is the most popular; ranks are scattered over the id space with a
+    fixed multiplicative bijection so popular users aren't all low ids.
+    """
+    rank = min(int(pareto(rng, alpha)), num_users)
+    return ((rank - 1) * multiplier) % num_users + 1
+
+
+def fake_sentence(rng, max_length):
+    """Build a sentence of lexicon words no longer than ``max_length``."""
+    words = rng.choices(WORDS, k=rng.randint(4, 24))
+    sentence = " ".join(words).capitalize() + "."
+    return sentence[:max_length]
+
+
+def bursty_timestamps(rng, count, start, end, mean_gap_seconds=180):
+    """Yield ``count`` timestamps between ``start`` and ``end`` that arrive in bursts.
+
+    Posting sessions start uniformly over the window; within a session the
+    gaps between posts are exponential, and session length is power-law.
+    """
+    span = (end - start).total_seconds()
+    emitted = 0
+
+    while emitted < count:
+        moment = start + timedelta(seconds=rng.uniform(0, span))
+        session_length = min(int(pareto(rng, 2.2)), count - emitted)
+
+        for _ in range(session_length):
+            if moment > end:
+                break
+            yield moment
+            emitted += 1
+            moment += timedelta(seconds=rng.expovariate(1.0 / mean_gap_seconds))
@@ -0,0 +1,348 @@
+"""An in-memory index of the follow graph.
+
+The ``follows`` table is loaded into two compressed sparse row (CSR)
+adjacency structures, one per direction, each three flat int64 arrays:
+
+    nodes    sorted ids of users with at least one edge
+    offsets  row i's targets are targets[offsets[i]:offsets[i + 1]]
+    targets  every row's user ids, sorted within the row
+
+That's roughly 16 bytes per follow in each direction, versus hundreds for
+ORM objects, and finding a row is one bisect. Both directions are streamed
+straight off their covering indexes, so a load takes seconds even for
+millions of follows.
+
+Follows and unfollows after the load are applied as deltas: the index
+subscribes to ``follows:following`` invalidations (see invalidation.py),
+which name the follower whose row changed, in this process or any other.
+``sync`` then re-reads just those followers' rows with one query and
+records the difference as added/removed sets over the arrays. Syncs run
+one at a time (as loads do), so a slower sync can't apply an older read of
+a row over a newer one. Once the
+deltas grow past COMPACT_AFTER edges the arrays are rebuilt from memory.
+
+Who-to-follow suggestions are friends of friends: the users followed by the
+most of the people you follow, that you don't already follow. They're
+computed when first asked for and kept in an LRU of at most
+FOLLOW_GRAPH_SUGGESTIONS_CACHE users until the follows of the user or of
+anyone they follow change. (Precomputing them for everyone would have every
+worker process doing it for every user, and holding all of it.) A result
+computed while a follow change came in is returned but not kept, since it
+may predate the change.
+"""
+
+import argparse
+import heapq
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import Counter, OrderedDict
+
+from invalidation import bus
+from models import db, Follows
+
+# Rows fetched per round trip while loading
+LOAD_BATCH = 10000
+
+# Rebuild the arrays once this many edges are held as deltas
+COMPACT_AFTER = 100000
+
+SUGGESTION_LIMIT = 30
+
+# Users whose suggestions are kept, per process
+DEFAULT_SUGGESTIONS_CACHE = 10000
+
+# Bound the work per suggestion: friends considered, and their follows each
+MAX_FRIENDS = 500
+MAX_FRIEND_FOLLOWS = 1000
+
+
+class Adjacency:
+    """One direction of the graph as CSR arrays."""
+
+    def __init__(self, nodes=None, offsets=None, targets=None):
+        self.nodes = nodes if nodes is not None else array('q')
+        self.offsets = offsets if offsets is not None else array('q', [0])
+        self.targets = targets if targets is not None else array('q')
+
+    @classmethod
+    def build(cls, edges):
+        """Build from (source, target) pairs sorted by source then target."""
+        adjacency = cls()
+        nodes, offsets, targets = adjacency.nodes, adjacency.offsets, adjacency.targets
+        for source, target in edges:
+            if not nodes or nodes[-1] != source:
+                if nodes:
+                    offsets.append(len(targets))
+                nodes.append(source)
+            targets.append(target)
+        if nodes:
+            offsets.append(len(targets))
+        return adjacency
+
+    def row(self, node):
+        """``node``'s sorted targets, as a view into the arrays."""
+        i = bisect_left(self.nodes, node)
+        if i == len(self.nodes) or self.nodes[i] != node:
+            return memoryview(self.targets)[0:0]
+        return memoryview(self.targets)[self.offsets[i]:self.offsets[i + 1]]
+
+    def has_edge(self, node, target):
+        row = self.row(node)
+        i = bisect_left(row, target)
+        return i < len(row) and row[i] == target
+
+    def edges(self):
+        for i, node in enumerate(self.nodes):
+            for target in self.targets[self.offsets[i]:self.offsets[i + 1]]:
+                yield node, target
+
+    def __len__(self):
+        return len(self.targets)
+
+
+class Direction:
+    """An Adjacency plus the edges added and removed since it was built."""
+
+    def __init__(self, base):
+        self.base = base
+        self.added = {}
+        self.removed = {}
+        self.delta_size = 0
+
+    def add(self, node, target):
+        removed = self.removed.get(node)
+        if removed and target in removed:
+            removed.discard(target)
+        else:
+            self.added.setdefault(node, set()).add(target)
+        self.delta_size += 1
+
+    def remove(self, node, target):
+        added = self.added.get(node)
+        if added and target in added:
+            added.discard(target)
+        else:
+            self.removed.setdefault(node, set()).add(target)
+        self.delta_size += 1
+
+    def has_edge(self, node, target):
+        if target in self.added.get(node, ()):
+            return True
+        return target not in self.removed.get(node, ()) and self.base.has_edge(node, target)
+
+    def count(self, node):
+        return (len(self.base.row(node)) + len(self.added.get(node, ()))
+                - len(self.removed.get(node, ())))
+
+    def row(self, node):
+        """``node``'s targets, sorted."""
+        added = self.added.get(node)
+        removed = self.removed.get(node)
+        if not added and not removed:
+            return self.base.row(node)
+        row = [t for t in self.base.row(node) if not removed or t not in removed]
+        if added:
+            row = sorted(row + list(added))
+        return row
+
+    def edges(self):
+        nodes = sorted(set(self.base.nodes).union(self.added))
+        for node in nodes:
+            for target in self.row(node):
+                yield node, target
+
+    def compacted(self):
+        return Direction(Adjacency.build(self.edges()))
+
+
+class FollowGraph:
+    """The follow graph in memory, kept current from invalidations."""
+
+    def __init__(self):
+        self.following = Direction(Adjacency())
+        self.followers = Direction(Adjacency())
+        self.loaded = False
+        self.dirty = set()
+        self.reload_needed = False
+        # user_id -> suggestions, least recently used first
+        self.suggested = OrderedDict()
+        self.max_suggested = DEFAULT_SUGGESTIONS_CACHE
+        # Bumped whenever cached suggestions are dropped, so a computation
+        # that overlapped the change isn't stored
+        self.generation = 0
+        self.lock = threading.RLock()
+        self.load_lock = threading.Lock()
+        self.subscription = None
+
+    def init_app(self, app):
+        self.max_suggested = app.config.setdefault(
+            'FOLLOW_GRAPH_SUGGESTIONS_CACHE', DEFAULT_SUGGESTIONS_CACHE)
+        if self.subscription is None:
+            self.subscription = bus.subscribe('follows:following', self.invalidate)
+
+    def invalidate(self, tag):
+        parts = tag.split(':')
+        with self.lock:
+            if len(parts) == 3 and parts[2].isdigit():
+                self.dirty.add(int(parts[2]))
+            else:
+                # Too broad to name a row (e.g. a whole account's deletion)
+                self.reload_needed = True
+
+    ######################################################################
+    # Loading and keeping current
+
+    @staticmethod
+    def _stream(conn, source, target):
+        """(source, target) pairs from the follows table, in order."""
+        query = db.select([source, target]).order_by(source, target)
+        result = conn.execution_options(stream_results=True).execute(query)
+        while True:
+            rows = result.fetchmany(LOAD_BATCH)
+            if not rows:
+                break
+            for row in rows:
+                yield row[0], row[1]
+
+    def load(self):
+        """(Re)build both directions from the follows table.
+
+        Both directions are read in one repeatable-read transaction so they
+        agree. Invalidations that arrive during the load are kept and
+        applied by the next ``sync``, so nothing committed meanwhile is lost.
+        """
+        with self.lock:
+            self.dirty.clear()
+            self.reload_needed = False
+
+        follower, followed = Follows.user_following_id, Follows.user_being_followed_id
+        with db.engine.connect() as conn:
+            conn = conn.execution_options(isolation_level='REPEATABLE READ')
+            with conn.begin():
+                following = Direction(Adjacency.build(self._stream(conn, follower, followed)))
+                followers = Direction(Adjacency.build(self._stream(conn, followed, follower)))
+
+        with self.lock:
+            self.following, self.followers = following, followers
+            self.suggested.clear()
+            self.generation += 1
+            self.loaded = True
+
+    def sync(self):
+        """Load if needed, then apply pending follow changes."""
+        with self.load_lock:
+            if not self.loaded or self.reload_needed:
+                self.load()
+
+            # Rows are read outside self.lock so queries aren't blocked, but
+            # under load_lock, so whichever sync takes a follower last also
+            # reads their row last and its snapshot is the one applied
+            with self.lock:
+                dirty, self.dirty = self.dirty, set()
+            if dirty:
+                self._refresh(dirty)
+
+        if self.following.delta_size + self.followers.delta_size > COMPACT_AFTER:
+            self.compact()
+
+    def _refresh(self, follower_ids):
+        current = {uid: set() for uid in follower_ids}
+        rows = (db.session.query(Follows.user_following_id, Follows.user_being_followed_id)
+                .filter(Follows.user_following_id.in_(follower_ids)))
+        for follower_id, followed_id in rows:
+            current[follower_id].add(followed_id)
+
+        with self.lock:
+            for follower_id, now in current.items():
+                before = set(self.following.row(follower_id))
+                for followed_id in now - before:
+                    self.following.add(follower_id, followed_id)
+                    self.followers.add(followed_id, follower_id)
+                for followed_id in before - now:
+                    self.following.remove(follower_id, followed_id)
+                    self.followers.remove(followed_id, follower_id)
+                if now != before:
+                    # Their suggestions change, and so do their followers'
+                    self.generation += 1
+                    self.suggested.pop(follower_id, None)
+                    for user_id in self.followers.row(follower_id):
+                        self.suggested.pop(user_id, None)
+
+    def compact(self):
+        with self.lock:
+            self.following = self.following.compacted()
+            self.followers = self.followers.compacted()
+
+    ######################################################################
+    # Queries
+
+    def is_following(self, follower_id, followed_id):
+        return self.following.has_edge(follower_id, followed_id)
+
+    def following_count(self, user_id):
+        return self.following.count(user_id)
+
+    def followers_count(self, user_id):
+        return self.followers.count(user_id)
+
+    def mutuals(self, user_id):
+        """Users that ``user_id`` follows and who follow them back."""
+        with self.lock:
+            return [uid for uid in self.following.row(user_id)
+                    if self.following.has_edge(uid, user_id)]
+
+    def suggestions_for(self, user_id, limit=SUGGESTION_LIMIT):
+        """[(user_id, how many people you follow follow them)], best first."""
+        with self.lock:
+            cached = self.suggested.get(user_id)
+            if cached is not None:
+                self.suggested.move_to_end(user_id)
+                return cached[:limit]
+            generation = self.generation
+
+        suggestions = self._friends_of_friends(user_id)
+
+        with self.lock:
+            if self.generation == generation:
+                self.suggested[user_id] = suggestions
+                while len(self.suggested) > self.max_suggested:
+                    self.suggested.popitem(last=False)
+        return suggestions[:limit]
+
+    def _friends_of_friends(self, user_id):
+        with self.lock:
+            friends = self.following.row(user_id)
+            counts = Counter()
+            for friend in friends[:MAX_FRIENDS]:
+                counts.update(self.following.row(friend)[:MAX_FRIEND_FOLLOWS])
+
+            counts.pop(user_id, None)
+            for friend in friends:
+                counts.pop(friend, None)
+
+        return heapq.nsmallest(SUGGESTION_LIMIT, counts.items(),
+                               key=lambda item: (-item[1], item[0]))
+
+
+graph = FollowGraph()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load the follow graph and report on it.")
+    parser.add_argument('command', choices=['stats'])
+    args = parser.parse_args(argv)
+
+    from app import app
+
+    with app.app_context():
+        started = time.perf_counter()
+        graph.load()
+        print(f"Loaded {len(graph.following.base)} follows for "
+              f"{len(graph.following.base.nodes)} users in "
+              f"{time.perf_counter() - started:.2f}s")
+
+
+if __name__ == '__main__':
+    main()
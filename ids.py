@@ -0,0 +1,148 @@
+"""Time-ordered 64-bit ids ("snowflake" style) for messages.
+
+Ids are generated in-process, with no database round trip, and sort in the
+order they were created. The layout (most to least significant bits) is:
+
+    41 bits  milliseconds since EPOCH (good for ~69 years)
+    10 bits  node id (one per process/worker; see ``default_node_id``)
+    12 bits  per-millisecond sequence (4096 ids per ms per node)
+
+The result always fits in a signed BIGINT.
+"""
+
+import os
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+
+# 2020-01-01T00:00:00Z in milliseconds
+EPOCH_MS = 1577836800000
+EPOCH = datetime(2020, 1, 1)
+
+NODE_BITS = 10
+SEQUENCE_BITS = 12
+
+MAX_NODE = (1 << NODE_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+TIMESTAMP_SHIFT = NODE_BITS + SEQUENCE_BITS
+NODE_SHIFT = SEQUENCE_BITS
+
+
+def default_node_id():
+    """Node id from WARBLER_NODE_ID, falling back to the process id.
+
+    Set WARBLER_NODE_ID explicitly (0-1023, unique per worker process) in
+    production; the pid fallback can collide across hosts.
+    """
+    if 'WARBLER_NODE_ID' in os.environ:
+        return int(os.environ['WARBLER_NODE_ID']) & MAX_NODE
+    return os.getpid() & MAX_NODE
+
+
+class IdGenerator:
+    """Thread-safe generator of time-ordered ids for one node."""
+
+    def __init__(self, node_id, clock=time.time, random_start=False):
+        if not 0 <= node_id <= MAX_NODE:
+            raise ValueError(f"node_id must be between 0 and {MAX_NODE}")
+
+        self.node_id = node_id
+        self.clock = clock
+        # Start each millisecond at a random sequence number, for node ids
+        # that several processes share (see ``next_id_for``)
+        self.random_start = random_start
+        self.last_ms = -1
+        self.sequence = 0
+        self.lock = threading.Lock()
+
+    def _now_ms(self):
+        return int(self.clock() * 1000) - EPOCH_MS
+
+    def next_id(self):
+        """Return the next id. Blocks briefly if the clock moves backwards
+        or this millisecond's sequence is exhausted."""
+        with self.lock:
+            now = self._now_ms()
+
+            # Never hand out an id older than one we already issued
+            while now < self.last_ms:
+                time.sleep((self.last_ms - now) / 1000)
+                now = self._now_ms()
+
+            if now == self.last_ms:
+                self.sequence = (self.sequence + 1) & MAX_SEQUENCE
+                if self.sequence == 0:
+                    # Sequence exhausted: wait for the next millisecond
+                    while now <= self.last_ms:
+                        now = self._now_ms()
+            else:
+                self.sequence = random.randint(0, MAX_SEQUENCE) if self.random_start else 0
+
+            self.last_ms = now
+            return (now << TIMESTAMP_SHIFT) | (self.node_id << NODE_SHIFT) | self.sequence
+
+
+def timestamp_of(snowflake_id):
+    """Return the (naive UTC) datetime encoded in an id."""
+    return EPOCH + timedelta(milliseconds=snowflake_id >> TIMESTAMP_SHIFT)
+
+
+def node_of(snowflake_id):
+    """Return the node id encoded in an id."""
+    return (snowflake_id >> NODE_SHIFT) & MAX_NODE
+
+
+def min_id_for(moment):
+    """Smallest possible id issued at or after ``moment`` (naive UTC).
+
+    Useful for turning a time cursor into a primary-key range.
+    """
+    ms = int((moment - EPOCH).total_seconds() * 1000)
+    return max(ms, 0) << TIMESTAMP_SHIFT
+
+
+_generator = None
+_generator_pid = None
+
+
+def next_id():
+    """Return an id from this process's default generator.
+
+    The generator is recreated after a fork so child workers don't share
+    sequence state (and, with the pid fallback, get their own node id).
+    """
+    global _generator, _generator_pid
+
+    if _generator is None or _generator_pid != os.getpid():
+        _generator = IdGenerator(default_node_id())
+        _generator_pid = os.getpid()
+
+    return _generator.next_id()
+
+
+_node_generators = {}
+_node_generators_pid = None
+
+
+def next_id_for(node_id):
+    """Return an id carrying ``node_id`` chosen by the caller.
+
+    Sharding (see sharding.py) puts the author's bucket in the node bits so
+    a message's shard can be read off its id. Several processes can then
+    use the same node id, so these generators start each millisecond at a
+    random sequence number; a clash needs two processes, one bucket, the
+    same millisecond and the same random start.
+    """
+    global _node_generators_pid
+
+    if _node_generators_pid != os.getpid():
+        _node_generators.clear()
+        _node_generators_pid = os.getpid()
+
+    generator = _node_generators.get(node_id)
+    if generator is None:
+        generator = _node_generators.setdefault(
+            node_id, IdGenerator(node_id, random_start=True))
+    return generator.next_id()
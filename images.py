@@ -0,0 +1,236 @@
+"""Uploaded avatars and header images.
+
+An upload is decoded once and resized to a few fixed sizes, each saved as a
+JPEG named after the upload's content hash:
+
+    <MEDIA_ROOT>/<hash>-original        the bytes as uploaded
+    <MEDIA_ROOT>/<hash>-timeline.jpg    96x96 avatar, timelines
+    <MEDIA_ROOT>/<hash>-card.jpg        256x256 avatar, cards and profiles
+    <MEDIA_ROOT>/<hash>-hero.jpg        1500x500 header, profile page
+    <MEDIA_ROOT>/<hash>-banner.jpg      600x200 header, user cards
+
+``hash`` is the first 32 hex digits of the upload's SHA-256, so a file's
+name changes whenever its content does: ``/media/`` responses are marked
+immutable and browsers never need to ask for them again. Identical uploads
+share files.
+
+The request only checks the image header and saves the original; resizing
+runs on a process pool (IMAGE_WORKERS processes). A size that's asked for
+before its resize is done is made on the spot from the original.
+
+User.image_url / header_image_url hold the ``card`` / ``hero`` URL, and
+templates pick other sizes with the ``sized`` filter, which leaves external
+URLs alone:
+
+    <img src="{{ msg.user.image_url | sized('timeline') }}">
+"""
+
+import hashlib
+import io
+import logging
+import os
+import re
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+from flask import abort, send_from_directory
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+# Size name -> (width, height); images are cropped to fill exactly
+AVATAR_SIZES = {'timeline': (96, 96), 'card': (256, 256)}
+HEADER_SIZES = {'hero': (1500, 500), 'banner': (600, 200)}
+SIZES = {**AVATAR_SIZES, **HEADER_SIZES}
+
+ALLOWED_FORMATS = {'JPEG', 'PNG', 'GIF', 'WEBP'}
+
+# Refuse anything bigger, before decoding a single pixel
+MAX_UPLOAD_BYTES = 10 * 1024 * 1024
+MAX_PIXELS = 40 * 1000 * 1000
+
+JPEG_QUALITY = 85
+
+MEDIA_URL = '/media/'
+MEDIA_NAME = re.compile(r'^([0-9a-f]{32})-(\w+)\.jpg$')
+
+
+class InvalidImage(ValueError):
+    """The upload isn't an image we accept."""
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()[:32]
+
+
+def variant_name(digest, size):
+    return f"{digest}-{size}.jpg"
+
+
+def media_url(digest, size):
+    return f"{MEDIA_URL}{variant_name(digest, size)}"
+
+
+def sized(url, size):
+    """The URL of ``size`` for an uploaded image URL; other URLs unchanged."""
+    if url and url.startswith(MEDIA_URL):
+        match = MEDIA_NAME.match(url[len(MEDIA_URL):])
+        if match and size in SIZES:
+            return media_url(match.group(1), size)
+    return url
+
+
+def check_image(data):
+    """Reject uploads that aren't a reasonably sized image we accept.
+
+    Only the header is parsed, so this is cheap enough for the request.
+    """
+    if len(data) > MAX_UPLOAD_BYTES:
+        raise InvalidImage("Image files must be under 10MB.")
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            image_format = image.format
+            width, height = image.size
+    except Exception:
+        raise InvalidImage("That file isn't an image.")
+
+    if image_format not in ALLOWED_FORMATS:
+        raise InvalidImage("Images must be JPEG, PNG, GIF or WebP.")
+    if width * height > MAX_PIXELS:
+        raise InvalidImage("That image is too large.")
+
+
+def write_atomic(path, data):
+    """Write a file so readers never see it half-written."""
+    # A unique temp file, so threads (or hosts sharing the media root) that
+    # write the same path at once don't write into each other's
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                               prefix=f".{os.path.basename(path)}.", suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            # mkstemp makes it private; media is served to everyone
+            os.fchmod(f.fileno(), 0o644)
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def resize(media_root, digest, sizes):
+    """Decode ``digest``'s original once and write each of ``sizes``.
+
+    Runs in a pool process. Returns the names written.
+    """
+    Image.MAX_IMAGE_PIXELS = MAX_PIXELS
+
+    with open(os.path.join(media_root, f"{digest}-original"), 'rb') as f:
+        image = Image.open(f)
+        # JPEGs can decode straight at a fraction of full size, as long as
+        # that's still at least as big as the largest output
+        image.draft('RGB', (max(SIZES[size][0] for size in sizes),
+                            max(SIZES[size][1] for size in sizes)))
+        image.load()
+
+    # Respect camera orientation, and flatten transparency onto white
+    image = ImageOps.exif_transpose(image)
+    if image.mode in ('RGBA', 'LA', 'P'):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, 'white')
+        background.paste(image, mask=image.split()[-1])
+        image = background
+    else:
+        image = image.convert('RGB')
+
+    written = []
+    for size in sizes:
+        thumb = ImageOps.fit(image, SIZES[size], method=Image.LANCZOS)
+
+        out = io.BytesIO()
+        thumb.save(out, 'JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)
+        write_atomic(os.path.join(media_root, variant_name(digest, size)), out.getvalue())
+        written.append(size)
+
+    return written
+
+
+class ImageStore:
+    """Saves uploads and hands their resizing to a process pool."""
+
+    def __init__(self, app=None):
+        self.media_root = None
+        self.workers = 2
+        self.pool = None
+        self.pool_pid = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.media_root = app.config.setdefault(
+            'MEDIA_ROOT', os.path.join(app.root_path, 'media'))
+        self.workers = app.config.setdefault('IMAGE_WORKERS', 2)
+        os.makedirs(self.media_root, exist_ok=True)
+
+        app.add_template_filter(sized)
+        app.add_url_rule(f"{MEDIA_URL}<name>", 'media', self.serve)
+
+    def _pool(self):
+        # One pool per process; a pool inherited over fork is unusable
+        if self.pool is None or self.pool_pid != os.getpid():
+            self.pool = ProcessPoolExecutor(max_workers=self.workers)
+            self.pool_pid = os.getpid()
+        return self.pool
+
+    def save(self, data, sizes):
+        """Store an upload and queue its resizes; return its content hash.
+
+        Raises InvalidImage for anything that isn't an acceptable image.
+        """
+        check_image(data)
+        digest = content_hash(data)
+
+        original = os.path.join(self.media_root, f"{digest}-original")
+        if not os.path.exists(original):
+            write_atomic(original, data)
+
+        missing = [size for size in sizes
+                   if not os.path.exists(os.path.join(self.media_root, variant_name(digest, size)))]
+        if missing:
+            future = self._pool().submit(resize, self.media_root, digest, missing)
+            future.add_done_callback(self._log_failure)
+
+        return digest
+
+    @staticmethod
+    def _log_failure(future):
+        if future.exception() is not None:
+            logger.error("Resizing an upload failed", exc_info=future.exception())
+
+    def save_avatar(self, data):
+        """Store an uploaded avatar; return the URL to save on the user."""
+        return media_url(self.save(data, AVATAR_SIZES), 'card')
+
+    def save_header(self, data):
+        """Store an uploaded header image; return the URL to save on the user."""
+        return media_url(self.save(data, HEADER_SIZES), 'hero')
+
+    def serve(self, name):
+        """Serve a resized image, forever cacheable."""
+        match = MEDIA_NAME.match(name)
+        if not match or match.group(2) not in SIZES:
+            abort(404)
+
+        path = os.path.join(self.media_root, name)
+        if not os.path.exists(path):
+            # Asked for before the pool got to it: make it now
+            digest = match.group(1)
+            if not os.path.exists(os.path.join(self.media_root, f"{digest}-original")):
+                abort(404)
+            self._pool().submit(resize, self.media_root, digest, [match.group(2)]).result()
+
+        response = send_from_directory(self.media_root, name, mimetype='image/jpeg')
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+        return response
+
+
+images = ImageStore()
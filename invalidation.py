@@ -0,0 +1,450 @@
+"""Cross-process cache invalidation by tag.
+
+Anything cached in a worker process (rows, query results, rendered
+fragments) is tagged with what it was built from, and subscribes to those
+tags on the bus. Writes publish tags once their transaction commits, and
+every process drops what they cover, so a gunicorn worker doesn't go on
+serving a profile another worker just edited.
+
+Tags are ``:``-separated paths, most general first, and cover each other in
+both directions: publishing ``users:5`` reaches subscribers of ``users``
+and ``users:5``, and publishing ``users`` reaches everything under it.
+``row_tags`` knows the tags for each table's rows:
+
+    users     users:<id>
+    messages  messages:<id>, messages:user:<user_id>
+    follows   follows:following:<follower id>, follows:followers:<followed id>
+    likes     likes:user:<user_id>, likes:message:<message_id>
+
+ORM changes are tagged automatically once ``watch`` is listening to the
+session; bulk ``Query.delete``/Core writes made through the session call
+``mark(session, *tags)``, and writes outside any session call
+``bus.publish(*tags)`` after committing.
+
+Subscribers in the publishing process are told straight away; other
+processes get batches, sent at most every INVALIDATION_BATCH_INTERVAL
+seconds, through the backend named by INVALIDATION_BACKEND:
+
+- ``memory``: an in-process hub shared by buses in the same process (tests)
+- ``socket``: UNIX datagram sockets in INVALIDATION_SOCKET_DIR, one per
+  process, for every worker on a single host
+- ``postgres``: ``pg_notify`` plus a LISTEN thread in each process, for
+  workers spread over several hosts
+"""
+
+import json
+import logging
+import os
+import select
+import socket
+import threading
+import uuid
+from collections import defaultdict
+
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+# Session.info key holding tags to publish when the session commits
+SESSION_TAGS = 'invalidation_tags'
+
+# Above this many tags, a batch is collapsed to table-level tags
+MAX_BATCH_TAGS = 500
+
+NOTIFY_CHANNEL = 'warbler_invalidate'
+
+
+def row_tags(table_name, row):
+    """Tags for one row of ``table_name``; ``row`` maps column names to values."""
+    if table_name == 'users':
+        return [f"users:{row['id']}"]
+    if table_name == 'messages':
+        return [f"messages:{row['id']}", f"messages:user:{row['user_id']}"]
+    if table_name == 'follows':
+        return [f"follows:following:{row['user_following_id']}",
+                f"follows:followers:{row['user_being_followed_id']}"]
+    if table_name == 'likes':
+        return [f"likes:user:{row['user_id']}", f"likes:message:{row['message_id']}"]
+    return [table_name]
+
+
+def covers(a, b):
+    """True if tags ``a`` and ``b`` are the same or one is under the other."""
+    return a == b or a.startswith(b + ':') or b.startswith(a + ':')
+
+
+def collapse(tags, limit=MAX_BATCH_TAGS):
+    """Bound a batch's size by widening it to table-level tags if needed."""
+    if len(tags) <= limit:
+        return set(tags)
+    return {tag.split(':', 1)[0] for tag in tags}
+
+
+def chunk_payloads(origin, tags, max_bytes):
+    """Split ``tags`` into JSON messages no larger than ``max_bytes`` each."""
+    chunk = []
+    size = 0
+    for tag in sorted(tags):
+        if chunk and size + len(tag) + 4 > max_bytes - 100:
+            yield json.dumps({'origin': origin, 'tags': chunk})
+            chunk, size = [], 0
+        chunk.append(tag)
+        size += len(tag) + 4
+    if chunk:
+        yield json.dumps({'origin': origin, 'tags': chunk})
+
+
+##############################################################################
+# Backends
+#
+# A backend sends encoded batches to every other process and calls
+# ``deliver(payload)`` with each batch received.
+
+
+class MemoryHub:
+    """Connects the MemoryBackends of several buses in one process."""
+
+    def __init__(self):
+        self.backends = []
+
+
+default_hub = MemoryHub()
+
+
+class MemoryBackend:
+    """Deliver batches synchronously to other buses on the same hub."""
+
+    max_payload = 1 << 20
+
+    def __init__(self, hub=default_hub):
+        self.hub = hub
+        self.deliver = None
+
+    def start(self, deliver):
+        self.deliver = deliver
+        self.hub.backends.append(self)
+
+    def send(self, payload):
+        for backend in list(self.hub.backends):
+            if backend is not self:
+                backend.deliver(payload)
+
+    def close(self):
+        if self in self.hub.backends:
+            self.hub.backends.remove(self)
+
+
+class SocketBackend:
+    """Exchange batches between processes on one host over UNIX sockets.
+
+    Each process binds a datagram socket in ``directory`` and sends to every
+    other socket found there; sockets left behind by dead processes are
+    removed the first time a send to them fails.
+    """
+
+    max_payload = 60000
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.sock = None
+        self.path = None
+
+    def start(self, deliver):
+        os.makedirs(self.directory, exist_ok=True)
+        self.path = os.path.join(self.directory, f"{os.getpid()}-{uuid.uuid4().hex[:8]}.sock")
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(self.path)
+
+        thread = threading.Thread(target=self._receive, args=(self.sock, deliver),
+                                  daemon=True, name='warbler-invalidate')
+        thread.start()
+
+    def _receive(self, sock, deliver):
+        while True:
+            try:
+                data = sock.recv(self.max_payload + 1000)
+            except OSError:
+                return  # closed
+            try:
+                deliver(data.decode())
+            except Exception:
+                logger.exception("Bad invalidation message")
+
+    def send(self, payload):
+        data = payload.encode()
+        out = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        # Never let a stuck worker hold up the one publishing
+        out.setblocking(False)
+        try:
+            for name in os.listdir(self.directory):
+                path = os.path.join(self.directory, name)
+                if path == self.path or not name.endswith('.sock'):
+                    continue
+                try:
+                    out.sendto(data, path)
+                except (ConnectionRefusedError, FileNotFoundError):
+                    # Nobody's listening: a worker that has gone away
+                    try:
+                        os.unlink(path)
+                    except FileNotFoundError:
+                        pass
+                except BlockingIOError:
+                    logger.warning("Invalidation socket %s is full; dropping a batch", path)
+        finally:
+            out.close()
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+
+
+class PostgresBackend:
+    """Exchange batches between processes on any host via LISTEN/NOTIFY."""
+
+    # NOTIFY payloads must be shorter than 8000 bytes
+    max_payload = 7900
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    def start(self, deliver):
+        thread = threading.Thread(target=self._listen, args=(deliver,),
+                                  daemon=True, name='warbler-invalidate')
+        thread.start()
+
+    def send(self, payload):
+        with self.engine.begin() as conn:
+            conn.execute("SELECT pg_notify(%s, %s)", (NOTIFY_CHANNEL, payload))
+
+    def _listen(self, deliver):
+        while True:
+            try:
+                self._listen_once(deliver)
+            except Exception:
+                logger.exception("LISTEN connection lost; reconnecting")
+                threading.Event().wait(1)
+
+    def _listen_once(self, deliver):
+        raw = self.engine.raw_connection()
+        try:
+            dbapi_conn = raw.connection
+            dbapi_conn.set_isolation_level(0)  # autocommit
+            dbapi_conn.cursor().execute(f"LISTEN {NOTIFY_CHANNEL}")
+
+            while True:
+                if select.select([dbapi_conn], [], [], 30) == ([], [], []):
+                    continue
+                dbapi_conn.poll()
+                while dbapi_conn.notifies:
+                    deliver(dbapi_conn.notifies.pop(0).payload)
+        finally:
+            raw.close()
+
+    def close(self):
+        pass
+
+
+##############################################################################
+# Bus
+
+
+class InvalidationBus:
+    """Publish and subscribe to invalidation tags across processes."""
+
+    def __init__(self, backend=None, batch_interval=0.05):
+        self.subscribers = defaultdict(list)
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.timer = None
+        self.batch_interval = batch_interval
+        self.backend = None
+        self.make_backend = None
+        self.origin = None
+        if backend is not None:
+            self.use(lambda: backend)
+
+    def use(self, make_backend):
+        """Start talking to other processes through ``make_backend()``."""
+        self.close()
+        self.make_backend = make_backend
+        self._start()
+
+    def _start(self):
+        # A fresh origin per process, so forked workers don't ignore each other
+        self.origin = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.pending = set()
+        self.timer = None
+        self.backend = self.make_backend()
+        self.backend.start(self._receive)
+
+    def restart_after_fork(self):
+        """Give a forked child its own backend (sockets and threads don't survive fork)."""
+        self.lock = threading.Lock()
+        if self.make_backend is not None:
+            self._start()
+
+    def close(self):
+        self.flush()
+        if self.backend is not None:
+            self.backend.close()
+            self.backend = None
+
+    def subscribe(self, tag, callback):
+        """Call ``callback(published_tag)`` for each published tag covering ``tag``.
+
+        ``tag=None`` subscribes to every tag. Returns a handle for
+        ``unsubscribe``.
+        """
+        with self.lock:
+            self.subscribers[tag].append(callback)
+        return (tag, callback)
+
+    def unsubscribe(self, handle):
+        tag, callback = handle
+        with self.lock:
+            callbacks = self.subscribers.get(tag, [])
+            if callback in callbacks:
+                callbacks.remove(callback)
+            if not callbacks:
+                self.subscribers.pop(tag, None)
+
+    def _notify(self, tags):
+        with self.lock:
+            subscribers = [(tag, list(callbacks))
+                           for tag, callbacks in self.subscribers.items()]
+
+        for published in tags:
+            for tag, callbacks in subscribers:
+                if tag is None or covers(tag, published):
+                    for callback in callbacks:
+                        try:
+                            callback(published)
+                        except Exception:
+                            logger.exception("Invalidation subscriber failed for %s", published)
+
+    def publish(self, *tags):
+        """Invalidate ``tags`` here now, and in other processes soon."""
+        tags = collapse(tags)
+        if not tags:
+            return
+
+        self._notify(tags)
+
+        if self.backend is None:
+            return
+
+        with self.lock:
+            self.pending |= tags
+            if self.batch_interval <= 0:
+                send_now = True
+            else:
+                send_now = False
+                if self.timer is None:
+                    self.timer = threading.Timer(self.batch_interval, self.flush)
+                    self.timer.daemon = True
+                    self.timer.start()
+
+        if send_now:
+            self.flush()
+
+    def flush(self):
+        """Send any batched tags to other processes."""
+        with self.lock:
+            tags, self.pending = self.pending, set()
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+        if not tags or self.backend is None:
+            return
+
+        for payload in chunk_payloads(self.origin, collapse(tags), self.backend.max_payload):
+            try:
+                self.backend.send(payload)
+            except Exception:
+                # Caches also expire entries on their own; don't fail the write
+                logger.exception("Couldn't send invalidations")
+
+    def _receive(self, payload):
+        message = json.loads(payload)
+        if message.get('origin') != self.origin:
+            self._notify(message['tags'])
+
+    ##########################################################################
+    # Session integration
+
+    def watch(self, session):
+        """Publish tags for whatever ``session`` changes, when it commits.
+
+        ``session`` may be a Session class, sessionmaker or scoped_session.
+        """
+        if event.contains(session, 'after_commit', self._after_commit):
+            return
+        event.listen(session, 'after_flush', self._after_flush)
+        event.listen(session, 'after_commit', self._after_commit)
+        event.listen(session, 'after_rollback', self._after_rollback)
+
+    def _after_flush(self, session, flush_context):
+        tags = set()
+        for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+            table = getattr(obj, '__table__', None)
+            if table is None:
+                continue
+            if obj in session.dirty and not session.is_modified(obj):
+                continue
+            tags.update(row_tags(table.name, ObjectRow(obj)))
+        mark(session, *tags)
+
+    def _after_commit(self, session):
+        tags = session.info.pop(SESSION_TAGS, None)
+        if tags:
+            self.publish(*tags)
+
+    def _after_rollback(self, session):
+        session.info.pop(SESSION_TAGS, None)
+
+
+class ObjectRow:
+    """Read an ORM object's column values by column name, for ``row_tags``."""
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __getitem__(self, column_name):
+        return getattr(self.obj, column_name)
+
+
+def mark(session, *tags):
+    """Publish ``tags`` when ``session`` next commits.
+
+    Use this for writes the ORM can't see, like ``Query.delete()``.
+    """
+    session.info.setdefault(SESSION_TAGS, set()).update(tags)
+
+
+bus = InvalidationBus()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=bus.restart_after_fork)
+
+
+def init_app(app, db):
+    """Pick the backend named by INVALIDATION_BACKEND and watch ``db.session``."""
+    name = app.config.setdefault('INVALIDATION_BACKEND', 'memory')
+    bus.batch_interval = app.config.setdefault('INVALIDATION_BATCH_INTERVAL', 0.05)
+
+    if name == 'postgres':
+        engine = db.get_engine(app)
+        bus.use(lambda: PostgresBackend(engine))
+    elif name == 'socket':
+        directory = app.config.setdefault('INVALIDATION_SOCKET_DIR', '/tmp/warbler-invalidate')
+        bus.use(lambda: SocketBackend(directory))
+    else:
+        bus.use(MemoryBackend)
+
+    bus.watch(db.session)
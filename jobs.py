@@ -0,0 +1,378 @@
+"""Background jobs for slow side effects.
+
+Handlers are plain functions registered with ``@job``; routes hand work off
+with ``queue.enqueue(name, **payload)`` (after committing their own changes)
+and return straight away. Where the work actually runs depends on the
+JOB_BACKEND config value:
+
+- ``inline``: run immediately in the caller (the default; used by the tests),
+  except jobs registered with ``background=True``, which are too slow to
+  hold up a request and go to a small in-process thread pool instead
+- ``thread``: run on an in-process thread pool, for single-node deployments
+- ``database``: insert a row in the ``jobs`` table for a separate worker
+  process pool to pick up, started with ``python jobs.py worker``
+
+The thread and database backends retry failed jobs with exponential
+backoff up to ``max_attempts``, skip jobs whose idempotency key they've
+already accepted, and apply backpressure: once JOB_MAX_PENDING jobs are
+waiting, ``enqueue`` runs the job in the caller instead, slowing producers
+down to what the workers can handle. The inline backend does none of
+that: it runs each job once, and its errors go to the caller.
+"""
+
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from multiprocessing import Process
+
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from models import db
+
+logger = logging.getLogger(__name__)
+
+# name -> (function, max_attempts)
+_registry = {}
+
+# Names of jobs that never run in the caller under the inline backend
+_background = set()
+
+
+class QueueFull(Exception):
+    """Raised by a backend that has JOB_MAX_PENDING jobs waiting."""
+
+
+def job(name=None, max_attempts=5, background=False):
+    """Register a function as a job handler under ``name``.
+
+    The handler receives the enqueued payload as keyword arguments and must
+    be safe to run more than once (it may be retried). ``background`` jobs
+    are run on a thread rather than in the caller by the inline backend.
+    """
+    def register(fn):
+        _registry[name or fn.__name__] = (fn, max_attempts)
+        if background:
+            _background.add(name or fn.__name__)
+        return fn
+    return register
+
+
+def backoff(attempts):
+    """Seconds to wait before retry number ``attempts`` (1, 2, 4, ... capped at 5 min)."""
+    return min(2 ** (attempts - 1), 300)
+
+
+class Job(db.Model):
+    """A queued job for the database backend."""
+    __tablename__ = 'jobs'
+
+    __table_args__ = (
+        # Workers poll for the oldest runnable pending job
+        db.Index('ix_jobs_status_run_at', 'status', 'run_at'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    # Registered handler name and its JSON-encoded keyword arguments
+    name = db.Column(db.String(100), nullable=False)
+    payload = db.Column(db.Text, nullable=False, default='{}')
+
+    # Enqueueing the same key twice only ever creates one job
+    idempotency_key = db.Column(db.String(200), unique=True)
+
+    # pending -> running -> done, or back to pending for a retry, or failed
+    status = db.Column(db.String(20), nullable=False, default='pending')
+
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=5)
+    last_error = db.Column(db.Text)
+
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    locked_at = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<Job #{self.id}: {self.name} {self.status}>"
+
+
+def run_handler(app, name, payload):
+    """Run one job in its own app context and session."""
+    fn, _ = _registry[name]
+    with app.app_context():
+        try:
+            fn(**payload)
+        finally:
+            db.session.remove()
+
+
+class InlineBackend:
+    """Run jobs immediately in the caller."""
+
+    def __init__(self, app):
+        self.app = app
+
+    def enqueue(self, name, payload, idempotency_key=None):
+        fn, _ = _registry[name]
+        fn(**payload)
+
+
+class ThreadPoolBackend:
+    """Run jobs on a bounded in-process thread pool."""
+
+    # How many idempotency keys to remember
+    MAX_KEYS = 10000
+
+    def __init__(self, app, workers=4, max_pending=1000):
+        self.app = app
+        self.executor = ThreadPoolExecutor(max_workers=workers,
+                                           thread_name_prefix='warbler-job')
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.seen_keys = OrderedDict()
+        self.lock = threading.Lock()
+
+    def enqueue(self, name, payload, idempotency_key=None):
+        if idempotency_key is not None:
+            with self.lock:
+                if idempotency_key in self.seen_keys:
+                    return
+                self.seen_keys[idempotency_key] = True
+                if len(self.seen_keys) > self.MAX_KEYS:
+                    self.seen_keys.popitem(last=False)
+
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.seen_keys.pop(idempotency_key, None)
+            raise QueueFull(name)
+
+        self.executor.submit(self._run, name, payload, 1)
+
+    def _run(self, name, payload, attempt):
+        _, max_attempts = _registry[name]
+        try:
+            run_handler(self.app, name, payload)
+        except Exception:
+            if attempt >= max_attempts:
+                logger.exception("Job %s failed after %d attempts", name, attempt)
+                self.slots.release()
+                return
+            logger.warning("Job %s failed (attempt %d), retrying", name, attempt,
+                           exc_info=True)
+            # Keep the slot while waiting to retry; the job is still pending
+            timer = threading.Timer(backoff(attempt), self.executor.submit,
+                                    (self._run, name, payload, attempt + 1))
+            timer.daemon = True
+            timer.start()
+            return
+
+        self.slots.release()
+
+
+class DatabaseBackend:
+    """Persist jobs in the ``jobs`` table for ``python jobs.py worker``."""
+
+    # Re-count pending jobs at most this often (seconds)
+    COUNT_INTERVAL = 1.0
+
+    def __init__(self, app, max_pending=100000):
+        self.app = app
+        self.max_pending = max_pending
+        self.pending = 0
+        self.counted_at = 0.0
+
+    def _pending_count(self):
+        now = time.monotonic()
+        if now - self.counted_at > self.COUNT_INTERVAL:
+            table = Job.__table__
+            self.pending = db.engine.execute(
+                db.select([db.func.count()]).where(table.c.status == 'pending')
+            ).scalar()
+            self.counted_at = now
+        return self.pending
+
+    def enqueue(self, name, payload, idempotency_key=None):
+        if self._pending_count() >= self.max_pending:
+            raise QueueFull(name)
+
+        _, max_attempts = _registry[name]
+        table = Job.__table__
+
+        # Use a separate short transaction so the job is visible to workers
+        # immediately, independent of the caller's session. A key that's
+        # already there (even one inserted concurrently) makes it a no-op
+        with db.engine.begin() as conn:
+            inserted = conn.execute(
+                pg_insert(table).values(
+                    name=name, payload=json.dumps(payload),
+                    idempotency_key=idempotency_key, max_attempts=max_attempts,
+                    status='pending', attempts=0, run_at=datetime.utcnow(),
+                    created_at=datetime.utcnow())
+                .on_conflict_do_nothing(index_elements=[table.c.idempotency_key])
+            ).rowcount
+
+        self.pending += inserted
+
+
+class JobQueue:
+    """Front door for enqueueing jobs; picks a backend from the app config."""
+
+    BACKENDS = {
+        'inline': InlineBackend,
+        'thread': ThreadPoolBackend,
+        'database': DatabaseBackend,
+    }
+
+    def __init__(self, app=None):
+        self.backend = None
+        self.background = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        name = app.config.setdefault('JOB_BACKEND', 'inline')
+        options = {}
+
+        if name == 'thread':
+            options['workers'] = app.config.setdefault('JOB_WORKERS', 4)
+        if name in ('thread', 'database'):
+            options['max_pending'] = app.config.setdefault('JOB_MAX_PENDING', 1000)
+
+        self.backend = self.BACKENDS[name](app, **options)
+
+        # Where the inline backend sends background jobs
+        self.background = None
+        if name == 'inline':
+            self.background = ThreadPoolBackend(
+                app, workers=app.config.setdefault('JOB_BACKGROUND_WORKERS', 1))
+
+    def enqueue(self, name, idempotency_key=None, **payload):
+        """Queue job ``name`` with ``payload`` as its keyword arguments.
+
+        If the backend is at capacity the job runs right here instead.
+        """
+        if name not in _registry:
+            raise KeyError(f"No job registered as {name!r}")
+
+        backend = self.backend
+        if name in _background and self.background is not None:
+            backend = self.background
+
+        try:
+            backend.enqueue(name, payload, idempotency_key=idempotency_key)
+        except QueueFull:
+            logger.warning("Job queue full; running %s inline", name)
+            _registry[name][0](**payload)
+
+
+queue = JobQueue()
+
+
+##############################################################################
+# Database worker
+
+
+def claim_job(conn, stale_after):
+    """Lock and mark running the next runnable job, or return None.
+
+    ``SKIP LOCKED`` lets many workers poll the same table without blocking
+    each other. Jobs stuck in ``running`` for longer than ``stale_after``
+    (a worker died mid-job) are treated as runnable again, unless they've
+    used up their attempts: those are marked failed, so a job that kills
+    its worker isn't run forever.
+    """
+    table = Job.__table__
+    now = datetime.utcnow()
+
+    stale = db.and_(table.c.status == 'running', table.c.locked_at < now - stale_after)
+    conn.execute(table.update()
+                 .where(db.and_(stale, table.c.attempts >= table.c.max_attempts))
+                 .values(status='failed', last_error="Worker died while running the job"))
+
+    runnable = db.or_(
+        db.and_(table.c.status == 'pending', table.c.run_at <= now),
+        db.and_(stale, table.c.attempts < table.c.max_attempts),
+    )
+    query = table.select().where(runnable).order_by(table.c.run_at).limit(1)
+    if conn.dialect.name == 'postgresql':
+        query = query.with_for_update(skip_locked=True)
+
+    row = conn.execute(query).first()
+    if row is None:
+        return None
+
+    conn.execute(table.update().where(table.c.id == row.id).values(
+        status='running', locked_at=now, attempts=row.attempts + 1))
+    return row
+
+
+def finish_job(row, error=None):
+    """Record the outcome of a claimed job."""
+    table = Job.__table__
+    attempts = row.attempts + 1
+
+    if error is None:
+        values = {'status': 'done', 'last_error': None}
+    elif attempts >= row.max_attempts:
+        values = {'status': 'failed', 'last_error': error}
+    else:
+        values = {'status': 'pending', 'last_error': error,
+                  'run_at': datetime.utcnow() + timedelta(seconds=backoff(attempts))}
+
+    with db.engine.begin() as conn:
+        conn.execute(table.update().where(table.c.id == row.id).values(**values))
+
+
+def work(app, poll_interval=1.0, stale_after=timedelta(minutes=10), stop=None):
+    """Claim and run jobs until ``stop`` is set (or forever)."""
+    # Handlers live in tasks.py; importing it registers them
+    import tasks  # noqa: F401
+
+    with app.app_context():
+        while stop is None or not stop.is_set():
+            with db.engine.begin() as conn:
+                row = claim_job(conn, stale_after)
+
+            if row is None:
+                time.sleep(poll_interval)
+                continue
+
+            try:
+                run_handler(app, row.name, json.loads(row.payload))
+            except Exception:
+                logger.warning("Job #%s %s failed", row.id, row.name, exc_info=True)
+                finish_job(row, traceback.format_exc())
+            else:
+                finish_job(row)
+
+
+def _worker_main(poll_interval):
+    # Each process gets its own app, engine and connection pool
+    from app import app
+    work(app, poll_interval)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run Warbler job workers.")
+    parser.add_argument('command', choices=['worker'])
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--poll-interval', type=float, default=1.0)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+
+    processes = [Process(target=_worker_main, args=(args.poll_interval,))
+                 for _ in range(args.processes)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,278 @@
+"""Write-behind buffering for likes.
+
+When a message goes viral, every like and unlike is a row lock and a commit
+on the same hot rows. With LIKE_WRITE_BEHIND on, ``like_message`` doesn't
+touch the ``likes`` table at all: it appends the intent ("user 7 likes
+message 42" or "... doesn't like ...") to a local append-only log, fsyncs
+it, and returns. A background thread then applies everything buffered every
+LIKE_FLUSH_INTERVAL seconds, coalesced to the last intent per (user,
+message), as one INSERT ... ON CONFLICT DO NOTHING and one DELETE per
+database, in a single commit.
+
+Intents are desired states rather than toggles, so replaying a log twice is
+harmless. Each worker process writes its own log under LIKE_BUFFER_DIR and
+holds an exclusive flock on it; when it first buffers a like, a process
+claims the logs of dead ones (any it can lock) and replays them. A log is
+deleted only once a flush that covered all of it has committed.
+
+Until its flush, a buffered intent lives in ``models.pending_likes``, which
+``User.has_liked``, ``User.liked_ids_among`` and the profile and likes pages
+merge over what's in the database, so people see their own likes and
+unlikes straight away. That map is per process: a request served by another
+worker sees the database until the flush, up to LIKE_FLUSH_INTERVAL later.
+So the like and unlike forms post the state they want rather than a toggle,
+and a page rendered from slightly stale likes still does what it showed.
+Other users' views catch up on the next flush too. The bulk
+``/api/v1/likes`` endpoints already batch their writes and stay synchronous.
+"""
+
+import atexit
+import fcntl
+import glob
+import json
+import logging
+import os
+import tempfile
+import threading
+
+from sqlalchemy import tuple_
+
+from models import db, insert_ignoring_duplicates, pending_likes, Likes, Message, User
+from sharding import router
+
+logger = logging.getLogger(__name__)
+
+LOG_PATTERN = 'likes-*.log'
+
+
+class LikeBuffer:
+    """Buffers like intents in a local log and applies them in batches."""
+
+    def __init__(self, app=None):
+        self.app = None
+        self.enabled = False
+        self.pid = None
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        self.thread = None
+
+        # (user_id, message_id) -> version of its newest intent
+        self.versions = {}
+        self.version = 0
+
+        self.log = None
+        # Logs (rotated or claimed) whose intents are all in pending_likes,
+        # deleted after the next successful flush
+        self.retired = []
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.close()
+        self.app = app
+        self.enabled = app.config.setdefault('LIKE_WRITE_BEHIND', False)
+        self.directory = app.config.setdefault(
+            'LIKE_BUFFER_DIR', os.path.join(app.root_path, 'like_buffer'))
+        # Seconds between flushes; 0 means only flush when flush() is called
+        self.interval = app.config.setdefault('LIKE_FLUSH_INTERVAL', 0.25)
+        self.fsync = app.config.setdefault('LIKE_BUFFER_FSYNC', True)
+
+    def start(self):
+        """Open this process's log, replay dead processes' logs, start flushing.
+
+        Run on the first like each process buffers, so forked workers each
+        get their own log and flusher.
+        """
+        if not self.enabled or self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            # State inherited over a fork belongs to the parent
+            self.pid = os.getpid()
+            self.log = None
+            self.retired = []
+            self.thread = None
+
+            os.makedirs(self.directory, exist_ok=True)
+            self._claim_orphans()
+            self._open_log()
+
+            if self.interval:
+                self.wakeup.clear()
+                self.stopping.clear()
+                self.thread = threading.Thread(target=self._run, name='like-buffer', daemon=True)
+                self.thread.start()
+                atexit.register(self.close)
+
+    def _open_log(self):
+        fd, path = tempfile.mkstemp(prefix=f"likes-{self.pid}-", suffix='.log',
+                                    dir=self.directory)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        self.log = (path, fd)
+
+    def _claim_orphans(self):
+        """Load every log no live process holds a lock on."""
+        for path in sorted(glob.glob(os.path.join(self.directory, LOG_PATTERN))):
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                continue
+
+            with os.fdopen(os.dup(fd)) as f:
+                for line in f:
+                    try:
+                        intent = json.loads(line)
+                    except ValueError:
+                        # The tail of a write cut short by a crash
+                        continue
+                    self._remember(intent['u'], intent['m'], intent['l'])
+            self.retired.append((path, fd))
+
+    def _remember(self, user_id, message_id, liked):
+        key = (user_id, message_id)
+        self.version += 1
+        self.versions[key] = self.version
+        pending_likes[key] = liked
+
+    def record(self, user_id, message_id, liked):
+        """Durably buffer that ``user_id`` does (or doesn't) like ``message_id``."""
+        self.start()
+        line = json.dumps({'u': user_id, 'm': message_id, 'l': liked}).encode() + b'\n'
+        with self.lock:
+            fd = self.log[1]
+            os.write(fd, line)
+            if self.fsync:
+                os.fsync(fd)
+            self._remember(user_id, message_id, liked)
+        self.wakeup.set()
+
+    def _run(self):
+        while not self.stopping.is_set():
+            self.wakeup.wait()
+            # Let a burst build up, then apply it in one go
+            self.stopping.wait(self.interval)
+            self.wakeup.clear()
+            if self.stopping.is_set():
+                return
+            try:
+                self.flush()
+            except Exception:
+                # Still in pending_likes and on disk; retried after the next interval
+                logger.exception("Couldn't apply buffered likes")
+                self.wakeup.set()
+
+    def flush(self):
+        """Apply every buffered intent; return how many were applied."""
+        with self.lock:
+            if not pending_likes:
+                return 0
+            batch = {key: (pending_likes[key], self.versions[key]) for key in pending_likes}
+            # New intents go to a fresh log; this one is covered by the batch
+            if self.log is not None:
+                self.retired.append(self.log)
+                self._open_log()
+            retired = list(self.retired)
+
+        with self.app.app_context():
+            try:
+                apply({key: liked for key, (liked, _) in batch.items()})
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+
+        with self.lock:
+            for key, (liked, version) in batch.items():
+                # Unless it's changed again since, it's in the database now
+                if self.versions.get(key) == version:
+                    del self.versions[key]
+                    pending_likes.pop(key, None)
+            for log in retired:
+                self.retired.remove(log)
+                _remove_log(*log)
+
+        return len(batch)
+
+    def close(self):
+        """Stop the flusher after a last flush; leave anything unapplied on disk."""
+        thread, self.thread = self.thread, None
+        if thread is not None:
+            self.stopping.set()
+            self.wakeup.set()
+            thread.join()
+
+        if self.pid == os.getpid():
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Couldn't apply buffered likes; they'll be replayed on restart")
+            with self.lock:
+                for path, fd in self.retired:
+                    os.close(fd)
+                if self.log is not None:
+                    if os.fstat(self.log[1]).st_size:
+                        os.close(self.log[1])
+                    else:
+                        _remove_log(*self.log)
+                self.retired = []
+                self.log = None
+
+        self.pid = None
+        self.versions.clear()
+        pending_likes.clear()
+
+
+def _remove_log(path, fd):
+    os.unlink(path)
+    os.close(fd)
+
+
+def apply(intents):
+    """Write {(user_id, message_id): liked} to the likes table. The caller commits.
+
+    Likes of messages or by users deleted since are dropped: ON CONFLICT
+    doesn't cover foreign keys, and one of them would fail every retry of
+    the whole batch.
+    """
+    likers = {user_id for (user_id, _), liked in intents.items() if liked}
+    users = {user_id for (user_id,) in
+             db.session.query(User.id).filter(User.id.in_(likers))} if likers else set()
+
+    if router.enabled:
+        groups = router.group_by_shard(intents, lambda key: router.shard_for_message(key[1]))
+    else:
+        groups = {None: list(intents)}
+
+    likes = Likes.__table__
+    for shard, keys in groups.items():
+        bind = router.engine(shard) if shard is not None else db.engine
+
+        to_like = [key for key in keys if intents[key]]
+        if to_like:
+            found = db.session.query(Message.id).filter(
+                Message.id.in_({message_id for _, message_id in to_like}))
+            if shard is not None:
+                found = found.set_shard(shard)
+            found = {message_id for (message_id,) in found}
+            insert_ignoring_duplicates(likes, [
+                {'user_id': user_id, 'message_id': message_id}
+                for user_id, message_id in sorted(to_like)
+                if message_id in found and user_id in users
+            ], returning='id', shard=shard)
+
+        to_unlike = [key for key in keys if not intents[key]]
+        if to_unlike:
+            db.session.execute(
+                likes.delete().where(tuple_(likes.c.user_id, likes.c.message_id).in_(to_unlike)),
+                bind=bind)
+
+    for user_id, message_id in intents:
+        Likes.mark_changed(user_id, [message_id])
+
+
+like_buffer = LikeBuffer()
@@ -0,0 +1,260 @@
+"""Live timeline updates over Server-Sent Events.
+
+``messages_add`` publishes each new message; every open ``/stream``
+connection whose user follows the author (or is the author) gets it pushed as
+an SSE event whose id is the message id. A reconnecting browser sends
+``Last-Event-ID`` and first receives whatever it missed, read from the
+database, so nothing is lost across reconnects or restarts.
+
+Publishing goes through a relay chosen by the LIVE_RELAY config value:
+
+- ``local``: an in-process broker; enough for a single worker process
+- ``postgres``: ``pg_notify`` on publish plus a LISTEN thread in each process
+  feeding its local broker, so every worker (and host) sees every message
+
+Each connection is one long-lived response that is idle almost all the time,
+so run the app on an evented worker (e.g. ``gunicorn -k gevent app:app``)
+where an idle connection costs a greenlet rather than an OS thread. The
+broker only uses ``threading`` primitives, which gevent patches.
+"""
+
+import json
+import logging
+import select
+import threading
+from collections import defaultdict, deque
+
+from images import sized
+from models import db, Follows, Message, User
+from sharding import router
+
+logger = logging.getLogger(__name__)
+
+# Seconds between keep-alive comments on an idle stream
+HEARTBEAT_INTERVAL = 15
+
+# Events buffered per connection before it's told to resync
+SUBSCRIBER_BUFFER = 100
+
+# Most missed messages replayed on reconnect
+MAX_REPLAY = 100
+
+NOTIFY_CHANNEL = 'warbler_live'
+
+
+def message_event(msg, user):
+    """The JSON-able payload sent to clients for one message."""
+    return {
+        'id': msg.id,
+        'text': msg.text,
+        'timestamp': msg.timestamp.isoformat(),
+        'user_id': user.id,
+        'username': user.username,
+        'image_url': sized(user.image_url, 'timeline'),
+    }
+
+
+def format_sse(data, event_id=None, event=None):
+    """Encode one Server-Sent Event."""
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    if event is not None:
+        lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data)}")
+    return "\n".join(lines) + "\n\n"
+
+
+class Subscriber:
+    """One open stream: the authors it wants and a bounded event buffer."""
+
+    def __init__(self, author_ids):
+        self.author_ids = set(author_ids)
+        self.events = deque()
+        self.overflowed = False
+        self.ready = threading.Condition()
+
+    def push(self, event):
+        with self.ready:
+            if len(self.events) >= SUBSCRIBER_BUFFER:
+                # A stalled client: drop its backlog and make it resync
+                self.events.clear()
+                self.overflowed = True
+            else:
+                self.events.append(event)
+            self.ready.notify()
+
+    def wait(self, timeout):
+        """Return buffered events (possibly none after ``timeout``)."""
+        with self.ready:
+            if not self.events and not self.overflowed:
+                self.ready.wait(timeout)
+            events = list(self.events)
+            self.events.clear()
+            return events
+
+
+class Broker:
+    """In-process pub/sub of new messages, indexed by author."""
+
+    def __init__(self):
+        self.by_author = defaultdict(set)
+        self.lock = threading.Lock()
+
+    def subscribe(self, author_ids):
+        subscriber = Subscriber(author_ids)
+        with self.lock:
+            for author_id in subscriber.author_ids:
+                self.by_author[author_id].add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            for author_id in subscriber.author_ids:
+                subscribers = self.by_author.get(author_id)
+                if subscribers is not None:
+                    subscribers.discard(subscriber)
+                    if not subscribers:
+                        del self.by_author[author_id]
+
+    def publish(self, event):
+        with self.lock:
+            subscribers = list(self.by_author.get(event['user_id'], ()))
+        for subscriber in subscribers:
+            subscriber.push(event)
+
+
+class LocalRelay:
+    """Deliver published events straight to this process's broker."""
+
+    def __init__(self, broker):
+        self.broker = broker
+
+    def publish(self, event):
+        self.broker.publish(event)
+
+
+class PostgresRelay:
+    """Fan events out to every process via Postgres LISTEN/NOTIFY."""
+
+    def __init__(self, broker, engine):
+        self.broker = broker
+        self.engine = engine
+        self.thread = threading.Thread(target=self._listen, daemon=True,
+                                       name='warbler-live-listen')
+        self.thread.start()
+
+    def publish(self, event):
+        with self.engine.begin() as conn:
+            conn.execute("SELECT pg_notify(%s, %s)", (NOTIFY_CHANNEL, json.dumps(event)))
+
+    def _listen(self):
+        while True:
+            try:
+                self._listen_once()
+            except Exception:
+                logger.exception("LISTEN connection lost; reconnecting")
+                threading.Event().wait(1)
+
+    def _listen_once(self):
+        raw = self.engine.raw_connection()
+        try:
+            dbapi_conn = raw.connection
+            dbapi_conn.set_isolation_level(0)  # autocommit
+            cursor = dbapi_conn.cursor()
+            cursor.execute(f"LISTEN {NOTIFY_CHANNEL}")
+
+            while True:
+                if select.select([dbapi_conn], [], [], HEARTBEAT_INTERVAL) == ([], [], []):
+                    continue
+                dbapi_conn.poll()
+                while dbapi_conn.notifies:
+                    notify = dbapi_conn.notifies.pop(0)
+                    self.broker.publish(json.loads(notify.payload))
+        finally:
+            raw.close()
+
+
+broker = Broker()
+relay = None
+
+
+def init_app(app):
+    """Pick the relay named by LIVE_RELAY ('local' or 'postgres')."""
+    global relay
+
+    if app.config.setdefault('LIVE_RELAY', 'local') == 'postgres':
+        relay = PostgresRelay(broker, db.get_engine(app))
+    else:
+        relay = LocalRelay(broker)
+
+
+def publish_message(msg):
+    """Push a newly committed message to everyone streaming its author."""
+    user = msg.user or User.query.get(msg.user_id)
+    relay.publish(message_event(msg, user))
+
+
+def missed_events(author_ids, last_event_id):
+    """Messages from ``author_ids`` newer than ``last_event_id``, oldest first."""
+    if router.enabled:
+        # Users stay in the main database, so no join: the messages come
+        # merged from the authors' shards and their authors in a second query
+        messages = (Message.query
+                    .filter(Message.user_id.in_(author_ids), Message.id > last_event_id)
+                    .order_by(Message.id.desc())
+                    .limit(MAX_REPLAY)
+                    .all())
+        users = {user.id: user for user in
+                 User.query.filter(User.id.in_({msg.user_id for msg in messages}))}
+        rows = [(msg, users[msg.user_id]) for msg in messages if msg.user_id in users]
+    else:
+        rows = (db.session.query(Message, User)
+                .join(User, User.id == Message.user_id)
+                .filter(Message.user_id.in_(author_ids), Message.id > last_event_id)
+                .order_by(Message.id.desc())
+                .limit(MAX_REPLAY)
+                .all())
+    return [message_event(msg, user) for msg, user in reversed(rows)]
+
+
+def event_stream(user_id, last_event_id=None):
+    """Generate the SSE body for ``user_id``'s live timeline."""
+    author_ids = {followed for (followed,) in db.session
+                  .query(Follows.user_being_followed_id)
+                  .filter(Follows.user_following_id == user_id)}
+    author_ids.add(user_id)
+
+    # Subscribe before replaying so nothing slips between the two
+    subscriber = broker.subscribe(author_ids)
+    replayed = set()
+
+    try:
+        # Tell the browser how long to wait before reconnecting (ms)
+        yield "retry: 3000\n\n"
+
+        if last_event_id is not None:
+            for event in missed_events(author_ids, last_event_id):
+                yield format_sse(event, event_id=event['id'])
+                replayed.add(event['id'])
+
+        # Don't hold a pooled connection for the life of the stream
+        db.session.remove()
+
+        while True:
+            events = subscriber.wait(HEARTBEAT_INTERVAL)
+
+            if subscriber.overflowed:
+                yield format_sse({}, event='resync')
+                return
+
+            if not events:
+                yield ": keep-alive\n\n"
+                continue
+
+            for event in events:
+                # Skip anything the replay already covered
+                if event['id'] not in replayed:
+                    yield format_sse(event, event_id=event['id'])
+    finally:
+        broker.unsubscribe(subscriber)
@@ -0,0 +1,219 @@
+"""@mentions and #hashtags.
+
+Message text is parsed once, when the message is posted, into two side
+tables in the main database (see models.Mentions and models.MessageTags):
+
+    mentions      (user_id, timestamp, message_id)  who was mentioned where
+    message_tags  (tag, timestamp, message_id)      which tags were used where
+
+Each is indexed in feed order, so ``/tags/<tag>`` and the mentions feed are
+keyset-paginated index range scans followed by one lookup of the page's
+messages by id, however many messages there are. The cursor is the
+(timestamp, id) of the last message on the previous page.
+
+Messages posted before this existed are indexed by the ``backfill_mentions``
+job, or:
+
+    python mentions.py backfill
+"""
+
+import argparse
+import re
+from datetime import datetime
+
+from models import db, Mentions, Message, MessageTags, User
+from sharding import router
+
+# A mention or tag starts at the beginning of the text or after a
+# character that can't be part of a word (so emails aren't mentions)
+MENTION = re.compile(r'(?<![\w@])@(\w{1,30})')
+HASHTAG = re.compile(r'(?<![\w#&])#(\w*[^\W\d_]\w*)')
+
+MAX_TAG_LENGTH = 140
+
+# Messages read and indexed per transaction by the backfill
+BACKFILL_CHUNK = 1000
+
+PAGE_SIZE = 20
+
+CURSOR_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def extract(text):
+    """The usernames mentioned and (lowercased) tags used in ``text``."""
+    usernames = set(MENTION.findall(text or ''))
+    tags = {tag.lower() for tag in HASHTAG.findall(text or '') if len(tag) <= MAX_TAG_LENGTH}
+    return usernames, tags
+
+
+def index_messages(messages):
+    """Add side-table rows for ``messages`` (id, text, user_id, timestamp).
+
+    Mentioned usernames are resolved with one query for the whole batch;
+    unknown usernames are ignored. The caller commits.
+    """
+    parsed = [(msg, *extract(msg.text)) for msg in messages]
+
+    usernames = set().union(*(names for _, names, _ in parsed)) if parsed else set()
+    user_ids = {}
+    if usernames:
+        user_ids = dict(db.session.query(User.username, User.id)
+                        .filter(User.username.in_(usernames)))
+
+    mention_rows = []
+    tag_rows = []
+    for msg, names, tags in parsed:
+        for user_id in {user_ids[name] for name in names if name in user_ids}:
+            mention_rows.append({'user_id': user_id, 'message_id': msg.id,
+                                 'timestamp': msg.timestamp, 'author_id': msg.user_id})
+        for tag in tags:
+            tag_rows.append({'tag': tag, 'message_id': msg.id,
+                             'timestamp': msg.timestamp, 'author_id': msg.user_id})
+
+    if mention_rows:
+        db.session.execute(Mentions.__table__.insert(), mention_rows)
+    if tag_rows:
+        db.session.execute(MessageTags.__table__.insert(), tag_rows)
+    return len(mention_rows), len(tag_rows)
+
+
+def unindex_messages(message_ids):
+    """Remove the side-table rows of deleted or archived messages."""
+    message_ids = list(message_ids)
+    if not message_ids:
+        return
+    for table in (Mentions.__table__, MessageTags.__table__):
+        db.session.execute(table.delete().where(table.c.message_id.in_(message_ids)))
+
+
+##############################################################################
+# Feeds
+
+
+def encode_cursor(timestamp, message_id):
+    return f"{timestamp.strftime(CURSOR_TIME_FORMAT)}_{message_id}"
+
+
+def decode_cursor(raw):
+    """(timestamp, id) from a cursor, or None for a missing or bad one."""
+    if not raw:
+        return None
+    try:
+        timestamp, message_id = raw.rsplit('_', 1)
+        return datetime.strptime(timestamp, CURSOR_TIME_FORMAT), int(message_id)
+    except ValueError:
+        return None
+
+
+def messages_by_id(ids):
+    """{id: Message} for ``ids``, fetched from whichever shards hold them."""
+    if router.enabled:
+        groups = router.group_by_shard(ids, router.shard_for_message)
+    else:
+        groups = {None: list(ids)}
+
+    found = {}
+    for shard, shard_ids in groups.items():
+        query = Message.query.filter(Message.id.in_(shard_ids))
+        if shard is not None:
+            query = query.set_shard(shard)
+        found.update((msg.id, msg) for msg in query)
+
+    # Load the authors in one query; msg.user then comes from the identity map
+    author_ids = {msg.user_id for msg in found.values()}
+    if author_ids:
+        User.query.filter(User.id.in_(author_ids)).all()
+    return found
+
+
+def _page(model, where, before, limit):
+    """Messages from ``model``'s rows matching ``where``, newest first.
+
+    Returns (messages, next_cursor); next_cursor is None on the last page.
+    """
+    query = db.session.query(model.message_id, model.timestamp).filter(where)
+    if before is not None:
+        query = query.filter(db.tuple_(model.timestamp, model.message_id) < db.tuple_(*before))
+    query = (query
+             .order_by(model.timestamp.desc(), model.message_id.desc())
+             .limit(limit + 1))
+
+    rows = query.all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    found = messages_by_id([message_id for message_id, _ in rows])
+    messages = [found[message_id] for message_id, _ in rows if message_id in found]
+
+    next_cursor = None
+    if has_more:
+        message_id, timestamp = rows[-1]
+        next_cursor = encode_cursor(timestamp, message_id)
+    return messages, next_cursor
+
+
+def tag_page(tag, before=None, limit=PAGE_SIZE):
+    """A page of messages tagged ``tag``."""
+    return _page(MessageTags, MessageTags.tag == tag.lower(), before, limit)
+
+
+def mentions_page(user_id, before=None, limit=PAGE_SIZE):
+    """A page of messages mentioning ``user_id``."""
+    return _page(Mentions, Mentions.user_id == user_id, before, limit)
+
+
+##############################################################################
+# Backfill
+
+
+def backfill(chunk_size=BACKFILL_CHUNK, after_id=0):
+    """Index every existing message, ``chunk_size`` at a time.
+
+    Messages are streamed in id order by keyset (never OFFSET), one shard
+    after another; each chunk replaces its messages' side-table rows and
+    commits, so the backfill can be rerun or resumed from ``after_id``.
+    Returns the number of messages processed.
+    """
+    total = 0
+    for shard in (router.shards if router.enabled else [None]):
+        last_id = after_id
+        while True:
+            query = (Message.query
+                     .with_entities(Message.id, Message.text, Message.user_id, Message.timestamp)
+                     .filter(Message.id > last_id)
+                     .order_by(Message.id)
+                     .limit(chunk_size))
+            if shard is not None:
+                query = query.set_shard(shard)
+
+            chunk = query.all()
+            if not chunk:
+                break
+
+            unindex_messages([msg.id for msg in chunk])
+            index_messages(chunk)
+            db.session.commit()
+
+            total += len(chunk)
+            last_id = chunk[-1].id
+            if len(chunk) < chunk_size:
+                break
+    return total
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Index Warbler mentions and hashtags.")
+    parser.add_argument('command', choices=['backfill'])
+    parser.add_argument('--chunk-size', type=int, default=BACKFILL_CHUNK)
+    parser.add_argument('--after-id', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    from app import app
+
+    with app.app_context():
+        processed = backfill(args.chunk_size, args.after_id)
+        print(f"Indexed {processed} messages")
+
+
+if __name__ == '__main__':
+    main()
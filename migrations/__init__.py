@@ -0,0 +1,144 @@
+"""Versioned schema migrations for Warbler.
+
+``db.create_all()`` only creates missing tables; it never changes tables that
+already exist. Anything that alters an existing table (new indexes, column
+changes) goes in a numbered module under ``migrations/versions`` and is applied
+with:
+
+    python -m migrations status
+    python -m migrations upgrade
+    python -m migrations downgrade 0001
+
+Each version module defines ``upgrade(conn)`` and ``downgrade(conn)``. Modules
+that set ``transactional = False`` run in autocommit mode, which Postgres needs
+for ``CREATE INDEX CONCURRENTLY`` (builds the index without blocking writes).
+Applied versions are recorded in the ``schema_migrations`` table.
+"""
+
+import importlib.util
+import os
+from collections import namedtuple
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, MetaData, String, Table
+
+VERSIONS_DIR = os.path.join(os.path.dirname(__file__), 'versions')
+
+Migration = namedtuple('Migration', ['version', 'name', 'module'])
+
+migrations_metadata = MetaData()
+
+schema_migrations = Table(
+    'schema_migrations', migrations_metadata,
+    Column('version', String(20), primary_key=True),
+    Column('name', String(200), nullable=False),
+    Column('applied_at', DateTime, nullable=False, default=datetime.utcnow),
+)
+
+
+def discover():
+    """Return every migration under ``versions/``, ordered by version."""
+    migrations = []
+
+    for file_name in sorted(os.listdir(VERSIONS_DIR)):
+        if not file_name.endswith('.py') or not file_name[0].isdigit():
+            continue
+
+        version, _, name = file_name[:-3].partition('_')
+        spec = importlib.util.spec_from_file_location(
+            f"migrations.versions.v{version}", os.path.join(VERSIONS_DIR, file_name))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        migrations.append(Migration(version, name, module))
+
+    return migrations
+
+
+def applied_versions(engine):
+    """Return the set of versions already applied to this database."""
+    migrations_metadata.create_all(bind=engine)
+    with engine.connect() as conn:
+        return {row.version for row in conn.execute(schema_migrations.select())}
+
+
+def _run(engine, migration, direction):
+    """Run one migration step and record it, honouring ``transactional``."""
+    step = getattr(migration.module, direction)
+
+    # Only Postgres needs (and reliably supports) autocommit here
+    if (getattr(migration.module, 'transactional', True)
+            or engine.dialect.name != 'postgresql'):
+        with engine.begin() as conn:
+            step(conn)
+            _record(conn, migration, direction)
+    else:
+        with engine.connect() as conn:
+            step(conn.execution_options(isolation_level='AUTOCOMMIT'))
+        with engine.begin() as conn:
+            _record(conn, migration, direction)
+
+
+def _record(conn, migration, direction):
+    if direction == 'upgrade':
+        conn.execute(schema_migrations.insert().values(
+            version=migration.version, name=migration.name))
+    else:
+        conn.execute(schema_migrations.delete().where(
+            schema_migrations.c.version == migration.version))
+
+
+def upgrade(engine, target=None, out=print):
+    """Apply every pending migration up to and including ``target``."""
+    done = applied_versions(engine)
+
+    for migration in discover():
+        if target is not None and migration.version > target:
+            break
+        if migration.version not in done:
+            out(f"Applying {migration.version} {migration.name}")
+            _run(engine, migration, 'upgrade')
+
+
+def downgrade(engine, target, out=print):
+    """Revert applied migrations newer than ``target``."""
+    done = applied_versions(engine)
+
+    for migration in reversed(discover()):
+        if migration.version > target and migration.version in done:
+            out(f"Reverting {migration.version} {migration.name}")
+            _run(engine, migration, 'downgrade')
+
+
+##############################################################################
+# Helpers for version modules
+
+
+def create_index(conn, name, table, columns, unique=False):
+    """Create an index without blocking writes where the database allows it.
+
+    On Postgres this uses CREATE INDEX CONCURRENTLY, so the connection must be
+    in autocommit mode (``transactional = False``). A failed concurrent build
+    leaves an INVALID index behind; it is dropped and rebuilt here.
+    """
+    unique_sql = 'UNIQUE ' if unique else ''
+
+    if conn.dialect.name == 'postgresql':
+        invalid = conn.execute(
+            "SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+            "WHERE c.relname = %s AND NOT i.indisvalid", (name,)).first()
+        if invalid:
+            conn.execute(f'DROP INDEX CONCURRENTLY IF EXISTS "{name}"')
+
+        conn.execute(f'CREATE {unique_sql}INDEX CONCURRENTLY IF NOT EXISTS "{name}" '
+                     f'ON {table} ({", ".join(columns)})')
+    else:
+        conn.execute(f'CREATE {unique_sql}INDEX IF NOT EXISTS "{name}" '
+                     f'ON {table} ({", ".join(columns)})')
+
+
+def drop_index(conn, name):
+    """Drop an index, concurrently on Postgres."""
+    if conn.dialect.name == 'postgresql':
+        conn.execute(f'DROP INDEX CONCURRENTLY IF EXISTS "{name}"')
+    else:
+        conn.execute(f'DROP INDEX IF EXISTS "{name}"')
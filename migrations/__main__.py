@@ -0,0 +1,33 @@
+"""Command-line entry point: ``python -m migrations [status|upgrade|downgrade]``."""
+
+import argparse
+
+from migrations import applied_versions, discover, downgrade, upgrade
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Apply Warbler schema migrations.")
+    parser.add_argument('command', choices=['status', 'upgrade', 'downgrade'])
+    parser.add_argument('target', nargs='?', default=None,
+                        help="version to upgrade to / downgrade to")
+    args = parser.parse_args(argv)
+
+    # Importing the app configures and connects the database
+    from app import db
+    engine = db.engine
+
+    if args.command == 'status':
+        done = applied_versions(engine)
+        for migration in discover():
+            mark = 'x' if migration.version in done else ' '
+            print(f"[{mark}] {migration.version} {migration.name}")
+    elif args.command == 'upgrade':
+        upgrade(engine, args.target)
+    else:
+        if args.target is None:
+            parser.error("downgrade needs a target version (use 0000 to revert all)")
+        downgrade(engine, args.target)
+
+
+if __name__ == '__main__':
+    main()
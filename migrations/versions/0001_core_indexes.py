@@ -0,0 +1,41 @@
+"""Add secondary indexes for timelines, follow lookups and likes.
+
+- messages(user_id, timestamp): per-user timelines and the homepage feed
+- follows(user_following_id, user_being_followed_id): "who does X follow"
+  (the primary key already covers the other direction)
+- likes(user_id, message_id), unique: "what has X liked", and one like per pair
+- likes(message_id): "who liked this", and cascading message deletes
+"""
+
+from migrations import create_index, drop_index
+
+# CREATE INDEX CONCURRENTLY can't run inside a transaction
+transactional = False
+
+INDEXES = [
+    ('ix_messages_user_timestamp', 'messages', ['user_id', 'timestamp'], False),
+    ('ix_follows_following_followed', 'follows',
+     ['user_following_id', 'user_being_followed_id'], False),
+    ('ix_likes_user_message', 'likes', ['user_id', 'message_id'], True),
+    ('ix_likes_message_id', 'likes', ['message_id'], False),
+]
+
+
+def upgrade(conn):
+    # The unique index would fail on duplicate likes; keep the oldest of each
+    conn.execute("""
+        DELETE FROM likes WHERE id IN (
+            SELECT id FROM (
+                SELECT id, ROW_NUMBER() OVER (
+                    PARTITION BY user_id, message_id ORDER BY id) AS n
+                FROM likes) AS ranked
+            WHERE n > 1)
+    """)
+
+    for name, table, columns, unique in INDEXES:
+        create_index(conn, name, table, columns, unique=unique)
+
+
+def downgrade(conn):
+    for name, _, _, _ in reversed(INDEXES):
+        drop_index(conn, name)
@@ -0,0 +1,29 @@
+"""Widen message ids to BIGINT and default timestamps on the server.
+
+BIGINT ids leave room for time-ordered ids (see ids.py). Changing a column
+type rewrites the table, so run this in a maintenance window on big data.
+
+SQLite columns are untyped and can't have their defaults altered, so there is
+nothing to do there.
+"""
+
+
+def upgrade(conn):
+    if conn.dialect.name != 'postgresql':
+        return
+
+    conn.execute("ALTER TABLE likes ALTER COLUMN message_id TYPE BIGINT")
+    conn.execute("ALTER TABLE messages ALTER COLUMN id TYPE BIGINT")
+    conn.execute("ALTER SEQUENCE messages_id_seq AS BIGINT")
+    conn.execute("ALTER TABLE messages ALTER COLUMN timestamp "
+                 "SET DEFAULT TIMEZONE('utc', CURRENT_TIMESTAMP)")
+
+
+def downgrade(conn):
+    if conn.dialect.name != 'postgresql':
+        return
+
+    conn.execute("ALTER TABLE messages ALTER COLUMN timestamp DROP DEFAULT")
+    conn.execute("ALTER SEQUENCE messages_id_seq AS INTEGER")
+    conn.execute("ALTER TABLE messages ALTER COLUMN id TYPE INTEGER")
+    conn.execute("ALTER TABLE likes ALTER COLUMN message_id TYPE INTEGER")
@@ -0,0 +1,21 @@
+"""Add the id tie-breaker to the per-user timeline index.
+
+Timelines order by (timestamp, id); with id in the index, Postgres can read
+each user's newest messages in order without a separate sort step.
+"""
+
+from migrations import create_index, drop_index
+
+# CREATE INDEX CONCURRENTLY can't run inside a transaction
+transactional = False
+
+
+def upgrade(conn):
+    create_index(conn, 'ix_messages_user_timestamp_id', 'messages',
+                 ['user_id', 'timestamp', 'id'])
+    drop_index(conn, 'ix_messages_user_timestamp')
+
+
+def downgrade(conn):
+    create_index(conn, 'ix_messages_user_timestamp', 'messages', ['user_id', 'timestamp'])
+    drop_index(conn, 'ix_messages_user_timestamp_id')
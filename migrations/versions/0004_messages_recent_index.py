@@ -0,0 +1,20 @@
+"""Add a (timestamp, id) index on messages for the home timeline.
+
+The home timeline is the newest messages by anyone the user follows. When
+those users post a large share of all messages, the per-user index can't
+beat sorting every one of their messages; walking this index backwards
+and keeping followed users' messages stops after about a page.
+"""
+
+from migrations import create_index, drop_index
+
+# CREATE INDEX CONCURRENTLY can't run inside a transaction
+transactional = False
+
+
+def upgrade(conn):
+    create_index(conn, 'ix_messages_timestamp_id', 'messages', ['timestamp', 'id'])
+
+
+def downgrade(conn):
+    drop_index(conn, 'ix_messages_timestamp_id')
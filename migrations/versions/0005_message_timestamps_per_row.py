@@ -0,0 +1,22 @@
+"""Default message timestamps to the time of the insert.
+
+0002 used CURRENT_TIMESTAMP, which Postgres fixes at the start of the
+transaction, so every message inserted in one transaction got the same
+timestamp. clock_timestamp() is read for each row.
+"""
+
+
+def upgrade(conn):
+    if conn.dialect.name != 'postgresql':
+        return
+
+    conn.execute("ALTER TABLE messages ALTER COLUMN timestamp "
+                 "SET DEFAULT TIMEZONE('utc', clock_timestamp())")
+
+
+def downgrade(conn):
+    if conn.dialect.name != 'postgresql':
+        return
+
+    conn.execute("ALTER TABLE messages ALTER COLUMN timestamp "
+                 "SET DEFAULT TIMEZONE('utc', CURRENT_TIMESTAMP)")
@@ -1,16 +1,80 @@
 """SQLAlchemy models for Warbler."""
 from datetime import datetime
+from flask import current_app
 from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
-
-# Initialize the database and bcrypt for password hashing
-db = SQLAlchemy()
+from sqlalchemy import event
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import FunctionElement
+
+from ids import next_id, next_id_for, node_of, timestamp_of
+from invalidation import mark, row_tags
+from sharding import ShardedSQLAlchemy, bucket_for_user, router
+
+# Initialize the database and bcrypt for password hashing. Sessions and
+# queries route messages and likes to their shard when sharding is on.
+db = ShardedSQLAlchemy()
 bcrypt = Bcrypt()
 
+def insert_ignoring_duplicates(table, rows, returning, shard=None):
+    """Insert ``rows`` in one statement, skipping any that already exist.
+
+    Returns the set of ``returning`` column values actually inserted. On
+    Postgres this is a single INSERT ... ON CONFLICT DO NOTHING RETURNING, so
+    rows raced in by a concurrent request are reported as skipped rather
+    than failing the whole batch. Other backends get a plain INSERT; callers
+    filter out existing rows first. ``shard`` names the shard to insert into
+    for sharded tables (see sharding.py).
+    """
+    if not rows:
+        return set()
+
+    bind = router.engine(shard) if shard is not None else db.engine
+
+    if bind.dialect.name == 'postgresql':
+        stmt = (pg_insert(table).values(rows)
+                .on_conflict_do_nothing()
+                .returning(table.c[returning]))
+        return {value for (value,) in db.session.execute(stmt, bind=bind)}
+
+    db.session.execute(table.insert(), rows, bind=bind)
+    return {row[returning] for row in rows}
+
+
+# Message ids are BIGINT so they can hold time-ordered ids (see ids.py).
+# SQLite only autoincrements a plain INTEGER primary key.
+MessageId = db.BigInteger().with_variant(db.Integer(), 'sqlite')
+
+
+class utcnow(FunctionElement):
+    """Server-side current UTC time, evaluated per row by the database."""
+    type = db.DateTime()
+
+
+@compiles(utcnow)
+def _default_utcnow(element, compiler, **kw):
+    # SQLite's CURRENT_TIMESTAMP is already UTC
+    return "CURRENT_TIMESTAMP"
+
+
+@compiles(utcnow, 'postgresql')
+def _pg_utcnow(element, compiler, **kw):
+    # CURRENT_TIMESTAMP is when the transaction began; clock_timestamp() is
+    # the time of the insert itself
+    return "TIMEZONE('utc', clock_timestamp())"
+
+
 class Follows(db.Model):
     """Represents a follow relationship between users."""
     __tablename__ = 'follows'
 
+    # The primary key (followed, following) already serves "who follows X";
+    # this covers the reverse "who does X follow" lookups without a heap fetch.
+    __table_args__ = (
+        db.Index('ix_follows_following_followed',
+                 'user_following_id', 'user_being_followed_id'),
+    )
+
     # ID of the user being followed
     user_being_followed_id = db.Column(
         db.Integer,
@@ -25,11 +89,101 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    @classmethod
+    def exists(cls, follower_id, followed_id):
+        """Checks for a single follow row without loading either user."""
+        return db.session.query(
+            cls.query.filter_by(user_following_id=follower_id,
+                                user_being_followed_id=followed_id).exists()
+        ).scalar()
+
+    @classmethod
+    def mark_changed(cls, follower_id, followed_ids):
+        """Invalidate caches of follows added or removed outside the ORM."""
+        for followed_id in followed_ids:
+            mark(db.session, *row_tags('follows', {'user_following_id': follower_id,
+                                                   'user_being_followed_id': followed_id}))
+
+    @classmethod
+    def add_many(cls, follower_id, user_ids):
+        """Follow many users at once with set-based queries.
+
+        Returns {user_id: outcome}, where outcome is 'followed',
+        'already_following', 'not_found' or 'self'. The caller commits.
+        """
+        table = cls.__table__
+        user_ids = set(user_ids)
+        results = {}
+
+        found = {uid for (uid,) in db.session.query(User.id).filter(User.id.in_(user_ids))}
+        existing = {uid for (uid,) in db.session
+                    .query(cls.user_being_followed_id)
+                    .filter(cls.user_following_id == follower_id,
+                            cls.user_being_followed_id.in_(found))}
+
+        to_follow = found - existing - {follower_id}
+        inserted = insert_ignoring_duplicates(table, [
+            {'user_being_followed_id': uid, 'user_following_id': follower_id}
+            for uid in sorted(to_follow)
+        ], returning='user_being_followed_id')
+        cls.mark_changed(follower_id, inserted)
+
+        for uid in user_ids:
+            if uid == follower_id:
+                results[uid] = 'self'
+            elif uid not in found:
+                results[uid] = 'not_found'
+            elif uid in inserted:
+                results[uid] = 'followed'
+            else:
+                results[uid] = 'already_following'
+        return results
+
+    @classmethod
+    def remove_many(cls, follower_id, user_ids):
+        """Unfollow many users with one DELETE.
+
+        Returns {user_id: 'unfollowed' | 'not_following'}. The caller commits.
+        """
+        user_ids = set(user_ids)
+        following = {uid for (uid,) in db.session
+                     .query(cls.user_being_followed_id)
+                     .filter(cls.user_following_id == follower_id,
+                             cls.user_being_followed_id.in_(user_ids))}
+
+        (cls.query
+         .filter(cls.user_following_id == follower_id,
+                 cls.user_being_followed_id.in_(following))
+         .delete(synchronize_session=False))
+        cls.mark_changed(follower_id, following)
+
+        return {uid: 'unfollowed' if uid in following else 'not_following'
+                for uid in user_ids}
+
+
+# Likes not yet written to the likes table: {(user_id, message_id): liked}.
+# Filled in by like_buffer when write-behind likes are on, and merged into
+# what users see of their own likes.
+pending_likes = {}
+
+
+def pending_likes_of(user_id):
+    """{message_id: liked} for ``user_id``'s likes not yet written, oldest first."""
+    return {message_id: liked for (liker_id, message_id), liked in pending_likes.items()
+            if liker_id == user_id}
+
 
 class Likes(db.Model):
     """Mapping users liking specific warbles/messages."""
     __tablename__ = 'likes' 
 
+    __table_args__ = (
+        # One like per user per message; also serves "what has X liked"
+        db.Index('ix_likes_user_message', 'user_id', 'message_id', unique=True),
+        # Serves "who liked this message" and the cascade from messages
+        db.Index('ix_likes_message_id', 'message_id'),
+    )
+
     id = db.Column(
         db.Integer,
         primary_key=True
@@ -43,10 +197,68 @@ class Likes(db.Model):
 
     # ID of the liked message
     message_id = db.Column(
-        db.Integer,
+        MessageId,
         db.ForeignKey('messages.id', ondelete='cascade')
     )
 
+    @classmethod
+    def mark_changed(cls, user_id, message_ids):
+        """Invalidate caches of likes added or removed outside the ORM."""
+        for message_id in message_ids:
+            mark(db.session, *row_tags('likes', {'user_id': user_id,
+                                                 'message_id': message_id}))
+
+    @classmethod
+    def add_many(cls, user_id, message_ids):
+        """Like many messages at once with set-based queries.
+
+        Returns {message_id: 'liked' | 'already_liked' | 'not_found'}.
+        The caller commits.
+        """
+        message_ids = set(message_ids)
+
+        found = {mid for (mid,) in db.session.query(Message.id).filter(Message.id.in_(message_ids))}
+        existing = {mid for (mid,) in db.session
+                    .query(cls.message_id)
+                    .filter(cls.user_id == user_id, cls.message_id.in_(found))}
+
+        to_like = sorted(found - existing)
+        if router.enabled:
+            # Each like goes to the shard of the message it likes
+            inserted = set()
+            for shard, mids in router.group_by_shard(to_like, router.shard_for_message).items():
+                inserted |= insert_ignoring_duplicates(cls.__table__, [
+                    {'user_id': user_id, 'message_id': mid} for mid in mids
+                ], returning='message_id', shard=shard)
+        else:
+            inserted = insert_ignoring_duplicates(cls.__table__, [
+                {'user_id': user_id, 'message_id': mid} for mid in to_like
+            ], returning='message_id')
+        cls.mark_changed(user_id, inserted)
+
+        return {mid: ('not_found' if mid not in found
+                      else 'liked' if mid in inserted
+                      else 'already_liked')
+                for mid in message_ids}
+
+    @classmethod
+    def remove_many(cls, user_id, message_ids):
+        """Unlike many messages with one DELETE.
+
+        Returns {message_id: 'unliked' | 'not_liked'}. The caller commits.
+        """
+        message_ids = set(message_ids)
+        liked = {mid for (mid,) in db.session
+                 .query(cls.message_id)
+                 .filter(cls.user_id == user_id, cls.message_id.in_(message_ids))}
+
+        (cls.query
+         .filter(cls.user_id == user_id, cls.message_id.in_(liked))
+         .delete(synchronize_session=False))
+        cls.mark_changed(user_id, liked)
+
+        return {mid: 'unliked' if mid in liked else 'not_liked' for mid in message_ids}
+
 class User(db.Model):
     """Represents a user in the system."""
     __tablename__ = 'users'
@@ -100,20 +312,29 @@ class User(db.Model):
         nullable=False,
     )
 
+    # The collections below are "dynamic": each one is a query, so appending,
+    # counting (``.count()``) and slicing never load the whole collection.
+    # passive_deletes leaves cleanup on user delete to the database's
+    # ON DELETE CASCADE instead of loading every related row first.
+
     # Establishing the many-to-many relationship with Messages through Likes
     likes = db.relationship('Message',
                             secondary='likes',
-                            backref='liked_by')
+                            backref='liked_by',
+                            lazy='dynamic',
+                            passive_deletes=True)
 
     # Relationship for the messages created by this user
-    messages = db.relationship('Message')
+    messages = db.relationship('Message', lazy='dynamic', passive_deletes=True)
 
     # Relationship for the users that this user is following (many-to-many)
     followers = db.relationship(
         "User",
         secondary="follows",
         primaryjoin=(Follows.user_being_followed_id == id),
-        secondaryjoin=(Follows.user_following_id == id)
+        secondaryjoin=(Follows.user_following_id == id),
+        lazy='dynamic',
+        passive_deletes=True,
     )
 
     # Relationship for the users that are following this user (many-to-many)
@@ -121,7 +342,9 @@ class User(db.Model):
         "User",
         secondary="follows",
         primaryjoin=(Follows.user_following_id == id),
-        secondaryjoin=(Follows.user_being_followed_id == id)
+        secondaryjoin=(Follows.user_being_followed_id == id),
+        lazy='dynamic',
+        passive_deletes=True,
     )
 
     def __repr__(self):
@@ -129,11 +352,88 @@ class User(db.Model):
 
     def is_following(self, user):
         """Checks if the current user is following the given user."""
-        return user in self.following
+        return Follows.exists(follower_id=self.id, followed_id=user.id)
 
     def is_followed_by(self, user):
         """Checks if the current user is followed by the given user."""
-        return user in self.followers
+        return Follows.exists(follower_id=user.id, followed_id=self.id)
+
+    def post_message(self, text):
+        """Add a new message by this user to the session and return it.
+
+        Inserts one row; the user's existing messages are never loaded.
+        """
+        msg = Message(text=text, user_id=self.id)
+        db.session.add(msg)
+        return msg
+
+    def follow(self, user):
+        """Start following ``user``. Does nothing if already following."""
+        if not self.is_following(user):
+            db.session.add(Follows(user_being_followed_id=user.id,
+                                   user_following_id=self.id))
+
+    def unfollow(self, user):
+        """Stop following ``user`` with a single DELETE."""
+        (Follows.query
+         .filter_by(user_following_id=self.id, user_being_followed_id=user.id)
+         .delete(synchronize_session=False))
+        Follows.mark_changed(self.id, [user.id])
+
+    def like(self, message_id):
+        """Like a message. Does nothing if already liked."""
+        if not self.has_liked(message_id):
+            db.session.add(Likes(user_id=self.id, message_id=message_id))
+
+    def unlike(self, message_id):
+        """Remove this user's like from a message with a single DELETE."""
+        (Likes.query
+         .filter_by(user_id=self.id, message_id=message_id)
+         .delete(synchronize_session=False))
+        Likes.mark_changed(self.id, [message_id])
+
+    def has_liked(self, message_id):
+        """Checks if this user has liked the message."""
+        pending = pending_likes.get((self.id, message_id))
+        if pending is not None:
+            return pending
+
+        query = db.session.query(
+            Likes.query.filter_by(user_id=self.id, message_id=message_id).exists())
+        if router.enabled:
+            query = query.set_shard(router.shard_for_message(message_id))
+        return query.scalar()
+
+    def liked_ids_among(self, message_ids, pending=True):
+        """Return the subset of ``message_ids`` this user has liked.
+
+        With ``pending`` false, only likes already in the database count.
+        """
+        if not message_ids:
+            return set()
+        if router.enabled:
+            # One query per shard the messages are on, not one per shard
+            groups = router.group_by_shard(message_ids, router.shard_for_message)
+        else:
+            groups = {None: message_ids}
+
+        liked = set()
+        for shard, ids in groups.items():
+            rows = (db.session.query(Likes.message_id)
+                    .filter(Likes.user_id == self.id, Likes.message_id.in_(ids)))
+            if shard is not None:
+                rows = rows.set_shard(shard)
+            liked.update(message_id for (message_id,) in rows)
+
+        if not pending:
+            return liked
+        for message_id in message_ids:
+            pending = pending_likes.get((self.id, message_id))
+            if pending is True:
+                liked.add(message_id)
+            elif pending is False:
+                liked.discard(message_id)
+        return liked
 
     @classmethod
     def signup(cls, username, email, password, image_url=None, header_image_url=None):
@@ -161,8 +461,12 @@ class User(db.Model):
     def authenticate(cls, username, password):
         """Authenticate a user by checking the username and password hash.
         """
-        # Find user by username
-        user = cls.query.filter_by(username=username).first()
+        # Find user by username, ignoring accounts that are being deleted
+        user = (cls.query
+                .filter_by(username=username)
+                .filter(~AccountDeletion.query
+                        .filter(AccountDeletion.user_id == cls.id).exists())
+                .first())
 
         # Check if password is correct
         if user and bcrypt.check_password_hash(user.password, password):
@@ -176,8 +480,16 @@ class Message(db.Model):
     """An individual message ("warble")."""
     __tablename__ = 'messages'
 
+    __table_args__ = (
+        # Serves per-user timelines ordered by (timestamp, id), scanned backwards
+        db.Index('ix_messages_user_timestamp_id', 'user_id', 'timestamp', 'id'),
+        # Serves the home timeline: walked newest first, keeping followed
+        # users' messages, until a page is full
+        db.Index('ix_messages_timestamp_id', 'timestamp', 'id'),
+    )
+
     id = db.Column(
-        db.Integer,
+        MessageId,
         primary_key=True,
     )
 
@@ -187,11 +499,12 @@ class Message(db.Model):
         nullable=False,
     )
 
-    # Timestamp of when the message was created
+    # Timestamp of when the message was created, filled in by the database
+    # for each row (or derived from the id when time-ordered ids are on)
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        server_default=utcnow(),
     )
 
     # ID of the user who posted the message
@@ -204,6 +517,184 @@ class Message(db.Model):
     # Relationship to the user who posted this message
     user = db.relationship('User')
 
+    # Fetch server-generated id/timestamp in the INSERT (RETURNING on Postgres)
+    __mapper_args__ = {'eager_defaults': True}
+
+    @classmethod
+    def newest_first(cls):
+        """ORDER BY clauses for timelines, newest message first.
+
+        With time-ordered ids the primary key alone gives the order; otherwise
+        sort by timestamp with the id as a tie-breaker.
+        """
+        if snowflake_ids_enabled():
+            return (cls.id.desc(),)
+        return (cls.timestamp.desc(), cls.id.desc())
+
+
+def snowflake_ids_enabled():
+    """True if the app is configured to generate time-ordered message ids.
+
+    Sharding always uses them: the id says which shard a message is on.
+    """
+    return router.enabled or bool(current_app and current_app.config.get('MESSAGE_SNOWFLAKE_IDS'))
+
+
+@event.listens_for(Message, 'before_insert')
+def assign_snowflake_id(mapper, connection, target):
+    """Give new messages a time-ordered id (and matching timestamp) if enabled."""
+    if target.id is None and snowflake_ids_enabled():
+        if router.enabled:
+            target.id = next_id_for(bucket_for_user(target.user_id))
+        else:
+            target.id = next_id()
+        if target.timestamp is None:
+            target.timestamp = timestamp_of(target.id)
+
+
+# Messages live on their author's shard, likes with the message they like
+router.register(Message, lambda msg: bucket_for_user(msg.user_id), bucket_of_key=node_of)
+router.register(Likes, lambda like: node_of(like.message_id))
+
+
+class ArchivedMessages(db.Model):
+    """A compressed chunk of one user's old messages (see archive.py).
+
+    Messages past the archive horizon move out of ``messages`` into these
+    chunks, so the hot table and its indexes only hold recent rows.
+    """
+    __tablename__ = 'message_archive'
+
+    __table_args__ = (
+        # Serves paging back through a user's archive, newest chunk first
+        db.Index('ix_message_archive_user_newest',
+                 'user_id', 'newest_timestamp', 'newest_id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        nullable=False,
+    )
+
+    # The (timestamp, id) range of the messages in the chunk
+    oldest_timestamp = db.Column(db.DateTime, nullable=False)
+    oldest_id = db.Column(MessageId, nullable=False)
+    newest_timestamp = db.Column(db.DateTime, nullable=False)
+    newest_id = db.Column(MessageId, nullable=False)
+
+    message_count = db.Column(db.Integer, nullable=False)
+
+    # zlib-compressed JSON list of the messages, with who liked each
+    data = db.Column(db.LargeBinary, nullable=False)
+
+    archived_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
+# Archived chunks stay on their author's shard
+router.register(ArchivedMessages, lambda chunk: bucket_for_user(chunk.user_id))
+
+
+class Mentions(db.Model):
+    """A message mentioning a user by @username (see mentions.py).
+
+    Kept in the main database next to users, with a copy of the message's
+    timestamp, so "mentions of me" is one index range scan wherever the
+    message itself lives. No foreign key to messages for the same reason;
+    deleting or archiving a message removes its rows explicitly.
+    """
+    __tablename__ = 'mentions'
+
+    __table_args__ = (
+        # Serves the mentions feed, newest first, keyset-paginated
+        db.Index('ix_mentions_user_timestamp_message',
+                 'user_id', 'timestamp', 'message_id'),
+    )
+
+    # The user mentioned
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(MessageId, primary_key=True)
+
+    timestamp = db.Column(db.DateTime, nullable=False)
+
+    # Who wrote the message; their rows go when their account does
+    author_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+
+class MessageTags(db.Model):
+    """A #hashtag used in a message (see mentions.py)."""
+    __tablename__ = 'message_tags'
+
+    __table_args__ = (
+        # Serves /tags/<tag>, newest first, keyset-paginated
+        db.Index('ix_message_tags_tag_timestamp_message',
+                 'tag', 'timestamp', 'message_id'),
+    )
+
+    # Lowercased, without the '#'
+    tag = db.Column(db.String(140), primary_key=True)
+
+    message_id = db.Column(MessageId, primary_key=True)
+
+    timestamp = db.Column(db.DateTime, nullable=False)
+
+    author_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+
+class AccountDeletion(db.Model):
+    """Progress of a batched account deletion (see tasks.delete_account).
+
+    The row is created as soon as the user asks to be deleted, which also
+    locks them out, and outlives the user row as a record of what was removed.
+    """
+    __tablename__ = 'account_deletions'
+
+    # No foreign key: the user row is deleted at the end
+    user_id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    # pending -> running -> done
+    status = db.Column(
+        db.String(20),
+        nullable=False,
+        default='pending',
+    )
+
+    # Rows removed so far, per table
+    likes_deleted = db.Column(db.Integer, nullable=False, default=0)
+    follows_deleted = db.Column(db.Integer, nullable=False, default=0)
+    messages_deleted = db.Column(db.Integer, nullable=False, default=0)
+
+    requested_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+
+    @classmethod
+    def request(cls, user_id):
+        """Record that ``user_id`` should be deleted, if not already recorded."""
+        deletion = cls.query.get(user_id)
+        if deletion is None:
+            deletion = cls(user_id=user_id)
+            db.session.add(deletion)
+        return deletion
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
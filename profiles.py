@@ -0,0 +1,236 @@
+"""Read model for profile pages.
+
+A profile page shows the user, four counts, whether the viewer follows
+them, their newest messages and their newest likes with who wrote each.
+Loaded through the ORM that's a query per count, per relationship and per
+liked message's author. ``load`` fetches all of it in two queries instead:
+
+1. the user row, with every count and the viewer's follow state as scalar
+   subqueries in the same SELECT;
+2. the first page of their messages and of their likes (joined to the
+   liked messages' authors), as one UNION ALL.
+
+With sharding on, messages and likes aren't in the main database, so the
+second query is run on the shards (and liked messages' authors are looked
+up in one more query) instead.
+
+Likes still buffered by like_buffer.py are folded into the likes count and
+the likes page, so users see their own likes straight away there too.
+"""
+
+from collections import namedtuple
+
+from mentions import messages_by_id
+from models import db, pending_likes_of, ArchivedMessages, Follows, Likes, Message, User
+from sharding import router
+
+MESSAGES_PAGE = 20
+LIKES_PAGE = 10
+
+# A message as shown on a profile, with its author's name and picture
+ProfileMessage = namedtuple('ProfileMessage', [
+    'id', 'text', 'timestamp', 'user_id', 'username', 'image_url'])
+
+
+class Profile:
+    """Everything a profile page shows about one user."""
+
+    def __init__(self, row, viewer_following, messages, liked):
+        self.id = row['id']
+        self.username = row['username']
+        self.image_url = row['image_url']
+        self.header_image_url = row['header_image_url']
+        self.bio = row['bio']
+        self.location = row['location']
+
+        self.messages_count = row['messages_count']
+        self.following_count = row['following_count']
+        self.followers_count = row['followers_count']
+        self.likes_count = row['likes_count']
+        self.viewer_following = viewer_following
+
+        self.messages = messages
+        self.liked = liked
+
+
+def _count(where):
+    return db.select([db.func.count()]).where(where).as_scalar()
+
+
+def _user_row(user_id, viewer_id, with_message_counts):
+    users = User.__table__
+    follows = Follows.__table__
+
+    columns = [users.c.id, users.c.username, users.c.image_url, users.c.header_image_url,
+               users.c.bio, users.c.location,
+               _count(follows.c.user_following_id == user_id).label('following_count'),
+               _count(follows.c.user_being_followed_id == user_id).label('followers_count'),
+               db.exists().where(db.and_(follows.c.user_following_id == viewer_id,
+                                         follows.c.user_being_followed_id == user_id))
+               .label('viewer_following')]
+
+    if with_message_counts:
+        messages = Message.__table__
+        chunks = ArchivedMessages.__table__
+        columns += [
+            (_count(messages.c.user_id == user_id)
+             + db.select([db.func.coalesce(db.func.sum(chunks.c.message_count), 0)])
+             .where(chunks.c.user_id == user_id).as_scalar()).label('messages_count'),
+            _count(Likes.__table__.c.user_id == user_id).label('likes_count'),
+        ]
+
+    return db.session.execute(db.select(columns).where(users.c.id == user_id)).first()
+
+
+def _pages_query(user_id):
+    """The user's newest messages and newest likes, tagged by kind."""
+    users = User.__table__
+    messages = Message.__table__
+    likes = Likes.__table__
+
+    def message_columns(kind):
+        return [db.literal(kind).label('kind'), messages.c.id, messages.c.text,
+                messages.c.timestamp, messages.c.user_id, users.c.username, users.c.image_url]
+
+    own = (db.select(message_columns('message'))
+           .select_from(messages.join(users, users.c.id == messages.c.user_id))
+           .where(messages.c.user_id == user_id)
+           .order_by(messages.c.timestamp.desc(), messages.c.id.desc())
+           .limit(MESSAGES_PAGE)).alias('own')
+    liked = (db.select(message_columns('like') + [likes.c.id.label('like_id')])
+             .select_from(likes.join(messages, messages.c.id == likes.c.message_id)
+                          .join(users, users.c.id == messages.c.user_id))
+             .where(likes.c.user_id == user_id)
+             .order_by(likes.c.id.desc())
+             .limit(LIKES_PAGE)).alias('liked')
+
+    return db.union_all(
+        db.select([own, db.literal(0).label('like_id')]),
+        db.select([liked]),
+    )
+
+
+def _split(rows):
+    """(messages, liked) from the UNION's rows, each newest first."""
+    messages = []
+    liked = []
+    for row in rows:
+        msg = ProfileMessage(row['id'], row['text'], row['timestamp'], row['user_id'],
+                             row['username'], row['image_url'])
+        if row['kind'] == 'message':
+            messages.append((row['timestamp'], row['id'], msg))
+        else:
+            liked.append((row['like_id'], msg))
+    messages.sort(key=lambda item: item[:2], reverse=True)
+    liked.sort(key=lambda item: item[0], reverse=True)
+    return [msg for _, _, msg in messages], [msg for _, msg in liked]
+
+
+def load(user_id, viewer_id=None, with_pages=True):
+    """The Profile of ``user_id`` as seen by ``viewer_id``, or None if no such user.
+
+    Without ``with_pages`` only the user and counts are loaded (one query),
+    and ``messages`` and ``liked`` are left empty, for pages that show the
+    profile header above something else.
+    """
+    if router.enabled:
+        return _load_sharded(user_id, viewer_id, with_pages)
+
+    row = _user_row(user_id, viewer_id, with_message_counts=True)
+    if row is None:
+        return None
+
+    messages, liked = [], []
+    if with_pages:
+        messages, liked = _split(db.session.execute(_pages_query(user_id)))
+    return _with_pending_likes(Profile(row, bool(row['viewer_following']), messages, liked),
+                               with_pages)
+
+
+def pending_like_changes(user):
+    """(messages newly liked, ids of messages unliked) by ``user``'s buffered likes.
+
+    Only intents that differ from the database count; newly liked messages
+    come newest first, with their authors loaded.
+    """
+    pending = pending_likes_of(user.id)
+    if not pending:
+        return [], set()
+
+    stored = user.liked_ids_among(list(pending), pending=False)
+    unliked = {message_id for message_id, liked in pending.items()
+               if not liked and message_id in stored}
+    liked_ids = [message_id for message_id, liked in pending.items()
+                 if liked and message_id not in stored]
+    found = messages_by_id(liked_ids) if liked_ids else {}
+    return [found[message_id] for message_id in reversed(liked_ids) if message_id in found], unliked
+
+
+def _with_pending_likes(profile, with_pages):
+    liked, unliked = pending_like_changes(User(id=profile.id))
+    profile.likes_count += len(liked) - len(unliked)
+    if with_pages and (liked or unliked):
+        profile.liked = ([ProfileMessage(msg.id, msg.text, msg.timestamp, msg.user_id,
+                                         msg.user.username, msg.user.image_url)
+                          for msg in liked]
+                         + [msg for msg in profile.liked if msg.id not in unliked])[:LIKES_PAGE]
+    return profile
+
+
+def _load_sharded(user_id, viewer_id, with_pages):
+    row = _user_row(user_id, viewer_id, with_message_counts=False)
+    if row is None:
+        return None
+    row = dict(row)
+
+    messages = Message.__table__
+    likes = Likes.__table__
+    chunks = ArchivedMessages.__table__
+    home = router.engine(router.shard_for_user(user_id))
+
+    with home.connect() as conn:
+        row['messages_count'] = conn.execute(
+            db.select([_count(messages.c.user_id == user_id)
+                       + db.select([db.func.coalesce(db.func.sum(chunks.c.message_count), 0)])
+                       .where(chunks.c.user_id == user_id).as_scalar()])).scalar()
+        own = []
+        if with_pages:
+            own = [ProfileMessage(r['id'], r['text'], r['timestamp'], user_id,
+                                  row['username'], row['image_url'])
+                   for r in conn.execute(db.select([messages.c.id, messages.c.text,
+                                                    messages.c.timestamp])
+                                         .where(messages.c.user_id == user_id)
+                                         .order_by(messages.c.timestamp.desc(),
+                                                   messages.c.id.desc())
+                                         .limit(MESSAGES_PAGE))]
+
+    # Likes live with the liked message, so they're spread over every shard
+    row['likes_count'] = 0
+    liked_rows = []
+    for shard in router.shards:
+        with router.engine(shard).connect() as conn:
+            row['likes_count'] += conn.execute(
+                db.select([_count(likes.c.user_id == user_id)])).scalar()
+            if not with_pages:
+                continue
+            liked_rows.extend(conn.execute(
+                db.select([likes.c.id, messages.c.id.label('message_id'), messages.c.text,
+                           messages.c.timestamp, messages.c.user_id])
+                .select_from(likes.join(messages, messages.c.id == likes.c.message_id))
+                .where(likes.c.user_id == user_id)
+                .order_by(likes.c.id.desc())
+                .limit(LIKES_PAGE)))
+    # Like ids are per shard, so across shards this is only roughly newest first
+    liked_rows = sorted(liked_rows, key=lambda r: r['id'], reverse=True)[:LIKES_PAGE]
+
+    authors = {}
+    if liked_rows:
+        authors = {author.id: author for author in db.session.query(
+            User.id, User.username, User.image_url)
+            .filter(User.id.in_({r['user_id'] for r in liked_rows}))}
+    liked = [ProfileMessage(r['message_id'], r['text'], r['timestamp'], r['user_id'],
+                            authors[r['user_id']].username, authors[r['user_id']].image_url)
+             for r in liked_rows if r['user_id'] in authors]
+
+    return _with_pending_likes(Profile(row, bool(row['viewer_following']), own, liked),
+                               with_pages)
@@ -0,0 +1,502 @@
+"""Tag-invalidated cache of SQLAlchemy query results.
+
+Reads that are the same across requests (a popular profile, a celebrity's
+follower list, a message page) go through ``cache.all(query, tags)`` or
+``cache.get(Model, id)`` instead of hitting the database each time:
+
+    user = cache.get_or_404(User, user_id)
+    followers = cache.all(user.followers, tags=[f"follows:followers:{user.id}"])
+
+Entries are keyed by the query's SQL and parameters, and tagged with the
+row tags (see invalidation.py) of every object they return plus any
+``tags`` given for what the result depends on, like list membership. The
+invalidation bus drops them when a commit anywhere touches those tags, and
+every entry also expires after QUERY_CACHE_TTL seconds as a backstop.
+Results come back merged into the current session without a query, so
+they can be modified and committed like freshly loaded objects.
+
+QUERY_CACHE_BACKEND picks where entries live:
+
+- ``none``: no caching (the default; queries just run)
+- ``memory``: an LRU in each process, capped at QUERY_CACHE_MAX_BYTES
+- ``redis``: a Redis-protocol server at QUERY_CACHE_URL shared by every
+  process; ``python query_cache.py serve`` runs a small stand-in for
+  development and tests
+
+Cached rows include whatever columns the model has (password hashes too),
+so only point ``redis`` at a server that's as private as the database.
+"""
+
+import argparse
+import hashlib
+import pickle
+import socket
+import socketserver
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from urllib.parse import urlparse
+
+from flask import abort
+
+from invalidation import ObjectRow, bus, row_tags
+from models import db
+
+# Seconds an entry lives even if nothing invalidates it
+DEFAULT_TTL = 300
+
+# Rough per-entry overhead on top of the pickled value, for the memory cap
+ENTRY_OVERHEAD = 200
+
+
+def ancestors(tag):
+    """``tag`` and every tag above it: 'a:b:c' -> ['a', 'a:b', 'a:b:c']."""
+    parts = tag.split(':')
+    return [':'.join(parts[:i]) for i in range(1, len(parts) + 1)]
+
+
+##############################################################################
+# Backends
+#
+# Values are pickled bytes. ``invalidate(tag)`` drops every entry with a tag
+# that covers ``tag`` (the same, above or below it).
+
+
+class MemoryBackend:
+    """Per-process LRU with a bound on total size."""
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        # key -> (value, expires_at, tags)
+        self.entries = OrderedDict()
+        # tag -> keys tagged with it; prefix -> tags under it
+        self.keys_by_tag = defaultdict(set)
+        self.tags_under = defaultdict(set)
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] < time.monotonic():
+                self._remove(key)
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value, ttl, tags):
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+            size = len(value) + ENTRY_OVERHEAD
+            if size > self.max_bytes:
+                return
+
+            self.entries[key] = (value, time.monotonic() + ttl, tags)
+            self.bytes += size
+            for tag in tags:
+                self.keys_by_tag[tag].add(key)
+                for prefix in ancestors(tag)[:-1]:
+                    self.tags_under[prefix].add(tag)
+
+            while self.bytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+
+    def _remove(self, key):
+        value, _, tags = self.entries.pop(key)
+        self.bytes -= len(value) + ENTRY_OVERHEAD
+        for tag in tags:
+            keys = self.keys_by_tag.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.keys_by_tag[tag]
+                    for prefix in ancestors(tag)[:-1]:
+                        under = self.tags_under.get(prefix)
+                        if under is not None:
+                            under.discard(tag)
+                            if not under:
+                                del self.tags_under[prefix]
+
+    def invalidate(self, tag):
+        with self.lock:
+            tags = set(ancestors(tag)) | self.tags_under.get(tag, set())
+            keys = set()
+            for covered in tags:
+                keys |= self.keys_by_tag.get(covered, set())
+            for key in keys:
+                self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.keys_by_tag.clear()
+            self.tags_under.clear()
+            self.bytes = 0
+
+
+class RespClient:
+    """Minimal client for the Redis protocol (RESP), one socket per thread."""
+
+    def __init__(self, host='localhost', port=6379, db=0, timeout=1.0):
+        self.address = (host, port)
+        self.db = db
+        self.timeout = timeout
+        self.local = threading.local()
+
+    @classmethod
+    def from_url(cls, url):
+        parsed = urlparse(url)
+        return cls(parsed.hostname or 'localhost', parsed.port or 6379,
+                   int(parsed.path.lstrip('/') or 0))
+
+    def _connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            sock = socket.create_connection(self.address, timeout=self.timeout)
+            conn = (sock, sock.makefile('rb'))
+            self.local.conn = conn
+            if self.db:
+                self.execute('SELECT', self.db)
+        return conn
+
+    def execute(self, *args):
+        """Send one command and return its decoded reply."""
+        sock, reader = self._connection()
+        try:
+            sock.sendall(encode_command(args))
+            return read_reply(reader)
+        except (OSError, EOFError):
+            # Drop the broken connection; the next call reconnects
+            self.local.conn = None
+            sock.close()
+            raise
+
+
+class ReplyError(Exception):
+    """An error reply from the server."""
+
+
+def encode_command(args):
+    parts = [b'*%d\r\n' % len(args)]
+    for arg in args:
+        if not isinstance(arg, bytes):
+            arg = str(arg).encode()
+        parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+    return b''.join(parts)
+
+
+def read_reply(reader):
+    line = reader.readline()
+    if not line:
+        raise EOFError("Connection closed")
+    kind, rest = line[:1], line[1:-2]
+
+    if kind == b'+':
+        return rest.decode()
+    if kind == b'-':
+        raise ReplyError(rest.decode())
+    if kind == b':':
+        return int(rest)
+    if kind == b'$':
+        length = int(rest)
+        if length < 0:
+            return None
+        data = reader.read(length + 2)
+        return data[:-2]
+    if kind == b'*':
+        length = int(rest)
+        if length < 0:
+            return None
+        return [read_reply(reader) for _ in range(length)]
+    raise ReplyError(f"Unexpected reply {line!r}")
+
+
+class RedisBackend:
+    """Entries in a Redis-protocol server shared by every process.
+
+    Tag indexes are server-side sets: ``tag:<tag>`` holds the keys tagged
+    with it, ``under:<prefix>`` the tags below a prefix. Both expire with
+    the entries that created them, so they can't grow without bound.
+
+    The store-time guard in QueryCache only sees invalidations that have
+    reached this process. If another process commits and drops an entry
+    while this one is still running the query, and its invalidation
+    arrives after the result is stored, the stale result is kept until the
+    next write to the same tags or QUERY_CACHE_TTL, whichever is first.
+    Keep the TTL as short as that staleness can be tolerated.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    def get(self, key):
+        try:
+            return self.client.execute('GET', key)
+        except (OSError, EOFError, ReplyError):
+            # A cache outage shouldn't take the site down with it
+            return None
+
+    def set(self, key, value, ttl, tags):
+        ttl_ms = int(ttl * 1000)
+        try:
+            self.client.execute('SET', key, value, 'PX', ttl_ms)
+            for tag in tags:
+                self.client.execute('SADD', f"tag:{tag}", key)
+                self.client.execute('PEXPIRE', f"tag:{tag}", ttl_ms)
+                for prefix in ancestors(tag)[:-1]:
+                    self.client.execute('SADD', f"under:{prefix}", tag)
+                    self.client.execute('PEXPIRE', f"under:{prefix}", ttl_ms)
+        except (OSError, EOFError, ReplyError):
+            pass
+
+    def invalidate(self, tag):
+        try:
+            tags = set(ancestors(tag))
+            tags |= {t.decode() for t in self.client.execute('SMEMBERS', f"under:{tag}")}
+            keys = set()
+            for covered in tags:
+                keys |= set(self.client.execute('SMEMBERS', f"tag:{covered}"))
+            if keys:
+                self.client.execute('DEL', *keys)
+        except (OSError, EOFError, ReplyError):
+            # Entries still expire by TTL
+            pass
+
+    def clear(self):
+        self.client.execute('FLUSHDB')
+
+
+##############################################################################
+# Cache front end
+
+
+class QueryCache:
+    """Run selected queries through the configured backend."""
+
+    def __init__(self, app=None):
+        self.backend = None
+        self.ttl = DEFAULT_TTL
+        # Bumped on every invalidation; see ``_store``
+        self.generation = 0
+        self.subscription = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        name = app.config.setdefault('QUERY_CACHE_BACKEND', 'none')
+        self.ttl = app.config.setdefault('QUERY_CACHE_TTL', DEFAULT_TTL)
+
+        if name == 'memory':
+            max_bytes = app.config.setdefault('QUERY_CACHE_MAX_BYTES', 64 * 1024 * 1024)
+            self.backend = MemoryBackend(max_bytes)
+        elif name == 'redis':
+            url = app.config.setdefault('QUERY_CACHE_URL', 'redis://localhost:6379/0')
+            self.backend = RedisBackend(RespClient.from_url(url))
+        else:
+            self.backend = None
+
+        if self.subscription is not None:
+            bus.unsubscribe(self.subscription)
+            self.subscription = None
+        if self.backend is not None:
+            self.subscription = bus.subscribe(None, self.invalidate)
+
+    def invalidate(self, tag):
+        self.generation += 1
+        self.backend.invalidate(tag)
+
+    def clear(self):
+        if self.backend is not None:
+            self.backend.clear()
+
+    @staticmethod
+    def key_for(query):
+        """Cache key from a query's SQL and bound parameters."""
+        compiled = query.statement.compile(dialect=db.engine.dialect)
+        params = sorted((name, repr(value)) for name, value in compiled.params.items())
+        digest = hashlib.sha1(f"{compiled}|{params}".encode()).hexdigest()
+        return f"q:{digest}"
+
+    def all(self, query, tags=(), ttl=None):
+        """``query.all()``, from the cache when possible.
+
+        ``tags`` name what the result depends on beyond the rows returned
+        (e.g. ``follows:followers:5`` for a follower list). Without any,
+        the result is tagged with the whole tables it reads from.
+        """
+        if self.backend is None:
+            return query.all()
+
+        key = self.key_for(query)
+        cached = self.backend.get(key)
+        if cached is not None:
+            return list(query.merge_result(pickle.loads(cached), load=False))
+
+        generation = self.generation
+        results = query.all()
+
+        tags = set(tags) or {table.name for table in query.statement.froms
+                             if hasattr(table, 'name')}
+        for row in results:
+            for obj in (row if isinstance(row, tuple) else (row,)):
+                table = getattr(obj, '__table__', None)
+                if table is not None:
+                    tags.update(row_tags(table.name, ObjectRow(obj)))
+
+        self._store(key, results, tags, ttl, generation)
+        return results
+
+    def get(self, model, ident, ttl=None):
+        """``model.query.get(ident)``, from the cache when possible."""
+        # Already in this session: no need for either the cache or the database
+        obj = db.session.identity_map.get(db.session.identity_key(model, ident))
+        if obj is not None or self.backend is None:
+            return obj if obj is not None else model.query.get(ident)
+
+        table = model.__table__
+        (pk,) = table.primary_key.columns
+        results = self.all(model.query.filter(pk == ident),
+                           tags=[f"{table.name}:{ident}"], ttl=ttl)
+        return results[0] if results else None
+
+    def get_or_404(self, model, ident, ttl=None):
+        obj = self.get(model, ident, ttl)
+        if obj is None:
+            abort(404)
+        return obj
+
+    def _store(self, key, results, tags, ttl, generation):
+        # If anything was invalidated while the query ran, the result may
+        # predate that write; leave it uncached rather than risk keeping it.
+        # The generation is per process, so with a shared backend this only
+        # catches invalidations that have already arrived (see RedisBackend)
+        if self.generation != generation:
+            return
+        self.backend.set(key, pickle.dumps(results), ttl or self.ttl, tags)
+
+
+cache = QueryCache()
+
+
+##############################################################################
+# Stand-in Redis-protocol server
+
+
+class StandInStore:
+    """The subset of Redis the cache uses, in memory."""
+
+    def __init__(self):
+        self.values = {}
+        self.sets = defaultdict(set)
+        self.expires = {}
+        self.lock = threading.Lock()
+
+    def _live(self, key):
+        expires = self.expires.get(key)
+        if expires is not None and expires < time.monotonic():
+            self.values.pop(key, None)
+            self.sets.pop(key, None)
+            del self.expires[key]
+
+    def execute(self, command, *args):
+        command = command.upper()
+        with self.lock:
+            for key in args[:1]:
+                self._live(key)
+
+            if command == b'PING':
+                return 'PONG'
+            if command == b'SELECT':
+                return 'OK'
+            if command == b'GET':
+                return self.values.get(args[0])
+            if command == b'SET':
+                self.values[args[0]] = args[1]
+                self.expires.pop(args[0], None)
+                if len(args) == 4 and args[2].upper() == b'PX':
+                    self.expires[args[0]] = time.monotonic() + int(args[3]) / 1000
+                return 'OK'
+            if command == b'DEL':
+                removed = 0
+                for key in args:
+                    removed += (self.values.pop(key, None) is not None
+                                or self.sets.pop(key, None) is not None)
+                    self.expires.pop(key, None)
+                return removed
+            if command == b'SADD':
+                members = self.sets[args[0]]
+                before = len(members)
+                members.update(args[1:])
+                return len(members) - before
+            if command == b'SMEMBERS':
+                return list(self.sets.get(args[0], ()))
+            if command == b'PEXPIRE':
+                if args[0] not in self.values and args[0] not in self.sets:
+                    return 0
+                self.expires[args[0]] = time.monotonic() + int(args[1]) / 1000
+                return 1
+            if command == b'FLUSHDB':
+                self.values.clear()
+                self.sets.clear()
+                self.expires.clear()
+                return 'OK'
+            raise ReplyError(f"ERR unknown command '{command.decode()}'")
+
+
+def encode_reply(value):
+    if isinstance(value, ReplyError):
+        return b'-%s\r\n' % str(value).encode()
+    if value is None:
+        return b'$-1\r\n'
+    if isinstance(value, str):
+        return b'+%s\r\n' % value.encode()
+    if isinstance(value, int):
+        return b':%d\r\n' % value
+    if isinstance(value, bytes):
+        return b'$%d\r\n%s\r\n' % (len(value), value)
+    return b'*%d\r\n' % len(value) + b''.join(encode_reply(item) for item in value)
+
+
+class StandInHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        while True:
+            try:
+                args = read_reply(self.rfile)
+            except EOFError:
+                return
+            try:
+                reply = self.server.store.execute(*args)
+            except ReplyError as error:
+                reply = error
+            self.wfile.write(encode_reply(reply))
+
+
+class StandInServer(socketserver.ThreadingTCPServer):
+    """Serve a StandInStore over the Redis protocol."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=('localhost', 6379)):
+        super().__init__(address, StandInHandler)
+        self.store = StandInStore()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Warbler query cache tools.")
+    parser.add_argument('command', choices=['serve'])
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=6379)
+    args = parser.parse_args(argv)
+
+    server = StandInServer((args.host, args.port))
+    print(f"Serving the query cache on {args.host}:{args.port}")
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
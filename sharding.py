@@ -0,0 +1,579 @@
+"""Hash-sharding of messages and likes across several databases.
+
+Off unless SHARDS names two or more binds from SQLALCHEMY_BINDS, e.g.:
+
+    SQLALCHEMY_BINDS = {'shard0': 'sqlite:///shard0.db',
+                        'shard1': 'postgresql:///warbler_shard1'}
+    SHARDS = ['shard0', 'shard1']
+
+Users and follows stay in the main database. A message lives on the shard
+of its author, and a like on the shard of the message it likes, so a
+message and its likes are always together (and ON DELETE CASCADE still
+works). Authors hash to one of NUM_BUCKETS logical buckets, and the
+``shard_buckets`` table in the main database maps buckets to shards, so
+resharding moves whole buckets without rehashing anyone. Message ids
+carry the author's bucket in their node bits (see ``ids.next_id_for``),
+so any message or like can be routed from its message id alone.
+
+The models route themselves: ``db`` uses RoutingSession, which flushes each
+object to its shard, and ShardedQuery, which sends Message/Likes queries
+to the shard(s) they need. A query that can't be routed (no ``set_shard``,
+no primary key, not ``user.messages``) runs on every shard: the results are
+merged in ORDER BY order and LIMIT/OFFSET applied again to the merge, which
+needs the ORDER BY columns to be among those selected (it raises
+otherwise). The homepage uses ``timeline`` instead, which queries only the
+authors' shards, in parallel.
+
+Nothing can join messages or likes to users, which stay in the main
+database: live.py's replay and the JSON API look them up separately when
+sharding is on. bulk_load.py, which loads the generator's CSVs, only fills
+a single database and refuses to run sharded; turning sharding on for an
+existing database means reloading its messages and likes onto the shards
+with new, bucket-carrying ids.
+
+Move buckets between shards with:
+
+    python sharding.py rebalance      # spread buckets evenly over SHARDS
+    python sharding.py move 17 shard2 # move one bucket
+"""
+
+import argparse
+import heapq
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import cmp_to_key
+from itertools import chain, islice
+from operator import attrgetter, itemgetter
+
+from flask_sqlalchemy import BaseQuery, SignallingSession, SQLAlchemy
+from sqlalchemy import MetaData, Table, Column, Integer, String, exc, orm, tuple_
+from sqlalchemy.orm import exc as orm_exc, loading
+from sqlalchemy.orm.query import _ColumnEntity, _MapperEntity
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import UnaryExpression
+
+from ids import MAX_NODE, NODE_SHIFT, node_of
+from invalidation import bus
+
+logger = logging.getLogger(__name__)
+
+# Logical buckets; one per possible node id, so a bucket fits in an id
+NUM_BUCKETS = MAX_NODE + 1
+
+# Invalidation tag published when the bucket map changes
+MAP_TAG = 'shard_map'
+
+# Seconds to let other processes pick up a new bucket map during a move
+MOVE_GRACE = 5
+
+# Rows copied per statement when moving a bucket
+COPY_BATCH = 1000
+
+shard_metadata = MetaData()
+
+shard_buckets = Table(
+    'shard_buckets', shard_metadata,
+    Column('bucket', Integer, primary_key=True, autoincrement=False),
+    Column('shard', String(100), nullable=False),
+)
+
+
+def bucket_for_user(user_id):
+    """The bucket an author's messages belong to.
+
+    A multiplicative hash, so consecutive user ids spread over all buckets.
+    """
+    return (user_id * 2654435761) % (1 << 32) % NUM_BUCKETS
+
+
+def bucket_expression(id_column):
+    """SQL for the bucket encoded in a message id column."""
+    return (id_column / (1 << NODE_SHIFT)) % NUM_BUCKETS
+
+
+def default_map(shards):
+    """Contiguous, equal ranges of buckets for each shard, in order."""
+    return [shards[bucket * len(shards) // NUM_BUCKETS] for bucket in range(NUM_BUCKETS)]
+
+
+class ShardRouter:
+    """Knows which shard every author, message and like lives on."""
+
+    def __init__(self):
+        self.app = None
+        self.db = None
+        self.shards = []
+        self.bucket_map = []
+        # Mapped class -> function(instance) giving the bucket it belongs to
+        self.bucket_of = {}
+        # Mapped class -> function(primary key) giving the bucket, if knowable
+        self.bucket_of_key = {}
+        self.subscription = None
+
+    @property
+    def enabled(self):
+        return len(self.shards) > 1
+
+    def register(self, cls, bucket_of, bucket_of_key=None):
+        """Shard ``cls`` by ``bucket_of(instance)``."""
+        self.bucket_of[cls] = bucket_of
+        if bucket_of_key is not None:
+            self.bucket_of_key[cls] = bucket_of_key
+
+    def is_sharded(self, mapper):
+        return self.enabled and mapper is not None and mapper.class_ in self.bucket_of
+
+    def init_app(self, app, db):
+        self.app = app
+        self.db = db
+        self.shards = list(app.config.setdefault('SHARDS', []))
+
+        if self.subscription is not None:
+            bus.unsubscribe(self.subscription)
+            self.subscription = None
+
+        if self.enabled:
+            with app.app_context():
+                self.create_all()
+                self.load_map()
+            self.subscription = bus.subscribe(MAP_TAG, lambda tag: self.load_map())
+
+    def engine(self, shard):
+        return self.db.get_engine(self.app, bind=shard)
+
+    def create_all(self):
+        """Create the bucket map and each shard's tables."""
+        shard_metadata.create_all(self.db.get_engine(self.app))
+        tables = shard_tables([m.local_table for m in self._mappers()])
+        for shard in self.shards:
+            tables.create_all(self.engine(shard))
+
+    def _mappers(self):
+        return [orm.class_mapper(cls) for cls in self.bucket_of]
+
+    def load_map(self):
+        """Read the bucket map, defaulting unassigned buckets to even ranges."""
+        bucket_map = default_map(self.shards)
+        with self.db.get_engine(self.app).connect() as conn:
+            for bucket, shard in conn.execute(shard_buckets.select()):
+                bucket_map[bucket] = shard
+        self.bucket_map = bucket_map
+
+    def assign(self, bucket, shard):
+        """Point ``bucket`` at ``shard`` for every process."""
+        with self.db.get_engine(self.app).begin() as conn:
+            updated = conn.execute(shard_buckets.update()
+                                   .where(shard_buckets.c.bucket == bucket)
+                                   .values(shard=shard)).rowcount
+            if not updated:
+                conn.execute(shard_buckets.insert().values(bucket=bucket, shard=shard))
+        self.bucket_map[bucket] = shard
+        bus.publish(MAP_TAG)
+
+    def shard_for_bucket(self, bucket):
+        return self.bucket_map[bucket]
+
+    def shard_for_user(self, user_id):
+        return self.bucket_map[bucket_for_user(user_id)]
+
+    def shard_for_message(self, message_id):
+        return self.bucket_map[node_of(message_id)]
+
+    def shard_for_instance(self, instance):
+        return self.bucket_map[self.bucket_of[type(instance)](instance)]
+
+    def shard_for_key(self, cls, ident):
+        """The shard holding ``cls``'s row with primary key ``ident``, or None."""
+        bucket_of_key = self.bucket_of_key.get(cls)
+        if bucket_of_key is None:
+            return None
+        if isinstance(ident, (tuple, list)):
+            (ident,) = ident
+        return self.bucket_map[bucket_of_key(ident)]
+
+    def group_by_shard(self, keys, shard_for):
+        """Split ``keys`` into {shard: [key, ...]} using ``shard_for(key)``."""
+        groups = {}
+        for key in keys:
+            groups.setdefault(shard_for(key), []).append(key)
+        return groups
+
+
+router = ShardRouter()
+
+
+def shard_tables(tables):
+    """Copies of ``tables`` for a shard, minus foreign keys to other tables."""
+    shard_md = MetaData()
+    names = {table.name for table in tables}
+
+    for table in tables:
+        copy = table.tometadata(shard_md)
+        for constraint in list(copy.foreign_key_constraints):
+            if constraint.elements[0].target_fullname.split('.')[0] not in names:
+                copy.constraints.discard(constraint)
+                copy.foreign_keys.difference_update(constraint.elements)
+                for column in constraint.columns:
+                    column.foreign_keys.difference_update(constraint.elements)
+    return shard_md
+
+
+##############################################################################
+# Session and query routing
+
+
+class RoutingSession(SignallingSession):
+    """A session that writes each sharded object to its own shard."""
+
+    def __init__(self, db, **options):
+        super().__init__(db, **options)
+        # Used by the unit of work to pick a connection per flushed object
+        if router.enabled:
+            self.connection_callable = self._connection_for_instance
+
+    def _connection_for_instance(self, mapper=None, instance=None, **kw):
+        shard = None
+        if instance is not None and router.is_sharded(mapper):
+            shard = router.shard_for_instance(instance)
+        return self.connection(mapper=mapper, shard=shard)
+
+    def get_bind(self, mapper=None, clause=None, shard=None):
+        if shard is not None:
+            return router.engine(shard)
+        return super().get_bind(mapper, clause)
+
+
+class ShardedQuery(BaseQuery):
+    """A query that runs sharded models on the shard(s) that hold them."""
+
+    _shard = None
+
+    def set_shard(self, shard):
+        """Run this query on ``shard`` only."""
+        query = self._clone()
+        query._shard = shard
+        return query
+
+    def _shards(self):
+        """Shards to run on, or None for the main database."""
+        # An explicit shard wins even where the mapper is hidden (count()
+        # wraps the query in a subquery)
+        if self._shard is not None:
+            return [self._shard]
+        if not router.is_sharded(self._bind_mapper()):
+            return None
+
+        # user.messages: everything is on the author's shard
+        instance = getattr(self, 'instance', None)
+        attr = getattr(self, 'attr', None)
+        if (instance is not None and attr is not None and attr.key == 'messages'):
+            return [router.shard_for_user(instance.id)]
+
+        return router.shards
+
+    def _connection_from_session(self, **kw):
+        # Used by bulk UPDATE/DELETE and by ``_execute_and_instances``
+        kw.setdefault('shard', self._shard)
+        return super()._connection_from_session(**kw)
+
+    def _execute_and_instances(self, querycontext):
+        shards = self._shards()
+        if shards is None:
+            return super()._execute_and_instances(querycontext)
+
+        limit, offset = self._limit, self._offset or 0
+        scattered = len(shards) > 1
+        if scattered:
+            # Raises unless the rows can be merged in ORDER BY order
+            order_key = self._merge_key()
+            if limit is not None or offset:
+                # Every shard's first offset + limit rows, cut down after the merge
+                query = self._clone()
+                query._offset = None
+                query._limit = None if limit is None else offset + limit
+                querycontext = query._compile_context()
+                querycontext.statement.use_labels = True
+
+        pages = []
+        for shard in shards:
+            conn = self._connection_from_session(
+                mapper=self._bind_mapper(), clause=querycontext.statement,
+                close_with_result=True, shard=shard)
+            result = conn.execute(querycontext.statement, self._params)
+            pages.append(list(loading.instances(querycontext.query, result, querycontext)))
+
+        if not scattered:
+            return iter(pages[0])
+        if order_key is None:
+            rows = chain.from_iterable(pages)
+        else:
+            rows = heapq.merge(*pages, key=order_key)
+        return islice(rows, offset, None if limit is None else offset + limit)
+
+    def _merge_key(self):
+        """Sort key putting rows from several shards back in ORDER BY order.
+
+        None if the query isn't ordered. Only ORDER BY columns that come
+        back in the rows (a column of a selected entity, or a selected
+        column) can be merged on; anything else raises.
+        """
+        if not self._order_by:
+            return None
+
+        entities = self._entities
+        single = len(entities) == 1 and entities[0].supports_single_entity
+        getters = []
+        for clause in self._order_by:
+            element, descending = clause, False
+            while isinstance(element, UnaryExpression):
+                if element.modifier is operators.desc_op:
+                    descending = True
+                element = element.element
+            getter = _row_getter(entities, single, element)
+            if getter is None:
+                raise exc.InvalidRequestError(
+                    f"Can't merge rows from several shards ordered by {clause}; "
+                    "order by selected columns or use set_shard()")
+            getters.append((getter, descending))
+
+        def compare(a, b):
+            for getter, descending in getters:
+                x, y = getter(a), getter(b)
+                if x == y:
+                    continue
+                # NULLs sort last ascending and first descending, as in Postgres
+                less = y is None if x is None or y is None else x < y
+                return (1 if less else -1) if descending else (-1 if less else 1)
+            return 0
+
+        return cmp_to_key(compare)
+
+    def get(self, ident):
+        if router.is_sharded(self._bind_mapper()) and self._shard is None:
+            shard = router.shard_for_key(self._bind_mapper().class_, ident)
+            if shard is not None:
+                return self.set_shard(shard).get(ident)
+        return super().get(ident)
+
+    def count(self):
+        shards = self._shards()
+        if shards is None or len(shards) == 1:
+            return super(ShardedQuery, self.set_shard(shards[0]) if shards else self).count()
+        return sum(self.set_shard(shard).count() for shard in shards)
+
+    def delete(self, synchronize_session='evaluate'):
+        shards = self._shards()
+        if shards is None or len(shards) == 1:
+            query = self.set_shard(shards[0]) if shards else self
+            return super(ShardedQuery, query).delete(synchronize_session)
+        return sum(self.set_shard(shard).delete(synchronize_session) for shard in shards)
+
+    def update(self, values, synchronize_session='evaluate', update_args=None):
+        shards = self._shards()
+        if shards is None or len(shards) == 1:
+            query = self.set_shard(shards[0]) if shards else self
+            return super(ShardedQuery, query).update(values, synchronize_session, update_args)
+        return sum(self.set_shard(shard).update(values, synchronize_session, update_args)
+                   for shard in shards)
+
+
+def _row_getter(entities, single, column):
+    """A function reading ``column``'s value out of a result row, or None."""
+    for index, entity in enumerate(entities):
+        if isinstance(entity, _MapperEntity):
+            try:
+                key = entity.mapper.get_property_by_column(column).key
+            except (orm_exc.UnmappedColumnError, AttributeError):
+                continue
+            read = attrgetter(key)
+        elif isinstance(entity, _ColumnEntity) and entity.column.shares_lineage(column):
+            read = None
+        else:
+            continue
+
+        if single:
+            return read or (lambda row: row)
+        if read is None:
+            return itemgetter(index)
+        return lambda row, index=index, read=read: read(row[index])
+    return None
+
+
+class ShardedSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy with routing sessions and queries."""
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault('query_class', ShardedQuery)
+        super().__init__(**kwargs)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+##############################################################################
+# Scatter-gather
+
+
+def timeline(model, author_ids, limit, newest_first):
+    """The newest ``limit`` ``model`` rows by any of ``author_ids``.
+
+    Each shard holding some of the authors is queried in parallel for its
+    own newest ``limit`` rows; the pages are merged newest-first and cut
+    to ``limit``. Results are attached to the current session without
+    another query.
+    """
+    session = router.db.session
+    groups = router.group_by_shard(set(author_ids), router.shard_for_user)
+
+    def fetch(shard, ids):
+        shard_session = orm.Session(bind=router.engine(shard))
+        try:
+            rows = (shard_session.query(model)
+                    .filter(model.user_id.in_(ids))
+                    .order_by(*newest_first)
+                    .limit(limit)
+                    .all())
+            shard_session.expunge_all()
+            return rows
+        finally:
+            shard_session.close()
+
+    with ThreadPoolExecutor(max_workers=max(len(groups), 1)) as pool:
+        pages = list(pool.map(lambda item: fetch(*item), groups.items()))
+
+    # Message ids are time-ordered, so they order the merge
+    merged = heapq.merge(*pages, key=lambda row: row.id, reverse=True)
+    return [session.merge(row, load=False) for row in islice(merged, limit)]
+
+
+##############################################################################
+# Resharding
+
+
+def bucket_rows(conn, table, key_columns, bucket, bucket_column):
+    """Keys of every row of ``table`` in ``bucket``."""
+    query = (table.select().with_only_columns(key_columns)
+             .where(bucket_expression(bucket_column) == bucket))
+    return {tuple(row) for row in conn.execute(query)}
+
+
+def sync_table(source, target, table, key_columns, bucket, bucket_column, copy_columns,
+               delete_extra=True):
+    """Make ``bucket``'s rows of ``table`` on ``target`` match ``source``.
+
+    With ``delete_extra`` off, only copies what's missing: rows only the
+    target has are kept.
+    """
+    key = key_columns[0] if len(key_columns) == 1 else None
+
+    with source.connect() as src, target.begin() as dst:
+        wanted = bucket_rows(src, table, key_columns, bucket, bucket_column)
+        have = bucket_rows(dst, table, key_columns, bucket, bucket_column)
+
+        extra = sorted(have - wanted) if delete_extra else []
+        missing = sorted(wanted - have)
+
+        for start in range(0, len(extra), COPY_BATCH):
+            chunk = extra[start:start + COPY_BATCH]
+            dst.execute(table.delete().where(_keys_in(key_columns, key, chunk)))
+
+        for start in range(0, len(missing), COPY_BATCH):
+            chunk = missing[start:start + COPY_BATCH]
+            rows = src.execute(table.select().with_only_columns(copy_columns)
+                               .where(_keys_in(key_columns, key, chunk)))
+            rows = [dict(row) for row in rows]
+            if rows:
+                dst.execute(table.insert(), rows)
+
+    return len(missing), len(extra)
+
+
+def _keys_in(key_columns, key, chunk):
+    if key is not None:
+        return key.in_([k for (k,) in chunk])
+    return tuple_(*key_columns).in_(chunk)
+
+
+def move_bucket(bucket, target_shard, messages, likes, grace=MOVE_GRACE):
+    """Move one bucket's messages and likes to ``target_shard``.
+
+    Copy, switch the map, give every process ``grace`` seconds to notice,
+    copy again to catch anything written to the old shard in the meantime,
+    then delete the old copy. Each step only does what's left, so a move
+    that dies part way can just be run again.
+
+    Once the map is switched, new posts and likes land on the target, so
+    the second copy never deletes rows only the target has. The price is
+    that a delete or unlike that reached the old shard during the grace
+    period comes back.
+    """
+    source_shard = router.shard_for_bucket(bucket)
+    if source_shard == target_shard:
+        return
+
+    source = router.engine(source_shard)
+    target = router.engine(target_shard)
+    messages_bucket = messages.c.id
+    likes_bucket = likes.c.message_id
+
+    def sync(delete_extra):
+        # Likes depend on messages: drop stale likes before messages, and
+        # copy messages before likes
+        copied = sync_table(source, target, messages, [messages.c.id], bucket,
+                            messages_bucket, list(messages.c), delete_extra)
+        sync_table(source, target, likes, [likes.c.user_id, likes.c.message_id],
+                   bucket, likes_bucket,
+                   [c for c in likes.c if c.name != 'id'], delete_extra)
+        return copied
+
+    logger.info("Moving bucket %s from %s to %s", bucket, source_shard, target_shard)
+    # Nothing writes to the target yet: anything only it has is left over
+    # from an earlier, abandoned move
+    sync(delete_extra=True)
+    router.assign(bucket, target_shard)
+    time.sleep(grace)
+    sync(delete_extra=False)
+
+    with source.begin() as conn:
+        conn.execute(likes.delete().where(bucket_expression(likes_bucket) == bucket))
+        conn.execute(messages.delete().where(bucket_expression(messages_bucket) == bucket))
+
+
+def rebalance(messages, likes, grace=MOVE_GRACE):
+    """Move buckets so they're spread evenly over the configured shards."""
+    moves = [(bucket, shard) for bucket, shard in enumerate(default_map(router.shards))
+             if router.shard_for_bucket(bucket) != shard]
+    for bucket, shard in moves:
+        move_bucket(bucket, shard, messages, likes, grace)
+    return len(moves)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Move Warbler shard buckets.")
+    sub = parser.add_subparsers(dest='command')
+    sub.required = True
+    sub.add_parser('rebalance')
+    move = sub.add_parser('move')
+    move.add_argument('bucket', type=int)
+    move.add_argument('shard')
+    parser.add_argument('--grace', type=float, default=MOVE_GRACE)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+
+    from app import app
+    from models import Likes, Message
+
+    with app.app_context():
+        if not router.enabled:
+            parser.error("SHARDS names fewer than two binds; nothing to do")
+        messages, likes = Message.__table__, Likes.__table__
+        if args.command == 'move':
+            move_bucket(args.bucket, args.shard, messages, likes, args.grace)
+        else:
+            print(f"Moved {rebalance(messages, likes, args.grace)} buckets")
+
+
+if __name__ == '__main__':
+    main()
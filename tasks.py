@@ -0,0 +1,137 @@
+"""Job handlers for work that routes hand off to the job queue.
+
+See jobs.py for how and where these run. Handlers may be retried, so each
+one must be safe to run more than once.
+"""
+
+import time
+from datetime import datetime
+
+from flask import current_app
+
+import archive
+import export
+import mentions
+
+from invalidation import bus
+from jobs import job
+from models import db, AccountDeletion, ArchivedMessages, Follows, Likes, Message, User
+from sharding import router
+
+def delete_in_batches(table, where, key_columns, batch_size, progress_column,
+                      user_id, pause=0, engine=None):
+    """Delete rows of ``table`` matching ``where``, ``batch_size`` at a time.
+
+    Each batch is its own short transaction, picked by primary key with a
+    LIMITed subquery, and bumps ``progress_column`` on the user's
+    AccountDeletion row in the same transaction. Returns the rows deleted.
+
+    ``engine`` is a shard to delete from; progress is then recorded in the
+    main database straight after each batch instead.
+    """
+    deletions = AccountDeletion.__table__
+    key = db.tuple_(*key_columns) if len(key_columns) > 1 else key_columns[0]
+    total = 0
+
+    def record(conn, deleted):
+        conn.execute(deletions.update()
+                     .where(deletions.c.user_id == user_id)
+                     .values({progress_column: progress_column + deleted,
+                              'updated_at': datetime.utcnow()}))
+
+    while True:
+        batch = db.select(key_columns).where(where).limit(batch_size)
+
+        with (engine or db.engine).begin() as conn:
+            deleted = conn.execute(table.delete().where(key.in_(batch))).rowcount
+            if engine is None:
+                record(conn, deleted)
+
+        if engine is not None:
+            with db.engine.begin() as conn:
+                record(conn, deleted)
+
+        total += deleted
+        if deleted < batch_size:
+            return total
+
+        # Give concurrent writers a turn at the locks
+        if pause:
+            time.sleep(pause)
+
+
+@job(max_attempts=3, background=True)
+def delete_account(user_id, batch_size=None, pause=0):
+    """Delete a user and everything that belongs to them, in small batches.
+
+    Rather than loading the user's rows into the session, this runs bounded
+    set-based DELETEs: the user's likes, follows in both directions, then
+    messages (whose likes go with them via ON DELETE CASCADE), and finally the
+    user row itself. Progress is recorded on the AccountDeletion row, and
+    since every step only deletes what's left, a retry just carries on.
+    """
+    batch_size = batch_size or current_app.config.get('ACCOUNT_DELETE_BATCH_SIZE', 1000)
+    deletions = AccountDeletion.__table__
+    likes = Likes.__table__
+    follows = Follows.__table__
+    messages = Message.__table__
+
+    AccountDeletion.request(user_id).status = 'running'
+    db.session.commit()
+
+    # With sharding, the user's likes can be on any shard and their
+    # messages are on their own
+    if router.enabled:
+        like_engines = [router.engine(shard) for shard in router.shards]
+        message_engine = router.engine(router.shard_for_user(user_id))
+    else:
+        like_engines = [None]
+        message_engine = None
+
+    for engine in like_engines:
+        delete_in_batches(likes, likes.c.user_id == user_id, [likes.c.id],
+                          batch_size, deletions.c.likes_deleted, user_id, pause, engine)
+
+    for column in (follows.c.user_following_id, follows.c.user_being_followed_id):
+        delete_in_batches(follows, column == user_id,
+                          [follows.c.user_being_followed_id, follows.c.user_following_id],
+                          batch_size, deletions.c.follows_deleted, user_id, pause)
+
+    delete_in_batches(messages, messages.c.user_id == user_id, [messages.c.id],
+                      batch_size, deletions.c.messages_deleted, user_id, pause,
+                      message_engine)
+
+    # Their archived messages are a handful of chunks: one DELETE does it
+    chunks = ArchivedMessages.__table__
+    with (message_engine or db.engine).begin() as conn:
+        conn.execute(chunks.delete().where(chunks.c.user_id == user_id))
+
+    with db.engine.begin() as conn:
+        conn.execute(User.__table__.delete().where(User.__table__.c.id == user_id))
+        conn.execute(deletions.update()
+                     .where(deletions.c.user_id == user_id)
+                     .values(status='done', updated_at=datetime.utcnow(),
+                             finished_at=datetime.utcnow()))
+
+    # These deletes bypassed the session, so publish their invalidations by
+    # hand. The user's rows are scattered through other users' follower
+    # lists and liked messages, so (this being rare) drop whole tables.
+    bus.publish(f"users:{user_id}", 'messages', 'follows', 'likes')
+
+
+@job(max_attempts=3)
+def archive_messages(batch_size=archive.BATCH_SIZE):
+    """Move messages past the archive horizon into compressed cold storage."""
+    archive.archive_old_messages(batch_size=batch_size)
+
+
+@job(max_attempts=3)
+def backfill_mentions(chunk_size=mentions.BACKFILL_CHUNK, after_id=0):
+    """Index the mentions and hashtags of messages posted before they were parsed."""
+    mentions.backfill(chunk_size, after_id)
+
+
+@job(max_attempts=3)
+def export_account(user_id, path=None):
+    """Write a user's data export to a local file (for accounts too big to stream)."""
+    export.write_export(user_id, path)
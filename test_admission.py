@@ -0,0 +1,170 @@
+"""Admission control tests."""
+
+# run these tests like:
+#    python -m unittest test_admission.py
+
+import json
+import threading
+from unittest import TestCase
+
+from flask import Flask
+from werkzeug.test import Client
+from werkzeug.wrappers import Response
+
+from admission import AdaptiveLimiter, AdmissionController, Shed, classify
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def limiter(**kwargs):
+    settings = dict(limit=2, min_limit=1, max_limit=8, max_queue=1,
+                    deadline=0.05, target_latency=0.1)
+    settings.update(kwargs)
+    return AdaptiveLimiter(**settings)
+
+
+class ClassifyTestCase(TestCase):
+    """Test sorting requests into route classes."""
+
+    def test_classify(self):
+        def env(path, method='GET'):
+            return {'PATH_INFO': path, 'REQUEST_METHOD': method}
+
+        self.assertEqual(classify(env('/login', 'POST')), 'auth')
+        self.assertEqual(classify(env('/signup')), 'auth')
+        self.assertEqual(classify(env('/')), 'timeline')
+        self.assertEqual(classify(env('/api/v1/timeline')), 'timeline')
+        self.assertEqual(classify(env('/messages/new', 'POST')), 'writes')
+        self.assertEqual(classify(env('/api/v1/likes', 'DELETE')), 'writes')
+        self.assertEqual(classify(env('/static/stylesheets/style.css')), 'static')
+        self.assertEqual(classify(env('/users/1')), 'default')
+        self.assertIsNone(classify(env('/stream')))
+
+
+class LimiterTestCase(TestCase):
+    """Test the adaptive limiter."""
+
+    def test_queue_full_sheds(self):
+        """Past the limit and a full queue, requests are shed at once."""
+        lim = limiter(limit=1, max_queue=0)
+        lim.acquire()
+        with self.assertRaises(Shed) as cm:
+            lim.acquire()
+        self.assertEqual(cm.exception.reason, 'queue_full')
+        self.assertEqual(lim.metrics()['queue_full'], 1)
+
+    def test_deadline_sheds(self):
+        """A queued request gives up at its deadline."""
+        lim = limiter(limit=1)
+        lim.acquire()
+        with self.assertRaises(Shed) as cm:
+            lim.acquire()
+        self.assertEqual(cm.exception.reason, 'deadline')
+        self.assertEqual(lim.metrics()['queued'], 0)
+
+    def test_queued_request_admitted(self):
+        """A slot freed before the deadline goes to the waiting request."""
+        lim = limiter(limit=1, deadline=5)
+        started = lim.acquire()
+        admitted = []
+        waiter = threading.Thread(target=lambda: admitted.append(lim.acquire()))
+        waiter.start()
+
+        lim.release(started)
+        waiter.join(5)
+        self.assertEqual(len(admitted), 1)
+        self.assertEqual(lim.metrics()['admitted'], 2)
+
+    def test_adapts_to_latency(self):
+        """Slow requests cut the limit; fast ones at the limit raise it."""
+        clock = FakeClock()
+        lim = limiter(limit=4, clock=clock)
+
+        started = lim.acquire()
+        clock.now += 1.0
+        lim.release(started)
+        self.assertAlmostEqual(lim.limit, 3.6)
+
+        # Back-to-back slow responses only cut it once per target interval
+        started = lim.acquire()
+        lim.release(started - 1.0)
+        self.assertAlmostEqual(lim.limit, 3.6)
+
+        starts = [lim.acquire() for _ in range(3)]
+        clock.now += 0.5
+        for started in starts:
+            clock.now += 0.01
+            lim.release(clock.now - 0.01)
+        self.assertGreater(lim.limit, 3.6)
+
+
+class MiddlewareTestCase(TestCase):
+    """Test the WSGI middleware."""
+
+    def setUp(self):
+        self.release = threading.Event()
+        self.entered = threading.Event()
+
+        def slow_app(environ, start_response):
+            self.entered.set()
+            self.release.wait(5)
+            return Response("ok")(environ, start_response)
+
+        self.controller = AdmissionController()
+        self.controller.limiters = {'auth': limiter(limit=1, max_queue=0)}
+        self.controller.wsgi_app = slow_app
+        self.client = Client(self.controller, Response)
+
+    def request(self, method, path):
+        # Buffered, so the response is closed and its slot freed, as a
+        # WSGI server would
+        return self.client.open(path, method=method, buffered=True)
+
+    def test_shed_with_retry_after(self):
+        """Over the limit a route class gets a fast 503; others pass."""
+        first = threading.Thread(target=lambda: self.request('POST', '/login'))
+        first.start()
+        self.entered.wait(5)
+
+        resp = self.request('POST', '/login')
+        self.assertEqual(resp.status_code, 503)
+        self.assertIn('Retry-After', resp.headers)
+
+        self.release.set()
+        first.join(5)
+        self.assertEqual(self.request('GET', '/users/1').status_code, 200)
+        self.assertEqual(self.request('POST', '/login').status_code, 200)
+
+        metrics = json.loads(self.request('GET', '/_status/admission').get_data())
+        self.assertEqual(metrics['auth']['queue_full'], 1)
+        self.assertEqual(metrics['auth']['admitted'], 2)
+        self.assertEqual(metrics['auth']['in_flight'], 0)
+
+    def test_app_wrapped(self):
+        """The app's routes still answer through the controller."""
+        wrapped = Flask('admission')
+        wrapped.config['ADMISSION_ENABLED'] = True
+        wrapped.add_url_rule('/users/<int:user_id>', 'user', lambda user_id: "ok")
+        AdmissionController(wrapped)
+
+        client = wrapped.test_client()
+        self.assertEqual(client.get('/users/1', buffered=True).status_code, 200)
+        resp = client.get('/_status/admission')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.get_json()['default']['in_flight'], 0)
+
+    def test_slot_held_until_closed(self):
+        """An unclosed response keeps its slot; closing it gives it back."""
+        self.release.set()
+        resp = self.client.open('/login', method='POST')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(self.request('POST', '/login').status_code, 503)
+
+        resp.close()
+        self.assertEqual(self.request('POST', '/login').status_code, 200)
@@ -0,0 +1,106 @@
+"""JSON API tests."""
+
+# run these tests like:
+#    python -m unittest test_api.py
+
+# Use test database (one per parallel worker; see testing.py)
+from testing import TransactionTestCase, make_follows, make_messages, make_user
+
+from app import app, CURR_USER_KEY
+from models import Follows, Likes
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['TESTING'] = True
+
+
+class APITestCase(TransactionTestCase):
+    """Test the /api/v1 endpoints."""
+
+    def setUp(self):
+        """Create two users, a follow and a few messages."""
+        super().setUp()
+
+        self.client = app.test_client()
+        self.user = make_user("apiuser", email="api@test.com")
+        self.other = make_user("other")
+        make_follows(self.user, [self.other])
+        self.other_messages = make_messages(self.other, 5, text="other {}")
+        make_messages(self.user, 1, text="mine")
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user.id
+
+    def test_timeline_pagination(self):
+        """The timeline pages through every message exactly once."""
+        seen = []
+        url = "/api/v1/timeline?limit=2"
+
+        while url:
+            data = self.client.get(url).get_json()
+            seen.extend(msg['id'] for msg in data['data'])
+            self.assertIn(str(self.other.id), data['users'])
+            url = (f"/api/v1/timeline?limit=2&cursor={data['next_cursor']}"
+                   if data['next_cursor'] else None)
+
+        self.assertEqual(len(seen), 6)
+        self.assertEqual(len(set(seen)), 6)
+
+    def test_sparse_fields(self):
+        """Only the requested fields (plus id) come back."""
+        data = self.client.get(f"/api/v1/users/{self.other.id}?fields=username").get_json()
+        self.assertEqual(set(data['data']), {'id', 'username', 'counts'})
+        self.assertEqual(data['data']['counts']['followers'], 1)
+
+    def test_unknown_field(self):
+        """Asking for a non-public field is an error."""
+        resp = self.client.get(f"/api/v1/users/{self.user.id}?fields=password")
+        self.assertEqual(resp.status_code, 400)
+
+    def test_batch_users(self):
+        """Many users can be fetched by id; unknown ids are skipped."""
+        ids = f"{self.user.id},{self.other.id},99999"
+        data = self.client.get(f"/api/v1/users?ids={ids}").get_json()
+        self.assertEqual({u['username'] for u in data['data']}, {'apiuser', 'other'})
+
+    def test_followers(self):
+        """Followers are listed with default compact fields."""
+        data = self.client.get(f"/api/v1/users/{self.other.id}/followers").get_json()
+        self.assertEqual(data['data'], [{'id': self.user.id, 'username': 'apiuser',
+                                         'image_url': '/static/images/default-pic.png'}])
+
+    def test_timeline_requires_login(self):
+        """Anonymous timeline requests get a JSON 401."""
+        with self.client.session_transaction() as sess:
+            del sess[CURR_USER_KEY]
+        resp = self.client.get("/api/v1/timeline")
+        self.assertEqual(resp.status_code, 401)
+        self.assertIn('error', resp.get_json())
+
+    def test_bulk_follow(self):
+        """Bulk follow reports an outcome per id and skips duplicates."""
+        third = make_user("third")
+
+        ids = [third.id, self.other.id, self.user.id, 99999]
+        data = self.client.post("/api/v1/follows", json={'ids': ids}).get_json()
+
+        self.assertEqual([r['result'] for r in data['results']],
+                         ['followed', 'already_following', 'self', 'not_found'])
+        self.assertEqual(Follows.query.filter_by(user_following_id=self.user.id).count(), 2)
+
+        data = self.client.delete("/api/v1/follows", json={'ids': [third.id, 99999]}).get_json()
+        self.assertEqual(data['counts'], {'unfollowed': 1, 'not_following': 1})
+
+    def test_bulk_like(self):
+        """Bulk like inserts each like once."""
+        ids = [msg.id for msg in self.other_messages]
+        first = self.client.post("/api/v1/likes", json={'ids': ids}).get_json()
+        again = self.client.post("/api/v1/likes", json={'ids': ids}).get_json()
+
+        self.assertEqual(first['counts'], {'liked': 5})
+        self.assertEqual(again['counts'], {'already_liked': 5})
+        self.assertEqual(Likes.query.filter_by(user_id=self.user.id).count(), 5)
+
+    def test_bulk_requires_json(self):
+        """Form-encoded bulk writes are rejected."""
+        resp = self.client.post("/api/v1/likes", data={'ids': '1'})
+        self.assertEqual(resp.status_code, 400)
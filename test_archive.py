@@ -0,0 +1,96 @@
+"""Message archive tests."""
+
+# run these tests like:
+#    python -m unittest test_archive.py
+
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+# Use test database (one per parallel worker; see testing.py)
+import testing
+
+from app import app, CURR_USER_KEY
+from archive import archive_old_messages, archived_count, older_messages
+from models import db, ArchivedMessages, Likes, Message, User
+
+app.config['TESTING'] = True
+
+
+class ArchiveTestCase(TestCase):
+    """Test moving old messages to the archive and reading them back."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        self.client = app.test_client()
+        self.user = User.signup("archivist", "arch@test.com", "password", None)
+        self.fan = User.signup("fan", "fan@test.com", "password", None)
+        db.session.commit()
+        self.user_id, self.fan_id = self.user.id, self.fan.id
+
+        # Five messages from two years ago, three from today
+        now = datetime.utcnow()
+        for days in (800, 790, 780, 770, 760, 2, 1, 0):
+            db.session.add(Message(text=f"{days} days ago", user_id=self.user_id,
+                                   timestamp=now - timedelta(days=days)))
+        db.session.commit()
+
+        self.oldest = Message.query.filter_by(text="800 days ago").one()
+        db.session.add(Likes(user_id=self.fan_id, message_id=self.oldest.id))
+        db.session.commit()
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+    def tearDown(self):
+        db.session.remove()
+
+    def archive(self, **kwargs):
+        with app.app_context():
+            return archive_old_messages(**kwargs)
+
+    def test_archive_moves_old_messages(self):
+        """Old messages leave the hot table, likes and all."""
+        self.assertEqual(self.archive(batch_size=2), 5)
+
+        self.assertEqual(Message.query.count(), 3)
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertEqual(ArchivedMessages.query.count(), 3)
+        self.assertEqual(archived_count(self.user_id), 5)
+
+        # Running again finds nothing left to do
+        self.assertEqual(self.archive(), 0)
+
+    def test_older_messages(self):
+        """The archive reads back newest first, below a cursor."""
+        self.archive(batch_size=2)
+
+        texts = [msg['text'] for msg in older_messages([self.user_id], None, 3)]
+        self.assertEqual(texts, ["760 days ago", "770 days ago", "780 days ago"])
+
+        archived = older_messages([self.user_id], None, 10)
+        before = (archived[1]['timestamp'], archived[1]['id'])
+        texts = [msg['text'] for msg in older_messages([self.user_id], before, 10)]
+        self.assertEqual(texts, ["780 days ago", "790 days ago", "800 days ago"])
+
+        self.assertEqual(archived[-1]['liked_by'], [self.fan_id])
+
+    def test_api_pages_into_archive(self):
+        """API cursors run on past the hot table into the archive."""
+        self.archive()
+
+        texts = []
+        url = f"/api/v1/users/{self.user_id}/messages?limit=3"
+        while url:
+            data = self.client.get(url).get_json()
+            texts.extend(msg['text'] for msg in data['data'])
+            url = (f"/api/v1/users/{self.user_id}/messages?limit=3&cursor={data['next_cursor']}"
+                   if data['next_cursor'] else None)
+
+        self.assertEqual(len(texts), 8)
+        self.assertEqual(texts[0], "0 days ago")
+        self.assertEqual(texts[-1], "800 days ago")
+
+        data = self.client.get(f"/api/v1/users/{self.user_id}").get_json()
+        self.assertEqual(data['data']['counts']['messages'], 8)
@@ -0,0 +1,151 @@
+"""Bulk loader tests."""
+
+# run these tests like:
+#    python -m unittest test_bulk_load.py
+
+import csv
+import io
+import os
+import tempfile
+from unittest import TestCase, mock
+
+# Use test database (one per parallel worker; see testing.py)
+import testing
+
+from sqlalchemy import inspect
+
+from app import app
+import bulk_load
+from bulk_load import load_all, load_progress, progress_metadata
+from models import db, Follows, Mentions, Message, MessageTags, User
+
+app.config['TESTING'] = True
+
+USERS = [[f"user{i}@test.com", f"user{i}", "", testing.password_hash("password"), "", "", ""]
+         for i in range(5)]
+MESSAGES = [[f"warble {i}", f"2017-01-0{i % 9 + 1} 12:00:00.000000", str(i % 5 + 1)]
+            for i in range(7)]
+FOLLOWS = [["1", "2"], ["2", "1"], ["3", "1"]]
+
+
+class BulkLoadTestCase(TestCase):
+    """Test loading the generator CSVs, resuming, and what's rebuilt after."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.write_csv('users.csv', ['email', 'username', 'image_url', 'password', 'bio',
+                                     'header_image_url', 'location'], USERS)
+        self.write_csv('messages.csv', ['text', 'timestamp', 'user_id'], MESSAGES)
+        self.write_csv('follows.csv', ['user_being_followed_id', 'user_following_id'], FOLLOWS)
+        self.out = io.StringIO()
+
+    def tearDown(self):
+        db.session.remove()
+        progress_metadata.drop_all(bind=db.engine)
+        self.tmp.cleanup()
+
+    def write_csv(self, name, header, rows):
+        with open(os.path.join(self.tmp.name, name), 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            writer.writerows(rows)
+
+    def load(self, resume=False):
+        return load_all(self.tmp.name, chunk_size=2, resume=resume, out=self.out)
+
+    def constraint_names(self, table_name):
+        inspector = inspect(db.engine)
+        return ({ix['name'] for ix in inspector.get_indexes(table_name)},
+                {tuple(uc['column_names']) for uc in inspector.get_unique_constraints(table_name)},
+                {tuple(fk['constrained_columns']) for fk in inspector.get_foreign_keys(table_name)})
+
+    def test_load(self):
+        self.assertEqual(self.load(), len(USERS) + len(MESSAGES) + len(FOLLOWS))
+
+        self.assertEqual([user.username for user in User.query.order_by(User.id)],
+                         [row[1] for row in USERS])
+        self.assertEqual([msg.id for msg in Message.query.order_by(Message.id)],
+                         list(range(1, len(MESSAGES) + 1)))
+        self.assertEqual(Follows.query.count(), len(FOLLOWS))
+
+    def test_mentions_indexed(self):
+        """Loaded messages' mentions and hashtags are indexed."""
+        self.write_csv('messages.csv', ['text', 'timestamp', 'user_id'],
+                       MESSAGES + [["hi @user2 #loaded", "2017-02-01 12:00:00.000000", "1"]])
+        self.load()
+
+        self.assertEqual([(row.user_id, row.message_id) for row in Mentions.query],
+                         [(3, len(MESSAGES) + 1)])
+        self.assertEqual([(row.tag, row.message_id) for row in MessageTags.query],
+                         [("loaded", len(MESSAGES) + 1)])
+
+    def test_constraints_restored(self):
+        db.create_all()
+        before = {name: self.constraint_names(name) for name in ('users', 'messages', 'follows')}
+        self.assertIn(('email',), before['users'][1])
+        self.assertIn('ix_messages_timestamp_id', before['messages'][0])
+
+        self.load()
+        after = {name: self.constraint_names(name) for name in ('users', 'messages', 'follows')}
+        self.assertEqual(after, before)
+
+        # ... and tables created afterwards still get them
+        db.drop_all()
+        db.create_all()
+        again = {name: self.constraint_names(name) for name in ('users', 'messages', 'follows')}
+        self.assertEqual(again, before)
+
+    def test_constraints_deferred_while_loading(self):
+        seen = {}
+
+        def load_table(engine, table, path, chunk_size, out):
+            seen[table.name] = self.constraint_names(table.name)
+            return 0
+
+        with mock.patch.object(bulk_load, 'load_table', load_table):
+            self.load()
+
+        indexes, unique, foreign = seen['messages']
+        self.assertNotIn('ix_messages_timestamp_id', indexes)
+        self.assertEqual(foreign, set())
+        self.assertEqual(seen['users'][1], set())
+
+    def test_resume(self):
+        """A load that fails part-way picks up after its last committed chunk."""
+        copy_chunk = bulk_load.copy_chunk
+        calls = []
+
+        def fail_on_second_messages_chunk(conn, table, columns, rows):
+            if table.name == 'messages':
+                calls.append(rows)
+                if len(calls) == 2:
+                    raise RuntimeError("connection lost")
+            copy_chunk(conn, table, columns, rows)
+
+        with mock.patch.object(bulk_load, 'copy_chunk', fail_on_second_messages_chunk):
+            with self.assertRaises(RuntimeError):
+                self.load()
+
+        with db.engine.connect() as conn:
+            progress = {row.table_name: row.rows_loaded
+                        for row in conn.execute(load_progress.select())}
+        self.assertEqual(progress, {'users': len(USERS), 'messages': 2})
+
+        self.assertEqual(self.load(resume=True), len(MESSAGES) - 2 + len(FOLLOWS))
+        self.assertIn("messages: resuming after 2 rows", self.out.getvalue())
+        self.assertEqual([(msg.id, msg.text) for msg in Message.query.order_by(Message.id)],
+                         [(i + 1, row[0]) for i, row in enumerate(MESSAGES)])
+        self.assertEqual(User.query.count(), len(USERS))
+
+    def test_reset_sequence(self):
+        """Rows added after a load get ids past the loaded ones."""
+        self.load()
+
+        user = User.signup("newcomer", "newcomer@test.com", "password", None)
+        db.session.commit()
+        self.assertEqual(user.id, len(USERS) + 1)
+
+        msg = Message(text="first!", user_id=user.id)
+        db.session.add(msg)
+        db.session.commit()
+        self.assertEqual(msg.id, len(MESSAGES) + 1)
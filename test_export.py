@@ -0,0 +1,105 @@
+"""Account export tests."""
+
+# run these tests like:
+#    python -m unittest test_export.py
+
+import io
+import json
+import os
+import tempfile
+import zipfile
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta
+from unittest import mock
+
+# Use test database (one per parallel worker; see testing.py)
+from testing import TransactionTestCase
+
+from app import app, CURR_USER_KEY
+from archive import archive_old_messages
+import export
+from export import write_export
+from models import db, Follows, Likes, Message, User
+
+app.config['TESTING'] = True
+
+
+def read_export(data):
+    """{file name: [row, ...]} from an export zip's bytes."""
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        return {name: [json.loads(line) for line in archive.read(name).splitlines()]
+                for name in archive.namelist()}
+
+
+class ExportTestCase(TransactionTestCase):
+    """Test exporting a user's data."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.user = User.signup("exporter", "exporter@test.com", "password", None)
+        self.friend = User.signup("friend", "friend@test.com", "password", None)
+        db.session.commit()
+        self.user_id, self.friend_id = self.user.id, self.friend.id
+
+        now = datetime.utcnow()
+        for days in (800, 2, 1):
+            db.session.add(Message(text=f"{days} days ago", user_id=self.user_id,
+                                   timestamp=now - timedelta(days=days)))
+        friend_msg = Message(text="friend's warble", user_id=self.friend_id)
+        db.session.add(friend_msg)
+        db.session.add(Follows(user_following_id=self.user_id, user_being_followed_id=self.friend_id))
+        db.session.commit()
+
+        db.session.add(Likes(user_id=self.user_id, message_id=friend_msg.id))
+        db.session.commit()
+        with app.app_context():
+            archive_old_messages()
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+    def check(self, files):
+        self.assertEqual(set(files), {'profile.ndjson', 'messages.ndjson', 'likes.ndjson',
+                                      'following.ndjson', 'followers.ndjson'})
+        self.assertEqual(files['profile.ndjson'][0]['username'], "exporter")
+        self.assertNotIn('password', files['profile.ndjson'][0])
+        self.assertEqual([msg['text'] for msg in files['messages.ndjson']],
+                         ["800 days ago", "2 days ago", "1 days ago"])
+        self.assertTrue(files['messages.ndjson'][0]['archived'])
+        self.assertEqual([like['text'] for like in files['likes.ndjson']], ["friend's warble"])
+        self.assertEqual([user['id'] for user in files['following.ndjson']], [self.friend_id])
+        self.assertEqual(files['followers.ndjson'], [])
+
+    def test_streamed_download(self):
+        resp = self.client.get("/users/export")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'application/zip')
+        self.assertIn('attachment', resp.headers['Content-Disposition'])
+        self.check(read_export(resp.get_data()))
+
+    def test_write_to_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "export.zip")
+            with app.app_context():
+                self.assertEqual(write_export(self.user_id, path), path)
+            with open(path, 'rb') as f:
+                self.check(read_export(f.read()))
+
+    def test_queued_job(self):
+        """``export.py --queue`` runs the export_account job into EXPORT_ROOT."""
+        with tempfile.TemporaryDirectory() as tmp:
+            with mock.patch.dict(app.config, EXPORT_ROOT=tmp), redirect_stdout(io.StringIO()):
+                export.main([str(self.user_id), '--queue'])
+            [name] = os.listdir(tmp)
+            self.assertTrue(name.startswith(f"warbler-{self.user_id}-"))
+            with open(os.path.join(tmp, name), 'rb') as f:
+                self.check(read_export(f.read()))
+
+    def test_requires_login(self):
+        resp = self.client.get("/users/export")
+        self.assertEqual(resp.status_code, 200)
+        with self.client.session_transaction() as sess:
+            del sess[CURR_USER_KEY]
+        self.assertEqual(self.client.get("/users/export").status_code, 302)
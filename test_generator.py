@@ -0,0 +1,39 @@
+"""CSV generator tests."""
+
+# run these tests like:
+#    python -m unittest test_generator.py
+
+import os
+import tempfile
+from unittest import TestCase, mock
+
+from generator import create_csvs
+from generator.create_csvs import generate
+
+TABLES = ['users.csv', 'messages.csv', 'follows.csv']
+
+
+class GenerateTestCase(TestCase):
+    """Test that output depends on the seed alone."""
+
+    def generate(self, seed=1, workers=1):
+        """{file name: contents} of one small run, split over several shards."""
+        with tempfile.TemporaryDirectory() as out_dir, \
+                mock.patch.object(create_csvs, 'ROWS_PER_SHARD', 100):
+            counts = generate(out_dir, 300, 1000, 2000, seed=seed, workers=workers)
+            self.assertEqual(sorted(os.listdir(out_dir)), sorted(TABLES))
+            files = {}
+            for name in TABLES:
+                with open(os.path.join(out_dir, name), 'rb') as f:
+                    files[name] = f.read()
+        self.assertEqual(counts['users'], 300)
+        self.assertEqual(counts['messages'], 1000)
+        return files
+
+    def test_workers_dont_change_output(self):
+        """One worker and several write byte-identical CSVs."""
+        self.assertEqual(self.generate(workers=1), self.generate(workers=4))
+
+    def test_seed_changes_output(self):
+        self.assertNotEqual(self.generate(seed=1)['messages.csv'],
+                            self.generate(seed=2)['messages.csv'])
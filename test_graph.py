@@ -0,0 +1,153 @@
+"""Follow graph index tests."""
+
+# run these tests like:
+#    python -m unittest test_graph.py
+
+from unittest import TestCase
+
+# Use test database (one per parallel worker; see testing.py)
+import testing
+
+from app import app, CURR_USER_KEY
+from graph import DEFAULT_SUGGESTIONS_CACHE, Adjacency, Direction, graph
+from models import db, Follows, User
+
+app.config['TESTING'] = True
+
+
+class AdjacencyTestCase(TestCase):
+    """Test the CSR arrays and their deltas."""
+
+    def setUp(self):
+        self.edges = Direction(Adjacency.build([(1, 2), (1, 3), (2, 3), (4, 1)]))
+
+    def test_rows(self):
+        self.assertEqual(list(self.edges.row(1)), [2, 3])
+        self.assertEqual(list(self.edges.row(3)), [])
+        self.assertTrue(self.edges.has_edge(4, 1))
+        self.assertFalse(self.edges.has_edge(1, 4))
+        self.assertEqual(self.edges.count(1), 2)
+
+    def test_deltas(self):
+        """Added and removed edges show through, and survive compaction."""
+        self.edges.add(1, 5)
+        self.edges.remove(1, 2)
+        self.edges.add(3, 1)
+        self.assertEqual(list(self.edges.row(1)), [3, 5])
+        self.assertTrue(self.edges.has_edge(3, 1))
+        self.assertFalse(self.edges.has_edge(1, 2))
+        self.assertEqual(self.edges.count(1), 2)
+
+        compacted = self.edges.compacted()
+        self.assertEqual(list(compacted.edges()), [(1, 3), (1, 5), (2, 3), (3, 1), (4, 1)])
+        self.assertEqual(compacted.delta_size, 0)
+
+
+class FollowGraphTestCase(TestCase):
+    """Test loading the graph, keeping it current and suggesting follows."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        self.users = [User.signup(f"user{i}", f"user{i}@test.com", "password", None)
+                      for i in range(5)]
+        db.session.commit()
+        self.ids = [user.id for user in self.users]
+        a, b, c, d, e = self.ids
+
+        # a follows b and c; both of them follow d, and c follows e
+        for follower, followed in [(a, b), (a, c), (b, d), (c, d), (c, e), (d, a)]:
+            db.session.add(Follows(user_following_id=follower, user_being_followed_id=followed))
+        db.session.commit()
+
+        graph.load()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+
+    def test_queries(self):
+        a, b, c, d, e = self.ids
+        self.assertTrue(graph.is_following(a, b))
+        self.assertFalse(graph.is_following(b, a))
+        self.assertEqual(graph.following_count(a), 2)
+        self.assertEqual(graph.followers_count(d), 2)
+        self.assertEqual(graph.mutuals(d), [])
+        self.assertEqual(graph.suggestions_for(a), [(d, 2), (e, 1)])
+
+    def test_deltas_from_commits(self):
+        """Committed follows and unfollows reach the graph on sync."""
+        a, b, c, d, e = self.ids
+        Follows.add_many(a, [d])
+        Follows.remove_many(c, [e])
+        db.session.commit()
+
+        graph.sync()
+        self.assertTrue(graph.is_following(a, d))
+        self.assertEqual(graph.followers_count(e), 0)
+        self.assertEqual(graph.mutuals(a), [d])
+        self.assertEqual(graph.suggestions_for(a), [])
+
+    def test_syncs_serialised(self):
+        """Follower rows are re-read with other syncs and loads locked out."""
+        a, b, c, d, e = self.ids
+        refresh = graph._refresh
+        held = []
+
+        def check_lock(follower_ids):
+            held.append(graph.load_lock.locked())
+            refresh(follower_ids)
+
+        Follows.add_many(a, [d])
+        db.session.commit()
+        graph._refresh = check_lock
+        try:
+            graph.sync()
+        finally:
+            del graph._refresh
+        self.assertEqual(held, [True])
+        self.assertTrue(graph.is_following(a, d))
+
+    def test_suggestions_bounded(self):
+        """Only the most recently asked-for suggestions are kept."""
+        a, b, c, d, e = self.ids
+        graph.max_suggested = 2
+        try:
+            for user_id in (a, b, c, a):
+                graph.suggestions_for(user_id)
+            self.assertEqual(list(graph.suggested), [c, a])
+        finally:
+            graph.max_suggested = DEFAULT_SUGGESTIONS_CACHE
+
+    def test_stale_suggestions_not_kept(self):
+        """Suggestions computed across a follow change aren't cached."""
+        a, b, c, d, e = self.ids
+        compute = graph._friends_of_friends
+
+        def compute_then_change(user_id):
+            result = compute(user_id)
+            Follows.add_many(c, [b])
+            db.session.commit()
+            graph.sync()
+            return result
+
+        graph._friends_of_friends = compute_then_change
+        try:
+            graph.suggestions_for(a)
+        finally:
+            del graph._friends_of_friends
+        self.assertNotIn(a, graph.suggested)
+
+    def test_suggestions_page(self):
+        a, b, c, d, e = self.ids
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = a
+
+        resp = self.client.get("/users/suggestions")
+        html = resp.get_data(as_text=True)
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("@user3", html)
+        self.assertIn("Followed by 2 people you follow", html)
+        self.assertNotIn("@user1", html)
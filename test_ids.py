@@ -0,0 +1,79 @@
+"""Time-ordered id tests."""
+
+# run these tests like:
+#    python -m unittest test_ids.py
+
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from ids import (EPOCH, IdGenerator, MAX_NODE, MAX_SEQUENCE, min_id_for, next_id_for,
+                 node_of, timestamp_of)
+
+
+class IdGeneratorTestCase(TestCase):
+    """Test ordering, layout and edge cases of IdGenerator."""
+
+    def setUp(self):
+        """Use a controllable clock starting at 2024-01-01."""
+        self.now = datetime(2024, 1, 1).timestamp()
+        self.gen = IdGenerator(5, clock=lambda: self.now)
+
+    def test_ids_increase(self):
+        """Ids from one generator are strictly increasing."""
+        ids = [self.gen.next_id() for _ in range(1000)]
+        self.assertEqual(ids, sorted(set(ids)))
+
+    def test_layout(self):
+        """Node and timestamp can be read back out of an id."""
+        new_id = self.gen.next_id()
+        self.assertEqual(node_of(new_id), 5)
+        self.assertEqual(timestamp_of(new_id), datetime.utcfromtimestamp(self.now))
+        self.assertLess(new_id, 2 ** 63)
+
+    def test_sequence_rollover_waits(self):
+        """Exhausting a millisecond's sequence moves on to the next millisecond."""
+        ticks = iter([self.now] * (MAX_SEQUENCE + 2) + [self.now + 0.001] * 10)
+        gen = IdGenerator(1, clock=lambda: next(ticks))
+        ids = [gen.next_id() for _ in range(MAX_SEQUENCE + 2)]
+        self.assertEqual(ids, sorted(set(ids)))
+        self.assertGreater(timestamp_of(ids[-1]), timestamp_of(ids[0]))
+
+    def test_bad_node(self):
+        """Node ids outside 10 bits are rejected."""
+        with self.assertRaises(ValueError):
+            IdGenerator(1024)
+
+
+class NodeIdTestCase(TestCase):
+    """Test ids carrying a caller's node id, and time cursors."""
+
+    def test_node_round_trips(self):
+        """next_id_for's node id (a shard bucket) can be read back out."""
+        for node_id in (0, 1, 517, MAX_NODE):
+            ids = [next_id_for(node_id) for _ in range(50)]
+            self.assertEqual({node_of(new_id) for new_id in ids}, {node_id})
+            self.assertEqual(ids, sorted(set(ids)))
+
+    def test_bad_node(self):
+        with self.assertRaises(ValueError):
+            next_id_for(MAX_NODE + 1)
+
+    def test_min_id_for_boundary(self):
+        """Every id issued at or after a moment is >= min_id_for(moment)."""
+        moment = datetime(2024, 1, 1)
+        # Seconds since the epoch with ``moment`` read as UTC, like min_id_for
+        now = (moment - datetime(1970, 1, 1)).total_seconds()
+        gen = IdGenerator(MAX_NODE, clock=lambda: now)
+        at = gen.next_id()
+
+        self.assertEqual(timestamp_of(min_id_for(moment)), moment)
+        self.assertLessEqual(min_id_for(moment), at)
+        # ... and every id from the millisecond before is below it
+        before = IdGenerator(MAX_NODE, clock=lambda: now - 0.001)
+        for _ in range(MAX_SEQUENCE):
+            before.next_id()
+        self.assertLess(before.next_id(), min_id_for(moment))
+        self.assertLess(at, min_id_for(moment + timedelta(milliseconds=1)))
+
+    def test_min_id_for_before_epoch(self):
+        self.assertEqual(min_id_for(EPOCH - timedelta(days=1)), 0)
@@ -0,0 +1,94 @@
+"""Image upload tests."""
+
+# run these tests like:
+#    python -m unittest test_images.py
+
+import io
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from PIL import Image
+
+# Use test database (one per parallel worker; see testing.py)
+import testing
+
+from app import app
+from images import (InvalidImage, check_image, content_hash, images, resize,
+                    sized, write_atomic)
+
+app.config['TESTING'] = True
+
+
+def png_bytes(size=(800, 600), color='red'):
+    out = io.BytesIO()
+    Image.new('RGB', size, color).save(out, 'PNG')
+    return out.getvalue()
+
+
+class ImagesTestCase(TestCase):
+    """Test checking, resizing and serving uploads."""
+
+    def setUp(self):
+        self.client = app.test_client()
+        self.media_root = images.media_root
+        images.media_root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(images.media_root)
+        images.media_root = self.media_root
+
+    def test_sized(self):
+        """Uploaded URLs switch size; external URLs are left alone."""
+        digest = '0' * 32
+        self.assertEqual(sized(f"/media/{digest}-card.jpg", 'timeline'),
+                         f"/media/{digest}-timeline.jpg")
+        self.assertEqual(sized("http://example.com/a.jpg", 'timeline'),
+                         "http://example.com/a.jpg")
+        self.assertEqual(sized("/static/images/default-pic.png", 'card'),
+                         "/static/images/default-pic.png")
+        self.assertIsNone(sized(None, 'card'))
+
+    def test_check_image(self):
+        """Non-images are refused before any decoding."""
+        check_image(png_bytes())
+        with self.assertRaises(InvalidImage):
+            check_image(b"not an image at all")
+
+    def test_resize(self):
+        """Each size is cropped to fill its box exactly."""
+        data = png_bytes()
+        digest = images.save(data, [])
+
+        self.assertEqual(resize(images.media_root, digest, ['card', 'banner']),
+                         ['card', 'banner'])
+        with Image.open(os.path.join(images.media_root, f"{digest}-card.jpg")) as image:
+            self.assertEqual(image.size, (256, 256))
+        with Image.open(os.path.join(images.media_root, f"{digest}-banner.jpg")) as image:
+            self.assertEqual(image.size, (600, 200))
+
+    def test_serve(self):
+        """Sizes are made on demand and served as immutable."""
+        data = png_bytes(color='blue')
+        digest = images.save(data, [])
+        self.assertEqual(digest, content_hash(data))
+
+        resp = self.client.get(f"/media/{digest}-timeline.jpg")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'image/jpeg')
+        self.assertIn('immutable', resp.headers['Cache-Control'])
+
+        self.assertEqual(self.client.get(f"/media/{'f' * 32}-card.jpg").status_code, 404)
+        self.assertEqual(self.client.get(f"/media/{digest}-original").status_code, 404)
+
+    def test_write_atomic(self):
+        """Writes land whole, readable, and leave no temp files behind."""
+        path = os.path.join(images.media_root, "file")
+        write_atomic(path, b"first")
+        write_atomic(path, b"second")
+
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b"second")
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o644)
+        self.assertEqual(os.listdir(images.media_root), ["file"])
@@ -0,0 +1,114 @@
+"""Cache invalidation bus tests."""
+
+# run these tests like:
+#    python -m unittest test_invalidation.py
+
+import os
+import tempfile
+import threading
+from unittest import TestCase
+
+from invalidation import (InvalidationBus, MemoryBackend, MemoryHub,
+                          SocketBackend, collapse, covers)
+
+
+class TagTestCase(TestCase):
+    """Test how tags relate to each other."""
+
+    def test_covers(self):
+        """Tags cover their parents and children, not their siblings."""
+        self.assertTrue(covers('users:5', 'users:5'))
+        self.assertTrue(covers('users', 'users:5'))
+        self.assertTrue(covers('users:5', 'users'))
+        self.assertFalse(covers('users:5', 'users:50'))
+        self.assertFalse(covers('users:5', 'messages:5'))
+
+    def test_collapse(self):
+        """Oversized batches widen to table-level tags."""
+        tags = {f"users:{i}" for i in range(10)} | {'likes:user:1'}
+        self.assertEqual(collapse(tags, limit=20), tags)
+        self.assertEqual(collapse(tags, limit=5), {'users', 'likes'})
+
+
+class MemoryBusTestCase(TestCase):
+    """Test publishing between two buses sharing a hub."""
+
+    def setUp(self):
+        hub = MemoryHub()
+        self.here = InvalidationBus(MemoryBackend(hub), batch_interval=0)
+        self.there = InvalidationBus(MemoryBackend(hub), batch_interval=0)
+
+    def test_publish_reaches_both_processes(self):
+        """Subscribers here and there both hear about a covering tag."""
+        here, there = [], []
+        self.here.subscribe('users:5', here.append)
+        self.there.subscribe('users', there.append)
+        self.there.subscribe('messages', there.append)
+
+        self.here.publish('users:5')
+
+        self.assertEqual(here, ['users:5'])
+        self.assertEqual(there, ['users:5'])
+
+    def test_batching(self):
+        """Other processes get one batch per interval."""
+        batches = []
+        self.there.backend.deliver = batches.append
+        self.here.batch_interval = 60
+
+        self.here.publish('users:1')
+        self.here.publish('users:2', 'users:1')
+        self.assertEqual(batches, [])
+
+        self.here.flush()
+        self.assertEqual(len(batches), 1)
+        self.assertIn('"users:2"', batches[0])
+
+    def test_unsubscribe(self):
+        """Unsubscribed callbacks aren't called."""
+        seen = []
+        handle = self.there.subscribe(None, seen.append)
+        self.there.unsubscribe(handle)
+
+        self.here.publish('users:1')
+        self.assertEqual(seen, [])
+
+
+class SocketBusTestCase(TestCase):
+    """Test publishing over UNIX sockets."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.here = InvalidationBus(SocketBackend(self.dir), batch_interval=0)
+        self.there = InvalidationBus(SocketBackend(self.dir), batch_interval=0)
+
+    def tearDown(self):
+        self.here.close()
+        self.there.close()
+        os.rmdir(self.dir)
+
+    def test_publish(self):
+        """A batch sent by one bus is received by the other."""
+        received = threading.Event()
+        seen = []
+
+        def on_tag(tag):
+            seen.append(tag)
+            received.set()
+
+        self.there.subscribe('messages', on_tag)
+        self.here.publish('messages:7')
+
+        self.assertTrue(received.wait(5))
+        self.assertEqual(seen, ['messages:7'])
+
+    def test_removes_dead_sockets(self):
+        """Sockets nobody listens on are cleaned up by the sender."""
+        dead = os.path.join(self.dir, 'dead.sock')
+        sock = SocketBackend(self.dir)
+        sock.start(lambda payload: None)
+        sock.sock.close()
+        os.rename(sock.path, dead)
+
+        self.here.publish('users:1')
+        self.assertFalse(os.path.exists(dead))
@@ -0,0 +1,180 @@
+"""Job queue tests."""
+
+# run these tests like:
+#    python -m unittest test_jobs.py
+
+import threading
+from datetime import timedelta
+from unittest import TestCase, mock
+
+# Use test database (one per parallel worker; see testing.py)
+import testing
+
+from app import app
+import jobs
+from jobs import (DatabaseBackend, Job, JobQueue, ThreadPoolBackend, claim_job, finish_job,
+                  job, run_handler, work)
+from models import db
+
+app.config['TESTING'] = True
+
+calls = []
+done = threading.Event()
+
+
+@job(name='test_record', max_attempts=3)
+def record(value, fail_times=0):
+    """Record a call, failing the first ``fail_times`` attempts."""
+    calls.append(value)
+    if calls.count(value) <= fail_times:
+        raise RuntimeError("try again")
+    done.set()
+
+
+@job(name='test_background', background=True)
+def record_thread():
+    """Record which thread ran the job."""
+    calls.append(threading.current_thread())
+    done.set()
+
+
+class JobQueueTestCase(TestCase):
+    """Test the inline, thread and database job backends."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        calls.clear()
+        done.clear()
+
+    def tearDown(self):
+        db.session.remove()
+
+    def test_inline(self):
+        """Inline jobs run before enqueue returns."""
+        queue = JobQueue(app)
+        queue.enqueue('test_record', value='a')
+        self.assertEqual(calls, ['a'])
+
+    def test_inline_background(self):
+        """Background jobs are handed to a thread even by the inline backend."""
+        queue = JobQueue(app)
+        queue.enqueue('test_background')
+        self.assertTrue(done.wait(5))
+        queue.background.executor.shutdown(wait=True)
+        self.assertNotEqual(calls, [threading.current_thread()])
+        self.assertEqual(len(calls), 1)
+
+        # ... which is how account deletion stays out of the POST request
+        self.assertIn('delete_account', jobs._background)
+
+    def test_thread_idempotency_key(self):
+        """A repeated idempotency key is only run once."""
+        queue = JobQueue()
+        queue.backend = ThreadPoolBackend(app, workers=1)
+        queue.enqueue('test_record', idempotency_key='k', value='b')
+        queue.enqueue('test_record', idempotency_key='k', value='b')
+        self.assertTrue(done.wait(5))
+        queue.backend.executor.shutdown(wait=True)
+        self.assertEqual(calls, ['b'])
+
+    def test_backpressure_runs_inline(self):
+        """A full queue runs the job in the caller instead."""
+        queue = JobQueue()
+        queue.backend = ThreadPoolBackend(app, workers=1, max_pending=1)
+        queue.backend.slots.acquire()
+        queue.enqueue('test_record', value='c')
+        self.assertEqual(calls, ['c'])
+
+    def test_database_retry(self):
+        """Failed database jobs are rescheduled, then marked done."""
+        queue = JobQueue()
+        queue.backend = DatabaseBackend(app)
+        queue.enqueue('test_record', value='d', fail_times=1)
+
+        with db.engine.begin() as conn:
+            row = claim_job(conn, stale_after=timedelta(minutes=10))
+        finish_job(row, error="boom")
+
+        job_row = Job.query.one()
+        self.assertEqual(job_row.status, 'pending')
+        self.assertEqual(job_row.attempts, 1)
+        self.assertEqual(job_row.last_error, "boom")
+
+        # Not runnable again until its backoff is up
+        with db.engine.begin() as conn:
+            self.assertIsNone(claim_job(conn, stale_after=timedelta(minutes=10)))
+        Job.query.update({Job.run_at: job_row.created_at})
+        db.session.commit()
+
+        with db.engine.begin() as conn:
+            row = claim_job(conn, stale_after=timedelta(minutes=10))
+        run_handler(app, row.name, {'value': 'd'})
+        finish_job(row)
+
+        db.session.expire_all()
+        job_row = Job.query.one()
+        self.assertEqual(job_row.status, 'done')
+        self.assertEqual(job_row.attempts, 2)
+        self.assertIsNone(job_row.last_error)
+
+    @mock.patch('jobs.backoff', return_value=0)
+    def test_thread_retry(self, backoff):
+        """Failed thread jobs are retried until they succeed."""
+        queue = JobQueue()
+        queue.backend = ThreadPoolBackend(app, workers=1)
+        queue.enqueue('test_record', value='h', fail_times=2)
+        self.assertTrue(done.wait(5))
+        queue.backend.executor.shutdown(wait=True)
+        self.assertEqual(calls, ['h', 'h', 'h'])
+
+    @mock.patch('jobs.backoff', return_value=0)
+    def test_worker(self, backoff):
+        """``work`` runs queued jobs, retrying failures, until stopped."""
+        queue = JobQueue()
+        queue.backend = DatabaseBackend(app)
+        queue.enqueue('test_record', value='i', fail_times=1)
+
+        stop = threading.Event()
+        worker = threading.Thread(target=work, args=(app,),
+                                  kwargs={'poll_interval': 0.01, 'stop': stop})
+        worker.start()
+        self.assertTrue(done.wait(5))
+        stop.set()
+        worker.join(5)
+
+        job_row = Job.query.one()
+        self.assertEqual(job_row.status, 'done')
+        self.assertEqual(job_row.attempts, 2)
+        self.assertEqual(calls, ['i', 'i'])
+
+    def test_stale_job_gives_up(self):
+        """A job whose worker keeps dying is failed after max_attempts claims."""
+        queue = JobQueue()
+        queue.backend = DatabaseBackend(app)
+        queue.enqueue('test_record', value='g')
+
+        for attempt in range(3):
+            with db.engine.begin() as conn:
+                row = claim_job(conn, stale_after=timedelta(0))
+            self.assertEqual(row.attempts, attempt)
+            # ... and the worker dies without calling finish_job
+
+        with db.engine.begin() as conn:
+            self.assertIsNone(claim_job(conn, stale_after=timedelta(0)))
+        job_row = Job.query.one()
+        self.assertEqual(job_row.status, 'failed')
+        self.assertEqual(job_row.attempts, 3)
+
+    def test_database_idempotency_key(self):
+        """A repeated idempotency key only ever inserts one job row."""
+        queue = JobQueue()
+        queue.backend = DatabaseBackend(app)
+        queue.enqueue('test_record', idempotency_key='k', value='e')
+        queue.enqueue('test_record', idempotency_key='k', value='e')
+        queue.enqueue('test_record', value='f')
+        queue.enqueue('test_record', value='f')
+
+        self.assertEqual(Job.query.filter_by(idempotency_key='k').count(), 1)
+        self.assertEqual(Job.query.count(), 3)
+        self.assertEqual(queue.backend.pending, 3)
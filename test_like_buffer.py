@@ -0,0 +1,198 @@
+"""Write-behind like buffer tests."""
+
+# run these tests like:
+#    python -m unittest test_like_buffer.py
+
+import glob
+import json
+import os
+import tempfile
+from unittest import TestCase
+
+# Use test database (one per parallel worker; see testing.py)
+import testing
+
+from app import app, CURR_USER_KEY
+from like_buffer import like_buffer
+from models import db, pending_likes, Likes, Message, User
+import profiles
+
+app.config['TESTING'] = True
+
+
+class LikeBufferTestCase(TestCase):
+    """Test buffering likes and applying them in batches."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        self.user = User.signup("liker", "liker@test.com", "password", None)
+        self.author = User.signup("author", "author@test.com", "password", None)
+        db.session.commit()
+        self.user_id = self.user.id
+
+        self.messages = [Message(text=f"hot take {i}", user_id=self.author.id) for i in range(3)]
+        db.session.add_all(self.messages)
+        db.session.commit()
+        self.message_ids = [msg.id for msg in self.messages]
+
+        self.tmp = tempfile.TemporaryDirectory()
+        app.config['LIKE_WRITE_BEHIND'] = True
+        app.config['LIKE_BUFFER_DIR'] = self.tmp.name
+        # No flusher thread: the tests flush by hand
+        app.config['LIKE_FLUSH_INTERVAL'] = 0
+        like_buffer.init_app(app)
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+    def tearDown(self):
+        app.config['LIKE_WRITE_BEHIND'] = False
+        like_buffer.init_app(app)
+        self.tmp.cleanup()
+        db.session.remove()
+
+    def stored_likes(self):
+        return {(like.user_id, like.message_id) for like in Likes.query}
+
+    def test_like_is_buffered(self):
+        msg_id = self.message_ids[0]
+        resp = self.client.post(f"/messages/{msg_id}/like")
+        self.assertEqual(resp.status_code, 302)
+
+        # Not written yet, but the liker already sees it
+        self.assertEqual(self.stored_likes(), set())
+        user = User.query.get(self.user_id)
+        self.assertTrue(user.has_liked(msg_id))
+        self.assertEqual(user.liked_ids_among(self.message_ids), {msg_id})
+
+        self.assertEqual(like_buffer.flush(), 1)
+        self.assertEqual(self.stored_likes(), {(self.user_id, msg_id)})
+        self.assertEqual(pending_likes, {})
+
+    def test_unlike_is_buffered(self):
+        msg_id = self.message_ids[1]
+        db.session.add(Likes(user_id=self.user_id, message_id=msg_id))
+        db.session.commit()
+
+        self.client.post(f"/messages/{msg_id}/like")
+        self.assertFalse(User.query.get(self.user_id).has_liked(msg_id))
+        self.assertEqual(User.query.get(self.user_id).liked_ids_among(self.message_ids), set())
+
+        like_buffer.flush()
+        self.assertEqual(self.stored_likes(), set())
+
+    def test_toggles_coalesce(self):
+        first, second = self.message_ids[:2]
+        for _ in range(3):
+            self.client.post(f"/messages/{first}/like")
+        for _ in range(2):
+            self.client.post(f"/messages/{second}/like")
+
+        # Liked, unliked, liked; liked, unliked: one intent each
+        self.assertEqual(like_buffer.flush(), 2)
+        self.assertEqual(self.stored_likes(), {(self.user_id, first)})
+
+    def test_posts_wanted_state(self):
+        """Posting the same wanted state twice doesn't flip it back."""
+        msg_id = self.message_ids[0]
+        for _ in range(2):
+            self.client.post(f"/messages/{msg_id}/like", data={'liked': '1'})
+        self.assertTrue(User.query.get(self.user_id).has_liked(msg_id))
+
+        like_buffer.flush()
+        self.client.post(f"/messages/{msg_id}/like", data={'liked': '1'})
+        like_buffer.flush()
+        self.assertEqual(self.stored_likes(), {(self.user_id, msg_id)})
+
+        self.client.post(f"/messages/{msg_id}/like", data={'liked': '0'})
+        like_buffer.flush()
+        self.assertEqual(self.stored_likes(), set())
+
+    def test_profile_counts_pending(self):
+        """The liker's profile and likes page include likes not yet written."""
+        liked, unliked = self.message_ids[:2]
+        db.session.add(Likes(user_id=self.user_id, message_id=unliked))
+        db.session.commit()
+
+        self.client.post(f"/messages/{liked}/like", data={'liked': '1'})
+        self.client.post(f"/messages/{unliked}/like", data={'liked': '0'})
+
+        profile = profiles.load(self.user_id)
+        self.assertEqual(profile.likes_count, 1)
+        self.assertEqual([msg.id for msg in profile.liked], [liked])
+
+        html = self.client.get(f"/users/{self.user_id}/liked").get_data(as_text=True)
+        self.assertIn("hot take 0", html)
+        self.assertNotIn("hot take 1", html)
+
+    def test_show_missing_message(self):
+        self.assertEqual(self.client.get("/messages/999999").status_code, 404)
+
+    def test_shows_pending_like(self):
+        msg_id = self.message_ids[2]
+        self.client.post(f"/messages/{msg_id}/like")
+
+        html = self.client.get(f"/messages/{msg_id}").get_data(as_text=True)
+        self.assertIn("Unlike", html)
+
+    def test_deleted_message_is_skipped(self):
+        msg_id = self.message_ids[0]
+        self.client.post(f"/messages/{msg_id}/like")
+        Message.query.filter_by(id=msg_id).delete()
+        db.session.commit()
+
+        like_buffer.flush()
+        self.assertEqual(self.stored_likes(), set())
+
+    def test_deleted_user_is_skipped(self):
+        """A like by an account deleted before the flush doesn't hold up the rest."""
+        gone = User.signup("gone", "gone@test.com", "password", None)
+        db.session.commit()
+        gone_id = gone.id
+        like_buffer.record(gone_id, self.message_ids[0], True)
+        like_buffer.record(self.user_id, self.message_ids[1], True)
+        User.query.filter_by(id=gone_id).delete()
+        db.session.commit()
+
+        self.assertEqual(like_buffer.flush(), 2)
+        self.assertEqual(self.stored_likes(), {(self.user_id, self.message_ids[1])})
+        self.assertEqual(pending_likes, {})
+
+    def test_log_deleted_after_flush(self):
+        self.client.post(f"/messages/{self.message_ids[0]}/like")
+        self.assertEqual(len(glob.glob(os.path.join(self.tmp.name, '*.log'))), 1)
+
+        like_buffer.flush()
+        # Only the (empty) log that new intents go to
+        logs = glob.glob(os.path.join(self.tmp.name, '*.log'))
+        self.assertEqual(len(logs), 1)
+        self.assertEqual(os.path.getsize(logs[0]), 0)
+
+    def test_replays_dead_process_log(self):
+        like_buffer.close()
+        first, second = self.message_ids[:2]
+        with open(os.path.join(self.tmp.name, 'likes-99999-dead.log'), 'w') as f:
+            f.write(json.dumps({'u': self.user_id, 'm': first, 'l': True}) + '\n')
+            f.write(json.dumps({'u': self.user_id, 'm': second, 'l': True}) + '\n')
+            f.write(json.dumps({'u': self.user_id, 'm': second, 'l': False}) + '\n')
+            # Cut short by the crash
+            f.write('{"u": 1, "m"')
+
+        like_buffer.init_app(app)
+        like_buffer.start()
+        self.assertTrue(User.query.get(self.user_id).has_liked(first))
+
+        like_buffer.flush()
+        self.assertEqual(self.stored_likes(), {(self.user_id, first)})
+        self.assertFalse(os.path.exists(os.path.join(self.tmp.name, 'likes-99999-dead.log')))
+
+    def test_off_by_default(self):
+        app.config['LIKE_WRITE_BEHIND'] = False
+        like_buffer.init_app(app)
+
+        msg_id = self.message_ids[0]
+        self.client.post(f"/messages/{msg_id}/like")
+        self.assertEqual(self.stored_likes(), {(self.user_id, msg_id)})
@@ -0,0 +1,133 @@
+"""Live timeline broker tests."""
+
+# run these tests like:
+#    python -m unittest test_live.py
+
+import json
+from unittest import TestCase
+
+# Use test database (one per parallel worker; see testing.py)
+from testing import TransactionTestCase, make_follows, make_messages, make_user, make_users
+
+from app import app, CURR_USER_KEY
+from live import SUBSCRIBER_BUFFER, Broker, broker, event_stream, format_sse
+
+app.config['TESTING'] = True
+
+
+class BrokerTestCase(TestCase):
+    """Test in-process fan-out of new messages."""
+
+    def setUp(self):
+        self.broker = Broker()
+
+    def test_delivers_to_followers_only(self):
+        """Only subscribers following the author get the event."""
+        fan = self.broker.subscribe({1, 2})
+        other = self.broker.subscribe({3})
+
+        self.broker.publish({'id': 10, 'user_id': 2})
+
+        self.assertEqual(fan.wait(0), [{'id': 10, 'user_id': 2}])
+        self.assertEqual(other.wait(0), [])
+
+    def test_unsubscribe(self):
+        """Unsubscribed streams stop receiving and leave no index entries."""
+        sub = self.broker.subscribe({1})
+        self.broker.unsubscribe(sub)
+        self.broker.publish({'id': 11, 'user_id': 1})
+
+        self.assertEqual(sub.wait(0), [])
+        self.assertEqual(dict(self.broker.by_author), {})
+
+    def test_overflow(self):
+        """A subscriber that falls too far behind is flagged for resync."""
+        sub = self.broker.subscribe({1})
+        for i in range(SUBSCRIBER_BUFFER + 1):
+            self.broker.publish({'id': i, 'user_id': 1})
+
+        self.assertTrue(sub.overflowed)
+
+    def test_format_sse(self):
+        """Events are encoded with id, event name and JSON data."""
+        self.assertEqual(format_sse({'a': 1}, event_id=5, event='x'),
+                         'id: 5\nevent: x\ndata: {"a": 1}\n\n')
+
+
+class StreamTestCase(TransactionTestCase):
+    """Test the /stream route and replay on reconnect."""
+
+    def setUp(self):
+        super().setUp()
+        self.user = make_user()
+        self.user_id = self.user.id
+        [self.followed, self.stranger] = make_users(2, prefix="other")
+        make_follows(self.user, [self.followed])
+        self.followed_id = self.followed.id
+        self.messages = [msg.id for msg in make_messages(self.followed, 3)]
+        make_messages(self.stranger, 2)
+
+    def events(self, chunks, count):
+        """Parse the next ``count`` events (skipping the retry hint)."""
+        events = []
+        while len(events) < count:
+            chunk = next(chunks)
+            chunk = chunk.decode() if isinstance(chunk, bytes) else chunk
+            if chunk.startswith('id:'):
+                events.append(json.loads(chunk.split('data: ', 1)[1]))
+        return events
+
+    def open_stream(self, query='', **headers):
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+        return client.get('/stream' + query, headers=headers)
+
+    def test_anonymous(self):
+        """Logged-out users can't stream."""
+        resp = app.test_client().get('/stream')
+        self.assertEqual(resp.status_code, 401)
+
+    def test_replay_from_header(self):
+        """A reconnect replays followed authors' messages after Last-Event-ID."""
+        resp = self.open_stream(**{'Last-Event-ID': str(self.messages[0])})
+        try:
+            self.assertEqual(resp.mimetype, 'text/event-stream')
+            events = self.events(iter(resp.response), 2)
+        finally:
+            resp.close()
+        self.assertEqual([event['id'] for event in events], self.messages[1:])
+        self.assertEqual({event['username'] for event in events}, {"other0"})
+
+    def test_replay_from_query(self):
+        """The first connection replays from the id the page rendered."""
+        resp = self.open_stream(f'?last_id={self.messages[1]}')
+        try:
+            events = self.events(iter(resp.response), 1)
+        finally:
+            resp.close()
+        self.assertEqual(events[0]['id'], self.messages[2])
+
+    def test_replay_not_repeated(self):
+        """Live events the replay already sent aren't sent again."""
+        stream = event_stream(self.user_id, self.messages[1])
+        try:
+            replayed = self.events(stream, 1)
+
+            # Published while the replay was running, so it's in the buffer too
+            broker.publish(dict(replayed[0]))
+            broker.publish({'id': replayed[0]['id'] + 1, 'user_id': self.followed_id})
+
+            [event] = self.events(stream, 1)
+        finally:
+            stream.close()
+        self.assertEqual(replayed[0]['id'], self.messages[2])
+        self.assertEqual(event['id'], self.messages[2] + 1)
+
+    def test_homepage_passes_last_id(self):
+        """The homepage opens the stream after its newest message."""
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+        html = client.get('/').get_data(as_text=True)
+        self.assertIn(f"/stream?last_id={max(self.messages)}", html)
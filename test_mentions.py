@@ -0,0 +1,96 @@
+"""Mention and hashtag tests."""
+
+# run these tests like:
+#    python -m unittest test_mentions.py
+
+from unittest import TestCase
+
+# Use test database (one per parallel worker; see testing.py)
+from testing import TransactionTestCase
+
+from app import app, CURR_USER_KEY
+from mentions import backfill, extract, mentions_page, tag_page
+from models import db, Mentions, Message, MessageTags, User
+
+app.config['TESTING'] = True
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class ExtractTestCase(TestCase):
+    """Test parsing message text."""
+
+    def test_extract(self):
+        usernames, tags = extract("@alice meet @bob_2 at #PyCon, #pycon #2024 me@example.com")
+        self.assertEqual(usernames, {"alice", "bob_2"})
+        self.assertEqual(tags, {"pycon"})
+
+    def test_nothing(self):
+        self.assertEqual(extract("just a warble"), (set(), set()))
+
+
+class MentionsTestCase(TransactionTestCase):
+    """Test indexing messages and reading the feeds."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.alice = User.signup("alice", "alice@test.com", "password", None)
+        self.bob = User.signup("bob", "bob@test.com", "password", None)
+        db.session.commit()
+        self.alice_id, self.bob_id = self.alice.id, self.bob.id
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.bob_id
+
+    def post(self, text):
+        return self.client.post("/messages/new", data={"text": text})
+
+    def test_posting_indexes(self):
+        """Posting records mentions and tags at write time."""
+        self.post("hi @alice, welcome to #Warbler")
+        self.post("#warbler again, @nobody")
+
+        self.assertEqual(Mentions.query.count(), 1)
+        self.assertEqual(MessageTags.query.count(), 2)
+
+        messages, cursor = tag_page("WARBLER")
+        self.assertEqual([msg.text for msg in messages],
+                         ["#warbler again, @nobody", "hi @alice, welcome to #Warbler"])
+        self.assertIsNone(cursor)
+
+        resp = self.client.get("/tags/warbler")
+        self.assertIn("#warbler again", resp.get_data(as_text=True))
+
+    def test_mentions_feed_pages(self):
+        """The mentions feed pages back with a keyset cursor."""
+        for i in range(5):
+            self.post(f"@alice number {i}")
+
+        messages, cursor = mentions_page(self.alice_id, limit=3)
+        self.assertEqual([msg.text for msg in messages],
+                         ["@alice number 4", "@alice number 3", "@alice number 2"])
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.alice_id
+        html = self.client.get(f"/mentions?before={cursor}").get_data(as_text=True)
+        self.assertIn("@alice number 1", html)
+        self.assertIn("@alice number 0", html)
+        self.assertNotIn("@alice number 2", html)
+
+    def test_delete_unindexes(self):
+        self.post("#gone soon")
+        msg_id = Message.query.one().id
+        self.client.post(f"/messages/{msg_id}/delete")
+        self.assertEqual(MessageTags.query.count(), 0)
+
+    def test_backfill(self):
+        """Existing messages are indexed in chunks, and reruns are harmless."""
+        for i in range(7):
+            db.session.add(Message(text=f"@alice old #backlog {i}", user_id=self.bob_id))
+        db.session.commit()
+
+        self.assertEqual(backfill(chunk_size=3), 7)
+        self.assertEqual(backfill(chunk_size=3), 7)
+        self.assertEqual(Mentions.query.count(), 7)
+        self.assertEqual(MessageTags.query.filter_by(tag="backlog").count(), 7)
@@ -8,48 +8,31 @@ Command for all test files:
     FLASK_ENV=production python -m unittest test_message_views.py
     python -m unittest test_message_model.py
     python -m unittest test_user_views.py
+
+Or every test file at once, one database per CPU:
+    FLASK_ENV=production python -m pytest -n auto
 '''
-import os
-from unittest import TestCase
-from models import db, connect_db, Message, User
-from app import app, db, CURR_USER_KEY
+# Use test database (one per parallel worker; see testing.py)
+from testing import TransactionTestCase, make_user
 
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+from models import db, Message, User
+from app import app, CURR_USER_KEY
 
-db.create_all()
 app.config['WTF_CSRF_ENABLED'] = False
 
-class BaseTestCase(TestCase):
+class BaseTestCase(TransactionTestCase):
     """Base setup for all message-related tests.
 
-    This sets up the test client and creates a sample user for all tests."""
+    This sets up the test client and creates a sample user for all tests.
+    Each test runs in a transaction that's rolled back afterwards."""
 
     def setUp(self):
         """Set up the test environment by creating a test user."""
-        # Clear any existing data in the database
-        User.query.delete()
-        Message.query.delete()
+        super().setUp()
 
         # Create a test client and test user
         self.client = app.test_client()
-
-        self.testuser = User.signup(
-            username="testuser",
-            email="test@test.com",
-            # Password should be hashed in the actual app
-            password="testuser",
-            image_url=None
-        )
-        db.session.commit()
-
-        # Attach to session
-        self.testuser = db.session.merge(self.testuser)  
-        
-    def tearDown(self):
-        """Rollback changes after each test."""
-        db.session.rollback()
-        # Fully clear the session
-        db.session.expunge_all()  
+        self.testuser = make_user("testuser", password="testuser")
 
 class TestMessageCreate(BaseTestCase):
     """Tests for creating messages."""
@@ -110,13 +93,7 @@ class TestMessageDelete(BaseTestCase):
     def test_delete_message_not_owner(self):
         """Test if a user cannot delete another user's message."""
         with self.client as c:
-            other_user = User.signup(
-                username="otheruser", 
-                email="otheruser@test.com",
-                password="HASHED_PASSWORD", 
-                image_url=None
-            )
-            db.session.commit()
+            other_user = make_user("otheruser")
 
             with c.session_transaction() as sess:
                 # Log in as the other user
@@ -156,7 +133,7 @@ class TestMessageLike(BaseTestCase):
 
             # Re-fetch user to ensure they are part of the session
             user = User.query.get(self.testuser.id)
-            self.assertEqual(len(user.likes), 1)
+            self.assertEqual(user.likes.count(), 1)
 
             # Unlike the message
             resp = c.post(f"/messages/{self.msg_id}/like", follow_redirects=True)
@@ -164,7 +141,7 @@ class TestMessageLike(BaseTestCase):
 
             # Re-fetch user and verify like removal
             user = User.query.get(self.testuser.id)
-            self.assertEqual(len(user.likes), 0)
+            self.assertEqual(user.likes.count(), 0)
 
     def test_like_without_login(self):
         """Test like/unlike when not logged in."""
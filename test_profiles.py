@@ -0,0 +1,130 @@
+"""Profile page read model tests."""
+
+# run these tests like:
+#    python -m unittest test_profiles.py
+
+from contextlib import contextmanager
+from unittest import TestCase
+
+from sqlalchemy import event
+
+# Use test database (one per parallel worker; see testing.py)
+import testing
+
+from app import app, CURR_USER_KEY
+from models import db, Follows, Likes, Message, User
+import profiles
+
+app.config['TESTING'] = True
+
+# The logged-in user's row, then the profile's two queries
+PROFILE_PAGE_QUERIES = 3
+
+
+@contextmanager
+def count_queries():
+    """Count the SQL statements run inside the block."""
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
+
+
+class ProfileTestCase(TestCase):
+    """Test loading a profile in a fixed number of queries."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        self.user = User.signup("profiled", "profiled@test.com", "password", None)
+        self.viewer = User.signup("viewer", "viewer@test.com", "password", None)
+        self.others = [User.signup(f"other{i}", f"other{i}@test.com", "password", None)
+                       for i in range(3)]
+        db.session.commit()
+        self.user_id, self.viewer_id = self.user.id, self.viewer.id
+        self.other_ids = [other.id for other in self.others]
+        self.other_names = {other.username for other in self.others}
+
+        for i in range(4):
+            db.session.add(Message(text=f"own {i}", user_id=self.user_id))
+        for other in self.others:
+            db.session.add(Message(text=f"by {other.username}", user_id=other.id))
+            db.session.add(Follows(user_following_id=other.id, user_being_followed_id=self.user_id))
+        db.session.add(Follows(user_following_id=self.viewer_id, user_being_followed_id=self.user_id))
+        db.session.add(Follows(user_following_id=self.user_id, user_being_followed_id=self.viewer_id))
+        db.session.commit()
+
+        for msg in Message.query.filter(Message.user_id != self.user_id):
+            db.session.add(Likes(user_id=self.user_id, message_id=msg.id))
+        db.session.commit()
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.viewer_id
+
+    def tearDown(self):
+        db.session.remove()
+
+    def test_load(self):
+        profile = profiles.load(self.user_id, self.viewer_id)
+
+        self.assertEqual(profile.username, "profiled")
+        self.assertEqual(profile.messages_count, 4)
+        self.assertEqual(profile.following_count, 1)
+        self.assertEqual(profile.followers_count, 4)
+        self.assertEqual(profile.likes_count, 3)
+        self.assertTrue(profile.viewer_following)
+        self.assertFalse(profiles.load(self.user_id, self.other_ids[0] + 1000).viewer_following)
+
+        self.assertEqual(len(profile.messages), 4)
+        self.assertEqual({msg.username for msg in profile.liked},
+                         self.other_names)
+
+        self.assertIsNone(profiles.load(self.user_id + 1000))
+
+    def test_load_without_pages(self):
+        db.session.expunge_all()
+        with count_queries() as statements:
+            profile = profiles.load(self.user_id, self.viewer_id, with_pages=False)
+        self.assertEqual(len(statements), 1, statements)
+        self.assertEqual(profile.followers_count, 4)
+        self.assertEqual((profile.messages, profile.liked), ([], []))
+
+    def test_followers_page(self):
+        db.session.expunge_all()
+        with count_queries() as statements:
+            resp = self.client.get(f"/users/{self.user_id}/followers")
+
+        html = resp.get_data(as_text=True)
+        self.assertIn("@other2", html)
+        self.assertNotIn("own 3", html)
+        self.assertNotIn("UNION", " ".join(statements))
+
+    def test_load_query_count(self):
+        db.session.expunge_all()
+        with count_queries() as statements:
+            profiles.load(self.user_id, self.viewer_id)
+        self.assertEqual(len(statements), 2, statements)
+
+    def test_page_query_budget(self):
+        """The whole profile page stays within its query budget."""
+        db.session.expunge_all()
+        with count_queries() as statements:
+            resp = self.client.get(f"/users/{self.user_id}")
+
+        html = resp.get_data(as_text=True)
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("own 3", html)
+        self.assertIn("@other0", html)
+        self.assertIn("Unfollow", html)
+        self.assertLessEqual(len(statements), PROFILE_PAGE_QUERIES, statements)
+
+    def test_missing_user(self):
+        self.assertEqual(self.client.get(f"/users/{self.user_id + 1000}").status_code, 404)
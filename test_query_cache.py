@@ -0,0 +1,119 @@
+"""Query result cache tests."""
+
+# run these tests like:
+#    python -m unittest test_query_cache.py
+
+import threading
+from unittest import TestCase
+
+# Use test database (one per parallel worker; see testing.py)
+import testing
+
+from app import app
+from models import db, User
+from query_cache import (MemoryBackend, QueryCache, RedisBackend, RespClient,
+                         StandInServer)
+
+app.config['TESTING'] = True
+
+
+class MemoryBackendTestCase(TestCase):
+    """Test the per-process LRU."""
+
+    def test_tag_invalidation(self):
+        """Entries go when a tag covering one of theirs is invalidated."""
+        backend = MemoryBackend()
+        backend.set('a', b'1', 60, {'users:1'})
+        backend.set('b', b'2', 60, {'users:2'})
+        backend.set('c', b'3', 60, {'follows:followers:1'})
+
+        backend.invalidate('users:1')
+        self.assertIsNone(backend.get('a'))
+        self.assertEqual(backend.get('b'), b'2')
+
+        backend.invalidate('follows')
+        self.assertIsNone(backend.get('c'))
+
+    def test_memory_bound(self):
+        """The least recently used entries are evicted past max_bytes."""
+        backend = MemoryBackend(max_bytes=1000)
+        for key in 'abc':
+            backend.set(key, b'x' * 250, 60, set())
+            backend.get('a')
+
+        self.assertLessEqual(backend.bytes, 1000)
+        self.assertEqual(backend.get('a'), b'x' * 250)
+        self.assertIsNone(backend.get('b'))
+
+    def test_expiry(self):
+        """Entries past their TTL aren't returned."""
+        backend = MemoryBackend()
+        backend.set('a', b'1', -1, set())
+        self.assertIsNone(backend.get('a'))
+
+
+class RedisBackendTestCase(TestCase):
+    """Test the Redis-protocol backend against the stand-in server."""
+
+    def setUp(self):
+        self.server = StandInServer(('localhost', 0))
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        host, port = self.server.server_address
+        self.backend = RedisBackend(RespClient(host, port))
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_round_trip_and_invalidate(self):
+        """Values round-trip and are dropped by tag."""
+        self.backend.set('a', b'\x00value', 60, {'messages:user:3'})
+        self.assertEqual(self.backend.get('a'), b'\x00value')
+
+        self.backend.invalidate('messages')
+        self.assertIsNone(self.backend.get('a'))
+
+
+class QueryCacheTestCase(TestCase):
+    """Test caching real queries."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        self.user = User.signup("cached", "cached@test.com", "password", None)
+        db.session.commit()
+        self.user_id = self.user.id
+        db.session.remove()
+
+        self.cache = QueryCache()
+        app.config['QUERY_CACHE_BACKEND'] = 'memory'
+        self.cache.init_app(app)
+
+    def tearDown(self):
+        app.config['QUERY_CACHE_BACKEND'] = 'none'
+        self.cache.init_app(app)
+        db.session.remove()
+
+    def test_hit_until_commit(self):
+        """A cached row is served until a commit touches it."""
+        self.assertEqual(self.cache.get(User, self.user_id).username, "cached")
+        db.session.remove()
+
+        # Changes the cache can't see don't show up...
+        db.engine.execute(User.__table__.update().values(bio="behind its back"))
+        self.assertIsNone(self.cache.get(User, self.user_id).bio)
+
+        # ...but committing through the session invalidates the row
+        user = self.cache.get(User, self.user_id)
+        user.username = "renamed"
+        db.session.commit()
+        db.session.remove()
+
+        user = self.cache.get(User, self.user_id)
+        self.assertEqual(user.username, "renamed")
+        self.assertEqual(user.bio, "behind its back")
+
+    def test_missing_rows(self):
+        """get() returns None for rows that don't exist."""
+        self.assertIsNone(self.cache.get(User, 99999))
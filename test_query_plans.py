@@ -0,0 +1,127 @@
+"""Query plan regression tests.
+
+These seed a large synthetic dataset, run EXPLAIN on the core read queries
+and fail if any of them falls back to a sequential scan on messages, follows
+or likes. Seeding takes a while, so it happens once per run, and only when
+PLAN_TESTS=1; otherwise they're skipped.
+
+# run these tests like:
+#    PLAN_TESTS=1 python -m unittest test_query_plans.py
+#    PLAN_TESTS=1 PLAN_TEST_USERS=50000 PLAN_TEST_MESSAGES=1000000 python -m unittest test_query_plans.py
+"""
+
+import os
+import tempfile
+from unittest import TestCase, skipUnless
+
+# Use test database (one per parallel worker; see testing.py)
+import testing
+
+from app import app
+from bulk_load import load_all
+from generator.create_csvs import generate
+from models import db, Follows, Likes, Message
+
+NUM_USERS = int(os.environ.get('PLAN_TEST_USERS', 20000))
+NUM_MESSAGES = int(os.environ.get('PLAN_TEST_MESSAGES', 300000))
+NUM_FOLLOWS = int(os.environ.get('PLAN_TEST_FOLLOWS', 200000))
+
+# Tables that must always be reached through an index
+INDEXED_TABLES = {'messages', 'follows', 'likes'}
+
+
+def seq_scans(plan):
+    """Return the relations a JSON EXPLAIN plan reads with a sequential scan."""
+    found = []
+    if plan.get('Node Type') == 'Seq Scan' and plan.get('Relation Name') in INDEXED_TABLES:
+        found.append(plan['Relation Name'])
+    for child in plan.get('Plans', []):
+        found.extend(seq_scans(child))
+    return found
+
+
+@skipUnless(os.environ.get('PLAN_TESTS') == '1', "set PLAN_TESTS=1 to seed and check query plans")
+class QueryPlanTestCase(TestCase):
+    """Check that core queries keep using their indexes on large data."""
+
+    @classmethod
+    def setUpClass(cls):
+        """Generate, bulk-load and analyze a large dataset once."""
+        with tempfile.TemporaryDirectory() as data_dir:
+            generate(data_dir, NUM_USERS, NUM_MESSAGES, NUM_FOLLOWS, seed=1)
+            with app.app_context():
+                load_all(data_dir, chunk_size=50000, out=open(os.devnull, 'w'))
+
+        # Give likes a realistic spread too: each user likes a few messages
+        db.engine.execute("""
+            INSERT INTO likes (user_id, message_id)
+            SELECT u.id, (u.id * g) %% %s + 1
+            FROM users u, generate_series(1, 5) g
+            ON CONFLICT DO NOTHING
+        """, (NUM_MESSAGES,))
+        db.engine.execute("ANALYZE")
+
+        # Pick a well-connected user, like the ones that dominate traffic
+        cls.user_id = db.session.query(Follows.user_following_id).group_by(
+            Follows.user_following_id).order_by(db.func.count().desc()).first()[0]
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+
+    def assertUsesIndexes(self, query):
+        """EXPLAIN the query and fail on any sequential scan of a big table."""
+        compiled = query.statement.compile(dialect=db.engine.dialect)
+        plan = db.engine.execute(
+            f"EXPLAIN (FORMAT JSON) {compiled}", compiled.params).scalar()[0]['Plan']
+
+        self.assertEqual(seq_scans(plan), [], f"sequential scan in plan: {plan}")
+
+    def test_homepage_timeline(self):
+        """The homepage feed: recent messages from the user and who they follow.
+
+        Built the way app.homepage builds it, own messages included.
+        """
+        following = (db.session.query(Follows.user_being_followed_id)
+                     .filter(Follows.user_following_id == self.user_id))
+        query = (Message.query
+                 .filter(db.or_(Message.user_id == self.user_id,
+                                Message.user_id.in_(following)))
+                 .order_by(*Message.newest_first())
+                 .limit(100))
+        self.assertUsesIndexes(query)
+
+    def test_user_messages(self):
+        """A profile's own messages, newest first."""
+        query = (Message.query
+                 .filter(Message.user_id == self.user_id)
+                 .order_by(*Message.newest_first())
+                 .limit(100))
+        self.assertUsesIndexes(query)
+
+    def test_following(self):
+        """Who a user follows."""
+        query = db.session.query(Follows).filter(Follows.user_following_id == self.user_id)
+        self.assertUsesIndexes(query)
+
+    def test_followers(self):
+        """Who follows a user."""
+        query = db.session.query(Follows).filter(Follows.user_being_followed_id == self.user_id)
+        self.assertUsesIndexes(query)
+
+    def test_user_likes(self):
+        """Messages a user has liked."""
+        query = Likes.query.filter(Likes.user_id == self.user_id)
+        self.assertUsesIndexes(query)
+
+    def test_like_lookup(self):
+        """The like/unlike toggle's existence check."""
+        query = Likes.query.filter_by(user_id=self.user_id, message_id=1)
+        self.assertUsesIndexes(query)
+
+    def test_message_likers(self):
+        """Who liked a message."""
+        query = Likes.query.filter(Likes.message_id == 1)
+        self.assertUsesIndexes(query)
@@ -0,0 +1,244 @@
+"""Message and like sharding tests."""
+
+# run these tests like:
+#    python -m unittest test_sharding.py
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase, mock
+
+# Use test database (one per parallel worker; see testing.py)
+import testing
+
+from sqlalchemy import exc, func
+
+from app import app, CURR_USER_KEY
+from bulk_load import load_all
+from live import missed_events
+from models import db, Follows, Likes, Message, User
+from sharding import (NUM_BUCKETS, bucket_for_user, default_map, move_bucket,
+                      router, timeline)
+
+app.config['TESTING'] = True
+
+
+class BucketTestCase(TestCase):
+    """Test how authors map onto buckets and shards."""
+
+    def test_default_map(self):
+        """Buckets are split into equal contiguous ranges."""
+        bucket_map = default_map(['a', 'b'])
+        self.assertEqual(len(bucket_map), NUM_BUCKETS)
+        self.assertEqual(bucket_map.count('a'), NUM_BUCKETS // 2)
+        self.assertEqual(bucket_map[0], 'a')
+        self.assertEqual(bucket_map[-1], 'b')
+
+    def test_consecutive_users_spread(self):
+        """Consecutive user ids land in many different buckets."""
+        buckets = {bucket_for_user(user_id) for user_id in range(1, 201)}
+        self.assertGreater(len(buckets), 150)
+
+
+class ShardingTestCase(TestCase):
+    """Test routing messages and likes over two SQLite shards."""
+
+    def setUp(self):
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+
+        self.dir = tempfile.mkdtemp()
+        app.config['SQLALCHEMY_BINDS'] = {
+            name: f"sqlite:///{os.path.join(self.dir, name)}.db"
+            for name in ('shard0', 'shard1')
+        }
+        app.config['SHARDS'] = ['shard0', 'shard1']
+        router.init_app(app, db)
+
+        # Enough users that both shards get some
+        self.users = [User.signup(f"user{i}", f"user{i}@test.com", "password", None)
+                      for i in range(8)]
+        db.session.commit()
+
+        for user in self.users:
+            for i in range(3):
+                user.post_message(f"{user.username} says {i}")
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        app.config['SHARDS'] = []
+        router.init_app(app, db)
+        # Or the next setUp's drop_all() would try the deleted shards
+        app.config['SQLALCHEMY_BINDS'] = {}
+        db.engine.execute("DROP TABLE IF EXISTS shard_buckets")
+        shutil.rmtree(self.dir)
+
+    def shard_message_ids(self, shard):
+        return {id for (id,) in router.engine(shard).execute("SELECT id FROM messages")}
+
+    def test_messages_live_on_authors_shard(self):
+        """Each message is stored on its author's shard, and only there."""
+        shards = {user.id: router.shard_for_user(user.id) for user in self.users}
+        self.assertEqual(set(shards.values()), {'shard0', 'shard1'})
+
+        for msg in Message.query.all():
+            self.assertIn(msg.id, self.shard_message_ids(shards[msg.user_id]))
+            self.assertEqual(router.shard_for_message(msg.id), shards[msg.user_id])
+
+        self.assertEqual(Message.query.count(), 24)
+        self.assertEqual(self.users[0].messages.count(), 3)
+
+    def test_get_and_likes(self):
+        """Messages are found by id, and likes go with their message."""
+        liker = self.users[0]
+        targets = [user.messages.first() for user in self.users[1:]]
+
+        for msg in targets:
+            self.assertEqual(Message.query.get(msg.id).text, msg.text)
+            liker.like(msg.id)
+        db.session.commit()
+
+        self.assertEqual(liker.likes.count(), len(targets))
+        self.assertEqual(liker.liked_ids_among([m.id for m in targets]),
+                         {m.id for m in targets})
+        for msg in targets:
+            self.assertTrue(liker.has_liked(msg.id))
+            like_shard = router.shard_for_message(msg.id)
+            rows = router.engine(like_shard).execute(
+                "SELECT count(*) FROM likes WHERE message_id = ?", msg.id).scalar()
+            self.assertEqual(rows, 1)
+
+    def test_timeline_merge(self):
+        """The scatter-gather timeline is newest-first across shards."""
+        author_ids = [user.id for user in self.users]
+        messages = timeline(Message, author_ids, 10, Message.newest_first())
+
+        self.assertEqual(len(messages), 10)
+        ids = [msg.id for msg in messages]
+        self.assertEqual(ids, sorted(ids, reverse=True))
+
+        newest = sorted((m.id for m in Message.query.all()), reverse=True)[:10]
+        self.assertEqual(ids, newest)
+
+    def test_move_bucket(self):
+        """Moving a bucket moves its rows and reroutes reads."""
+        user = self.users[0]
+        user_id = user.id
+        bucket = bucket_for_user(user_id)
+        source = router.shard_for_bucket(bucket)
+        target = 'shard1' if source == 'shard0' else 'shard0'
+        msg = user.messages.first()
+        msg_id, text, liker_id = msg.id, msg.text, self.users[1].id
+        self.users[1].like(msg_id)
+        db.session.commit()
+
+        move_bucket(bucket, target, Message.__table__, Likes.__table__, grace=0)
+        db.session.remove()
+
+        self.assertEqual(router.shard_for_user(user_id), target)
+        self.assertNotIn(msg_id, self.shard_message_ids(source))
+        self.assertIn(msg_id, self.shard_message_ids(target))
+        self.assertEqual(Message.query.get(msg_id).text, text)
+        self.assertTrue(User.query.get(liker_id).has_liked(msg_id))
+
+    def test_move_bucket_keeps_grace_writes(self):
+        """Posts and likes made on the target during the grace period survive."""
+        user = self.users[0]
+        user_id, liker_id = user.id, self.users[1].id
+        bucket = bucket_for_user(user_id)
+        target = 'shard1' if router.shard_for_bucket(bucket) == 'shard0' else 'shard0'
+        written = {}
+
+        def write_during_grace(seconds):
+            # The map already points at the target
+            msg = User.query.get(user_id).post_message("posted mid-move")
+            db.session.commit()
+            User.query.get(liker_id).like(msg.id)
+            db.session.commit()
+            written['id'] = msg.id
+
+        with mock.patch('sharding.time.sleep', write_during_grace):
+            move_bucket(bucket, target, Message.__table__, Likes.__table__)
+        db.session.remove()
+
+        msg_id = written['id']
+        self.assertIn(msg_id, self.shard_message_ids(target))
+        self.assertEqual(Message.query.get(msg_id).text, "posted mid-move")
+        self.assertTrue(User.query.get(liker_id).has_liked(msg_id))
+        self.assertEqual(User.query.get(user_id).messages.count(), 4)
+
+    def test_scattered_order_and_limit(self):
+        """Queries over every shard merge in ORDER BY order before LIMIT/OFFSET."""
+        everything = sorted(Message.query.all(), key=lambda msg: (msg.text, -msg.id))
+        self.assertEqual(set(router.shard_for_message(msg.id) for msg in everything),
+                         {'shard0', 'shard1'})
+
+        page = Message.query.order_by(Message.text, Message.id.desc()).offset(3).limit(7).all()
+        self.assertEqual([msg.id for msg in page], [msg.id for msg in everything[3:10]])
+
+        ids = [id for (id,) in db.session.query(Message.id).order_by(Message.id.desc())[:5]]
+        self.assertEqual(ids, sorted((msg.id for msg in everything), reverse=True)[:5])
+
+        newest = Message.query.order_by(Message.id.desc()).first()
+        self.assertEqual(newest.id, max(msg.id for msg in everything))
+
+    def test_scattered_order_by_expression(self):
+        """An ORDER BY the merge can't read back out of the rows is refused."""
+        with self.assertRaises(exc.InvalidRequestError):
+            Message.query.order_by(func.length(Message.text)).limit(3).all()
+
+    def test_missed_events(self):
+        """The live replay reads messages from every shard, newest kept."""
+        author_ids = [user.id for user in self.users]
+        last_event_id = min(msg.id for msg in Message.query.all())
+
+        events = missed_events(author_ids, last_event_id)
+        ids = [event['id'] for event in events]
+        self.assertEqual(len(ids), 23)
+        self.assertEqual(ids, sorted(ids))
+        authors = {user.id: user.username for user in self.users}
+        for event in events:
+            self.assertEqual(event['username'], authors[Message.query.get(event['id']).user_id])
+
+    def test_api(self):
+        """The JSON API reads messages and likes from their shards."""
+        user, others = self.users[0], self.users[1:]
+        user_id = user.id
+        db.session.add_all(Follows(user_following_id=user_id, user_being_followed_id=other.id)
+                           for other in others)
+        other_id, message_id = others[0].id, others[0].messages.first().id
+        user.like(message_id)
+        db.session.commit()
+        all_ids = sorted((msg.id for msg in Message.query.all()), reverse=True)
+
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+        seen = []
+        url = "/api/v1/timeline?limit=5"
+        while url:
+            data = client.get(url).get_json()
+            seen.extend(msg['id'] for msg in data['data'])
+            url = (f"/api/v1/timeline?limit=5&cursor={data['next_cursor']}"
+                   if data['next_cursor'] else None)
+        self.assertEqual(seen, all_ids)
+
+        data = client.get(f"/api/v1/users/{user_id}").get_json()['data']
+        self.assertEqual(data['counts'], {'messages': 3, 'following': 7, 'followers': 0})
+
+        data = client.get(f"/api/v1/users/{other_id}/messages").get_json()['data']
+        self.assertEqual(len(data), 3)
+
+        ids = ",".join(str(id) for id in all_ids[:6])
+        data = client.get(f"/api/v1/messages?ids={ids}").get_json()['data']
+        self.assertEqual({msg['id'] for msg in data}, set(all_ids[:6]))
+
+        data = client.get(f"/api/v1/messages/{message_id}").get_json()['data']
+        self.assertEqual(data['likes'], 1)
+
+    def test_bulk_load_refuses(self):
+        with self.assertRaisesRegex(RuntimeError, "unset SHARD_URLS"):
+            load_all(self.dir)
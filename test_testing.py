@@ -0,0 +1,88 @@
+"""Test support tests."""
+
+# run these tests like:
+#    python -m unittest test_testing.py
+
+from unittest import TestCase
+
+# Use test database (one per parallel worker; see testing.py)
+from testing import (BASE_DATABASE_URL, TransactionTestCase, database_url, make_follows,
+                     make_likes, make_messages, make_user, make_users, password_hash)
+
+from app import app
+from models import db, bcrypt, Follows, Likes, Message, User
+
+app.config['TESTING'] = True
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class DatabaseUrlTestCase(TestCase):
+    """Test choosing a database per worker."""
+
+    def test_worker_databases(self):
+        self.assertEqual(database_url(), BASE_DATABASE_URL)
+        self.assertEqual(database_url('gw3'), f"{BASE_DATABASE_URL}-gw3")
+
+    def test_cheap_hashing(self):
+        self.assertEqual(app.config['BCRYPT_LOG_ROUNDS'], 4)
+        hashed = password_hash("secret")
+        self.assertTrue(hashed.startswith("$2b$04$"))
+        self.assertIs(password_hash("secret"), hashed)
+        self.assertTrue(bcrypt.check_password_hash(hashed, "secret"))
+
+
+class RollbackTestCase(TransactionTestCase):
+    """Test that each test's writes, committed or not, are rolled back."""
+
+    def write(self):
+        # Whichever test runs second would hit the unique username otherwise
+        self.assertEqual(User.query.count(), 0)
+        make_user("kept")
+        db.session.commit()
+        self.assertEqual(User.query.count(), 1)
+
+    def test_first(self):
+        self.write()
+
+    def test_second(self):
+        self.write()
+
+    def test_rollback_inside_test(self):
+        """Code under test can roll back without losing the test's data."""
+        make_user("before")
+        db.session.commit()
+
+        db.session.add(User(username="before", email="dupe@test.com", password="x"))
+        with self.assertRaises(Exception):
+            db.session.commit()
+        db.session.rollback()
+
+        self.assertEqual([user.username for user in User.query], ["before"])
+
+    def test_requests_share_the_transaction(self):
+        make_user("poster", password="secret")
+        db.session.commit()
+
+        client = app.test_client()
+        resp = client.post("/login", data={'username': "poster", 'password': "secret"})
+        self.assertEqual(resp.status_code, 302)
+
+
+class FactoryTestCase(TransactionTestCase):
+    """Test building fixtures in bulk."""
+
+    def test_factories(self):
+        users = make_users(5, prefix="bulk")
+        self.assertEqual([user.username for user in users],
+                         ["bulk0", "bulk1", "bulk2", "bulk3", "bulk4"])
+        self.assertEqual(len({user.password for user in users}), 1)
+
+        messages = make_messages(users[0], 3)
+        make_follows(users[0], users[1:])
+        make_likes(users[1], messages)
+        db.session.commit()
+
+        self.assertEqual(Message.query.filter_by(user_id=users[0].id).count(), 3)
+        self.assertEqual(Follows.query.filter_by(user_following_id=users[0].id).count(), 4)
+        self.assertEqual(Likes.query.filter_by(user_id=users[1].id).count(), 3)
+        self.assertTrue(User.authenticate("bulk2", "password"))
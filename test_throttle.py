@@ -0,0 +1,116 @@
+"""Login throttling tests."""
+
+# run these tests like:
+#    python -m unittest test_throttle.py
+
+from unittest import TestCase
+
+# Use test database (one per parallel worker; see testing.py)
+from testing import TransactionTestCase
+
+from app import app
+from models import db, User
+from query_cache import RespClient
+from throttle import MemoryBackend, RedisBackend, throttle
+
+app.config['TESTING'] = True
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class BucketTestCase(TestCase):
+    """Test the token buckets themselves."""
+
+    def test_burst_then_refill(self):
+        """A bucket allows its burst, then one attempt per interval."""
+        clock = FakeClock()
+        backend = MemoryBackend(clock=clock)
+
+        for _ in range(3):
+            self.assertEqual(backend.take('k', 3, 10.0), 0)
+        self.assertAlmostEqual(backend.take('k', 3, 10.0), 10.0)
+
+        clock.now += 10.0
+        self.assertEqual(backend.take('k', 3, 10.0), 0)
+        self.assertGreater(backend.take('k', 3, 10.0), 0)
+
+        # Other keys have their own buckets
+        self.assertEqual(backend.take('other', 3, 10.0), 0)
+
+    def test_peek(self):
+        """Peeking reports the wait without using up an attempt."""
+        backend = MemoryBackend(clock=FakeClock())
+        self.assertEqual(backend.take('k', 1, 10.0, peek=True), 0)
+        self.assertEqual(backend.take('k', 1, 10.0), 0)
+        self.assertAlmostEqual(backend.take('k', 1, 10.0, peek=True), 10.0)
+
+    def test_bounded(self):
+        """The LRU never holds more than max_keys buckets."""
+        backend = MemoryBackend(max_keys=10)
+        for i in range(100):
+            backend.take(f"ip:{i}", 1, 60.0)
+        self.assertEqual(len(backend.full_at), 10)
+        self.assertIn('ip:99', backend.full_at)
+
+    def test_redis_unreachable(self):
+        """Without its store the Redis backend throttles in-process."""
+        backend = RedisBackend(RespClient('127.0.0.1', 1, timeout=0.1))
+        self.assertEqual(backend.take('k', 1, 60.0), 0)
+        self.assertGreater(backend.take('k', 1, 60.0), 0)
+
+
+class LoginThrottleTestCase(TransactionTestCase):
+    """Test throttling the login view."""
+
+    def setUp(self):
+        super().setUp()
+        User.signup("target", "target@test.com", "password", None)
+        db.session.commit()
+
+        self.client = app.test_client()
+        throttle.clear()
+
+    def tearDown(self):
+        throttle.clear()
+        super().tearDown()
+
+    def login(self, username, password, ip='10.0.0.1'):
+        return self.client.post("/login", data={'username': username, 'password': password},
+                                environ_base={'REMOTE_ADDR': ip})
+
+    def test_username_throttled(self):
+        """Repeated bad passwords for one user get a 429, from any IP."""
+        burst = throttle.username_limit[0]
+        for i in range(burst):
+            self.assertEqual(self.login("target", "badpassword", ip=f"10.0.1.{i}").status_code, 200)
+
+        resp = self.login("target", "password", ip="10.0.2.1")
+        self.assertEqual(resp.status_code, 429)
+        self.assertIn('Retry-After', resp.headers)
+
+        # Other users are unaffected
+        self.assertEqual(self.login("someone", "wrong", ip="10.0.2.2").status_code, 200)
+
+    def test_successes_not_counted(self):
+        """Only failed logins use up a username's attempts."""
+        burst = throttle.username_limit[0]
+        for i in range(burst + 2):
+            self.assertEqual(self.login("target", "password", ip=f"10.0.3.{i}").status_code, 302)
+        self.assertEqual(self.login("target", "badpassword", ip="10.0.3.99").status_code, 200)
+
+    def test_ip_throttled(self):
+        """One IP trying many usernames is cut off."""
+        burst = throttle.ip_limit[0]
+        for i in range(burst):
+            self.assertEqual(self.login(f"user{i}", "wrong").status_code, 200)
+        self.assertEqual(self.login("target", "password").status_code, 429)
+
+        # A different client still gets in
+        self.assertEqual(self.login("target", "password", ip='10.0.0.2').status_code, 302)
@@ -3,20 +3,21 @@
 # run these tests like:
 #    python -m unittest test_user_model.py
 
+import time
 
-import os
-from unittest import TestCase
-from app import app
-from models import db, User, Message, Follows, Likes
+# Use test database (one per parallel worker; see testing.py)
+from testing import TransactionTestCase, make_messages, make_user
 
-# Use test database
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+from app import app
+from models import db, AccountDeletion, User, Message, Follows, Likes
+from invalidation import bus
+from tasks import delete_account
 
 # Configure app for testing
 app.config['WTF_CSRF_ENABLED'] = False
 app.config['TESTING'] = True
 
-class UserModelTestCase(TestCase):
+class UserModelTestCase(TransactionTestCase):
     """Test for the User model and related functionality.
 
     Includes tests for user creation, following, liking messages, and model representation.
@@ -24,34 +25,19 @@ class UserModelTestCase(TestCase):
 
     def setUp(self):
         """Create test client, add sample data."""
-        db.drop_all()
-        db.create_all()
+        super().setUp()
 
-        # Create a test client and a sample user
+        # Create a test client, a sample user and a message by them
         self.client = app.test_client()
-        self.testuser = User.signup(username="testuser", 
-                                    email="test@test.com",
-                                    password="testuser",
-                                    image_url=None,
-                                    header_image_url=None)
+        self.testuser = make_user("testuser", password="testuser", email="test@test.com")
+        make_messages(self.testuser, 1, text="Test message")
         db.session.commit()
 
-        # Create a sample message associated with the test user
-        message = Message(text="Test message", user_id=self.testuser.id)
-        db.session.add(message)
-
-        # Commit the message to the database
-        db.session.commit()  
-
-    def tearDown(self):
-        """Rollback the session after each test to ensure no changes persist."""
-        db.session.remove()
-
     def test_user_model(self):
         """Test basic user model attributes (messages, followers)."""
         # User should have 1 message and no followers initially
-        self.assertEqual(len(self.testuser.messages), 1)
-        self.assertEqual(len(self.testuser.followers), 0)
+        self.assertEqual(self.testuser.messages.count(), 1)
+        self.assertEqual(self.testuser.followers.count(), 0)
 
     def test_user_following(self):
         """Test the following relationship between users."""
@@ -68,6 +54,64 @@ class UserModelTestCase(TestCase):
         # Second user should not follow the first
         self.assertFalse(user2.is_following(self.testuser))
 
+    def test_follow_unfollow(self):
+        """Test the explicit follow/unfollow APIs."""
+        user2 = User.signup("testuser2", "test2@test.com", "password", None)
+        db.session.commit()
+
+        self.testuser.follow(user2)
+        # Following twice is a no-op rather than a duplicate row
+        self.testuser.follow(user2)
+        db.session.commit()
+
+        self.assertTrue(self.testuser.is_following(user2))
+        self.assertTrue(user2.is_followed_by(self.testuser))
+        self.assertEqual(user2.followers.count(), 1)
+
+        self.testuser.unfollow(user2)
+        db.session.commit()
+
+        self.assertFalse(self.testuser.is_following(user2))
+        self.assertEqual(user2.followers.count(), 0)
+
+    def test_commits_publish_invalidations(self):
+        """ORM and bulk writes publish their tags once committed."""
+        user2 = User.signup("testuser2", "test2@test.com", "password", None)
+        db.session.commit()
+
+        seen = []
+        handle = bus.subscribe(None, seen.append)
+        try:
+            self.testuser.bio = "New bio"
+            self.testuser.unfollow(user2)
+            self.assertEqual(seen, [])
+
+            db.session.commit()
+        finally:
+            bus.unsubscribe(handle)
+
+        self.assertIn(f"users:{self.testuser.id}", seen)
+        self.assertIn(f"follows:followers:{user2.id}", seen)
+
+    def test_post_message(self):
+        """Test posting through the user without loading their messages."""
+        msg = self.testuser.post_message("Another one")
+        db.session.commit()
+
+        self.assertEqual(msg.user_id, self.testuser.id)
+        self.assertIsNotNone(msg.timestamp)
+        self.assertEqual(self.testuser.messages.count(), 2)
+
+    def test_post_message_timestamps(self):
+        """Messages posted one after another get increasing timestamps."""
+        first = self.testuser.post_message("First")
+        db.session.commit()
+        time.sleep(0.01)
+        second = self.testuser.post_message("Second")
+        db.session.commit()
+
+        self.assertLess(first.timestamp, second.timestamp)
+
     def test_liking_message(self):
         """Test if a user can like a message."""
         # Get the first user
@@ -86,3 +130,37 @@ class UserModelTestCase(TestCase):
         """Test the string representation of the user object."""
         # Verify that the user representation matches the expected format
         self.assertEqual(repr(self.testuser), f"<User #{self.testuser.id}: testuser, test@test.com>")
+
+    def test_delete_account_in_batches(self):
+        """Test batched account deletion removes everything and records progress."""
+        user2 = User.signup("testuser2", "test2@test.com", "password", None)
+        db.session.commit()
+
+        self.testuser.follow(user2)
+        user2.follow(self.testuser)
+        self.testuser.post_message("Second")
+        db.session.commit()
+        for message in self.testuser.messages:
+            self.testuser.like(message.id)
+        db.session.commit()
+
+        user_id = self.testuser.id
+        AccountDeletion.request(user_id)
+        db.session.commit()
+
+        # Deleting is locked out of login as soon as it's requested
+        self.assertFalse(User.authenticate("testuser", "testuser"))
+
+        delete_account(user_id, batch_size=1)
+        db.session.expire_all()
+
+        self.assertIsNone(User.query.get(user_id))
+        self.assertEqual(Message.query.filter_by(user_id=user_id).count(), 0)
+        self.assertEqual(Follows.query.count(), 0)
+        self.assertEqual(Likes.query.count(), 0)
+
+        deletion = AccountDeletion.query.get(user_id)
+        self.assertEqual(deletion.status, 'done')
+        self.assertEqual(deletion.messages_deleted, 2)
+        self.assertEqual(deletion.follows_deleted, 2)
+        self.assertEqual(deletion.likes_deleted, 2)
@@ -1,35 +1,22 @@
-import os
-from unittest import TestCase
+# Use test database (one per parallel worker; see testing.py)
+from testing import TransactionTestCase, make_user
 
-from models import db, connect_db, User, Message
+from models import User
 from app import app, CURR_USER_KEY
 
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 app.config['WTF_CSRF_ENABLED'] = False
 
-db.create_all()
-
-class UserViewsTestCase(TestCase):
+class UserViewsTestCase(TransactionTestCase):
     """Test the views related to user actions like login and profile editing."""
 
     def setUp(self):
         """Set up the test environment by creating a test user."""
-        # Drop all existing tables and create them fresh for the tests
-        db.drop_all()
-        db.create_all()
+        super().setUp()
 
-        # Create a test client and a sample user
+        # Create a test client and a sample user; the test's writes are
+        # rolled back afterwards
         self.client = app.test_client()
-        self.testuser = User.signup(
-            username="testuser", 
-            email="test@test.com",
-            password="testuser",
-            image_url=None)
-        db.session.commit()
-
-    def tearDown(self):
-        """Rollback the session after each test to avoid persistence of changes."""
-        db.session.rollback()
+        self.testuser = make_user("testuser", password="testuser")
 
     def test_login(self):
         """Test user login functionality for a valid user."""
@@ -85,4 +72,15 @@ class UserViewsTestCase(TestCase):
             self.assertEqual(user.bio, "New bio")
             self.assertEqual(user.email, "new@test.com")
 
-  
\ No newline at end of file
+  
+    def test_follow(self):
+        """Following someone shows them on the page the follow redirects to."""
+        other = make_user("followed")
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.post(f"/users/follow/{other.id}", follow_redirects=True)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b"@followed", resp.data)
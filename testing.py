@@ -0,0 +1,244 @@
+"""Test support: a database per worker, rolled-back tests and fast fixtures.
+
+Import this at the top of a test module, before the app:
+
+    import testing
+
+    from app import app
+
+It points DATABASE_URL at the test database and turns bcrypt down to its
+cheapest cost (BCRYPT_LOG_ROUNDS=4), so hashing a fixture password takes
+well under a millisecond instead of a quarter of a second, and turns
+admission control off. Run in parallel
+with pytest-xdist, each worker gets its own database ("warbler-test-gw0",
+"warbler-test-gw1", ...), created on first use:
+
+    python -m pytest -n auto
+
+``TransactionTestCase`` runs each test inside a transaction on one
+connection that's rolled back afterwards, so tests don't have to drop and
+recreate the tables or delete what they wrote. Code under test can commit
+and roll back as usual: the session works inside a SAVEPOINT that's
+started again after each commit or rollback, and ``db.engine`` hands out
+that same connection (with ``begin()`` also a SAVEPOINT). Tests that run
+work on other threads or connections, or count the SQL they issue, should
+stay on a plain TestCase.
+
+The ``make_*`` factories build fixtures in bulk with set-based INSERTs,
+hashing each distinct password only once. They commit what they build (in
+a TransactionTestCase that just releases the savepoint), so it outlives
+the end of the next request, which rolls back anything uncommitted.
+"""
+
+import os
+from contextlib import contextmanager
+from functools import lru_cache
+from unittest import TestCase
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine.url import make_url
+
+BASE_DATABASE_URL = os.environ.get('TEST_DATABASE_URL', "postgresql:///warbler-test")
+
+
+def database_url(worker=None):
+    """The test database for a pytest-xdist worker ("gw0", ...), or the base one."""
+    if not worker:
+        return BASE_DATABASE_URL
+    url = make_url(BASE_DATABASE_URL)
+    url.database = f"{url.database}-{worker}"
+    return str(url)
+
+
+def create_database(url):
+    """Create the database at ``url`` unless it already exists."""
+    url = make_url(url)
+    name = url.database
+    url.database = 'postgres'
+    engine = create_engine(url, isolation_level='AUTOCOMMIT')
+    try:
+        with engine.connect() as conn:
+            exists = conn.execute("SELECT 1 FROM pg_database WHERE datname = %s", name).scalar()
+            if not exists:
+                conn.execute(f'CREATE DATABASE "{name}"')
+    finally:
+        engine.dispose()
+
+
+_worker = os.environ.get('PYTEST_XDIST_WORKER')
+os.environ['DATABASE_URL'] = database_url(_worker)
+if _worker:
+    create_database(os.environ['DATABASE_URL'])
+
+# Cheapest cost bcrypt allows; app.py reads this into BCRYPT_LOG_ROUNDS
+os.environ.setdefault('BCRYPT_LOG_ROUNDS', '4')
+
+# The test client doesn't close the responses it returns, so admission
+# control would never get their slots back; test_admission.py wraps its
+# own apps
+os.environ.setdefault('ADMISSION_ENABLED', '0')
+
+from models import db, bcrypt, Follows, Likes, Message, User  # noqa: E402
+
+
+class JoinedEngine:
+    """Stands in for ``db.engine`` during a TransactionTestCase.
+
+    Every connection it gives out is a branch of the test's connection, so
+    it sees (and is rolled back with) the test's writes. It compares equal
+    to the real engine, so the session finds the connection it already has
+    for it when code passes ``bind=db.engine``.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.engine = connection.engine
+
+    def __getattr__(self, name):
+        try:
+            return getattr(self.connection, name)
+        except AttributeError:
+            return getattr(self.engine, name)
+
+    def __eq__(self, other):
+        return other is self or other is self.engine
+
+    def __hash__(self):
+        return hash(self.engine)
+
+    def connect(self, **kwargs):
+        return self.connection.connect()
+
+    contextual_connect = connect
+
+    @contextmanager
+    def begin(self):
+        conn = self.connection.connect()
+        with conn.begin_nested():
+            yield conn
+
+
+class TransactionTestCase(TestCase):
+    """A TestCase whose database writes are rolled back after each test.
+
+    Subclasses that override ``setUp`` or ``tearDown`` call super() first
+    and last respectively.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # Start from empty tables, whatever earlier plain TestCases left
+        db.create_all()
+        clear_tables()
+
+    def setUp(self):
+        super().setUp()
+        db.session.remove()
+
+        self._connection = db.engine.connect()
+        self._transaction = self._connection.begin()
+        engine = JoinedEngine(self._connection)
+
+        get_engine = db.get_engine
+        db.get_engine = lambda app=None, bind=None: (
+            engine if bind is None else get_engine(app, bind))
+
+        self._session = db.session()
+        self._session.begin_nested()
+        event.listen(self._session, 'after_transaction_end', self._restart_savepoint)
+
+        # Ending a request closes the session; here that's rolling back to
+        # the savepoint, so later requests share this session and
+        # connection. Objects stay attached (expired), so the test's
+        # fixtures reload on their next use instead of going detached.
+        def remove():
+            self._session.rollback()
+        db.session.remove = remove
+
+    @staticmethod
+    def _restart_savepoint(session, transaction):
+        if transaction.nested and not transaction._parent.nested:
+            session.expire_all()
+            session.begin_nested()
+
+    def tearDown(self):
+        del db.session.remove
+        del db.get_engine
+        event.remove(self._session, 'after_transaction_end', self._restart_savepoint)
+        db.session.remove()
+
+        self._transaction.rollback()
+        self._connection.close()
+        super().tearDown()
+
+
+def clear_tables():
+    """Empty every table in the main database."""
+    tables = db.get_tables_for_bind()
+    if tables:
+        db.session.execute("TRUNCATE {} RESTART IDENTITY CASCADE".format(
+            ", ".join(f'"{table.name}"' for table in tables)))
+        db.session.commit()
+
+
+@lru_cache(maxsize=None)
+def password_hash(password):
+    """A bcrypt hash of ``password``, computed once per password."""
+    return bcrypt.generate_password_hash(password).decode('UTF-8')
+
+
+def _insert(model, rows):
+    """Insert ``rows`` in one statement; return their ids in order."""
+    if not rows:
+        return []
+    table = model.__table__
+    return [row_id for (row_id,) in db.session.execute(
+        table.insert().values(rows).returning(table.c.id))]
+
+
+def make_users(count, prefix="user", password="password", **fields):
+    """``count`` users named <prefix>0, <prefix>1, ..., in one INSERT."""
+    hashed = password_hash(password)
+    ids = _insert(User, [dict({'username': f"{prefix}{i}", 'email': f"{prefix}{i}@test.com",
+                               'password': hashed}, **fields)
+                         for i in range(count)])
+    db.session.commit()
+    return User.query.filter(User.id.in_(ids)).order_by(User.id).all()
+
+
+def make_user(username="testuser", password="password", **fields):
+    """One user, by default "testuser"; see make_users."""
+    fields.setdefault('email', f"{username}@test.com")
+    [user] = make_users(1, prefix=username, password=password, username=username, **fields)
+    return user
+
+
+def make_messages(user, count, text="warble {}"):
+    """``count`` messages by ``user``, oldest first.
+
+    Added through the session rather than one INSERT, so ids are assigned
+    however messages normally get them (see ids.py).
+    """
+    messages = [Message(text=text.format(i), user_id=user.id) for i in range(count)]
+    db.session.add_all(messages)
+    db.session.flush()
+    ids = [msg.id for msg in messages]
+    db.session.commit()
+    # Reloaded in one query, so they keep their state past the next request
+    return Message.query.filter(Message.id.in_(ids)).order_by(Message.id).all()
+
+
+def make_follows(follower, users):
+    """Make ``follower`` follow every one of ``users`` in one INSERT."""
+    if users:
+        db.session.execute(Follows.__table__.insert().values([
+            {'user_following_id': follower.id, 'user_being_followed_id': user.id}
+            for user in users]))
+        db.session.commit()
+
+
+def make_likes(user, messages):
+    """Make ``user`` like every one of ``messages`` in one INSERT."""
+    _insert(Likes, [{'user_id': user.id, 'message_id': msg.id} for msg in messages])
+    db.session.commit()
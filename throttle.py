@@ -0,0 +1,186 @@
+"""Login throttling.
+
+Every login attempt costs a bcrypt check, which is deliberately slow, so a
+burst of bad logins can use up every worker's CPU. Attempts are rate limited
+with two token buckets, checked before the password is looked at:
+
+    per client IP   every attempt takes from it
+    per username    only failed attempts take from it, so a user logging in
+                    successfully (from any number of devices) never uses it
+                    up, while guessing one account's password from many IPs
+                    still runs out
+
+An attempt with an empty bucket gets a plain 429 with a Retry-After header,
+without touching the database or rendering a template.
+
+The client IP is ``request.remote_addr``. Behind a reverse proxy that's the
+proxy's address, so every client would share one bucket: set PROXY_COUNT to
+the number of proxies in front of the app and it trusts that many entries
+of X-Forwarded-For (see app.py). Never set it for an app reachable directly,
+since clients could then pick their own IP.
+
+Each bucket holds ``burst`` attempts and refills one every ``interval``
+seconds. Buckets are kept GCRA-style: only the time the bucket will next be
+full is stored, a single float per key. A bucket that has refilled holds no
+information, so losing it (to LRU eviction, or a restart) only ever makes
+the throttle more lenient.
+
+Backends (LOGIN_THROTTLE_BACKEND):
+
+    memory  per-process LRU of at most LOGIN_THROTTLE_MAX_KEYS buckets (default)
+    redis   shared by every process, via the Redis at LOGIN_THROTTLE_URL;
+            falls back to the memory backend while Redis can't be reached
+    none    no throttling
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from flask import Response
+
+from query_cache import ReplyError, RespClient
+
+logger = logging.getLogger(__name__)
+
+# (burst, seconds per refilled attempt)
+DEFAULT_IP_LIMIT = (20, 3.0)
+DEFAULT_USERNAME_LIMIT = (5, 30.0)
+
+DEFAULT_MAX_KEYS = 100000
+
+
+class MemoryBackend:
+    """Buckets in an LRU dict bounded to ``max_keys`` entries."""
+
+    def __init__(self, max_keys=DEFAULT_MAX_KEYS, clock=time.monotonic):
+        self.max_keys = max_keys
+        self.clock = clock
+        self.full_at = OrderedDict()
+        self.lock = threading.Lock()
+
+    def take(self, key, burst, interval, peek=False):
+        """Take one attempt from ``key``'s bucket.
+
+        Returns 0 if allowed, otherwise the seconds until an attempt would be.
+        With ``peek``, only checks, leaving the bucket as it was.
+        """
+        with self.lock:
+            now = self.clock()
+            full_at = max(self.full_at.get(key, now), now) + interval
+            wait = full_at - now - burst * interval
+            if wait > 0 or peek:
+                return max(wait, 0)
+
+            self.full_at[key] = full_at
+            self.full_at.move_to_end(key)
+            while len(self.full_at) > self.max_keys:
+                self.full_at.popitem(last=False)
+            return 0
+
+    def clear(self):
+        with self.lock:
+            self.full_at.clear()
+
+
+class RedisBackend:
+    """Buckets in Redis, updated atomically by a script."""
+
+    # KEYS[1] = bucket; ARGV = now, interval, burst, peek (times in milliseconds)
+    SCRIPT = """
+local now = tonumber(ARGV[1])
+local interval = tonumber(ARGV[2])
+local full_at = math.max(tonumber(redis.call('GET', KEYS[1]) or now), now) + interval
+local wait = full_at - now - tonumber(ARGV[3]) * interval
+if wait > 0 then
+    return wait
+end
+if ARGV[4] == '1' then
+    return 0
+end
+redis.call('SET', KEYS[1], full_at, 'PX', full_at - now)
+return 0
+"""
+
+    def __init__(self, client, fallback=None, clock=time.time):
+        self.client = client
+        self.fallback = fallback or MemoryBackend()
+        self.clock = clock
+
+    def take(self, key, burst, interval, peek=False):
+        try:
+            wait = self.client.execute(
+                'EVAL', self.SCRIPT, 1, f"throttle:{key}",
+                int(self.clock() * 1000), int(interval * 1000), burst, int(peek))
+            return int(wait) / 1000
+        except (OSError, EOFError, ReplyError) as err:
+            logger.warning("Login throttle store unavailable, throttling locally: %s", err)
+            return self.fallback.take(key, burst, interval, peek)
+
+    def clear(self):
+        self.fallback.clear()
+
+
+class LoginThrottle:
+    """Per-IP and per-username rate limits on login attempts."""
+
+    def __init__(self, app=None):
+        self.backend = None
+        self.ip_limit = DEFAULT_IP_LIMIT
+        self.username_limit = DEFAULT_USERNAME_LIMIT
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        name = app.config.setdefault('LOGIN_THROTTLE_BACKEND', 'memory')
+        self.ip_limit = app.config.setdefault('LOGIN_THROTTLE_IP_LIMIT', DEFAULT_IP_LIMIT)
+        self.username_limit = app.config.setdefault(
+            'LOGIN_THROTTLE_USERNAME_LIMIT', DEFAULT_USERNAME_LIMIT)
+        max_keys = app.config.setdefault('LOGIN_THROTTLE_MAX_KEYS', DEFAULT_MAX_KEYS)
+
+        if name == 'memory':
+            self.backend = MemoryBackend(max_keys)
+        elif name == 'redis':
+            url = app.config.setdefault('LOGIN_THROTTLE_URL', 'redis://localhost:6379/0')
+            self.backend = RedisBackend(RespClient.from_url(url), MemoryBackend(max_keys))
+        else:
+            self.backend = None
+
+    @staticmethod
+    def _username_key(username):
+        return f"user:{(username or '').strip().lower()}"
+
+    def check(self, username, ip):
+        """Count a login attempt; return 0 if it may go ahead, else seconds to wait.
+
+        The IP's bucket is charged for it; the username's is only checked,
+        and charged by ``failed`` if the password turns out to be wrong.
+        """
+        if self.backend is None:
+            return 0
+
+        wait = self.backend.take(f"ip:{ip}", *self.ip_limit)
+        if wait:
+            return wait
+        return self.backend.take(self._username_key(username), *self.username_limit, peek=True)
+
+    def failed(self, username):
+        """Count a failed login against ``username``."""
+        if self.backend is not None:
+            self.backend.take(self._username_key(username), *self.username_limit)
+
+    @staticmethod
+    def reject(wait):
+        """A cheap 429 for a throttled attempt."""
+        return Response("Too many login attempts. Try again later.\n", 429, {
+            'Retry-After': str(max(1, int(wait + 0.999))),
+            'Content-Type': 'text/plain; charset=utf-8',
+        })
+
+    def clear(self):
+        if self.backend is not None:
+            self.backend.clear()
+
+
+throttle = LoginThrottle()